@@ -10,6 +10,7 @@ pass_config = click.make_pass_decorator(dict)
 DEFAULT_CONFIG = {
     'video_extension': 'avi',
     'converted_video_speed': 1,
+    'n_workers': 1,
     'calibration': {
         'animal_calibration': False,
         'calibration_init': None,
@@ -21,12 +22,20 @@ DEFAULT_CONFIG = {
     'triangulation': {
         'ransac': False,
         'optim': False,
+        'engine': 'aniposelib',
         'scale_smooth': 2,
         'scale_length': 2,
         'scale_length_weak': 1,
         'reproj_error_threshold': 5,
         'score_threshold': 0.8,
         'n_deriv_smooth': 3,
+        'chunk_frames': 0,
+        'coordinate_frame': 'trial',
+        'undistort_cache': False,
+        'optim_window': 0,
+        'optim_overlap': 50,
+        'optim_decimation': [],
+        'optim_final_max_nfev': 2,
         'constraints': [],
         'constraints_weak': []
     },
@@ -58,10 +67,22 @@ DEFAULT_CONFIG = {
         'score_threshold': 0.05,
         'spline': True,
         'n_back': 5,
+        'viterbi_beam': 0,
+        'viterbi_lag': 0,
         'multiprocessing': False
     },
     'filter3d': {
         'enabled': False
+    },
+    'storage': {
+        'pose_2d_format': 'fast',
+        'pose_3d_format': 'npz',
+        'store_chunk_frames': 10000
+    },
+    'distributed': {
+        'enabled': False,
+        'lease_timeout': 600,
+        'heartbeat': 30
     }
 }
 
@@ -106,9 +127,23 @@ def load_config(fname):
 @click.version_option()
 @click.option('--config', type=click.Path(exists=True, dir_okay=False),
               help='The config file to use instead of the default "config.toml" .')
+@click.option('--n-workers', type=int, default=None,
+              help='Number of processes to run trials on (0 uses all cores), overrides n_workers in the config.')
+@click.option('--distributed', is_flag=True,
+              help='Coordinate with other nodes processing the same project through lease files.')
+@click.option('--profile', is_flag=True,
+              help='Record the time spent in each stage and trial, in .anipose/profile.')
 @click.pass_context
-def cli(ctx, config):
+def cli(ctx, config, n_workers, distributed, profile):
     ctx.obj = load_config(config)
+    if n_workers is not None:
+        ctx.obj['n_workers'] = n_workers
+    if distributed:
+        ctx.obj['distributed']['enabled'] = True
+    if profile:
+        from .profiling import start_profiling, finish_profiling
+        start_profiling(ctx.obj)
+        ctx.call_on_close(lambda: finish_profiling(ctx.obj))
 
 @cli.command()
 @pass_config
@@ -297,8 +332,12 @@ def train_autoencoder(config):
 
 
 @cli.command()
+@click.option('--fused', is_flag=True,
+              help='Carry each trial through filtering, triangulation, 3D filtering and angles in memory.')
+@click.option('--final-only', is_flag=True,
+              help='With --fused, only write the final 3D pose and angles, not the intermediate outputs.')
 @pass_config
-def run_data(config):
+def run_data(config, fused=False, final_only=False):
     from .calibrate import calibrate_all
     from .pose_videos import pose_videos_all
     from .triangulate import triangulate_all
@@ -307,6 +346,18 @@ def run_data(config):
     click.echo('Analyzing videos...')
     pose_videos_all(config)
 
+    if fused:
+        from .fused import fused_all, fused_final_all
+        click.echo('Calibrating...')
+        calibrate_all(config)
+
+        click.echo('Filtering, triangulating and computing angles...')
+        if final_only:
+            fused_final_all(config)
+        else:
+            fused_all(config)
+        return
+
     if config['filter']['enabled']:
         from .filter_pose import filter_pose_all
         click.echo('Filtering tracked points...')
@@ -342,6 +393,40 @@ def run_viz(config):
     label_videos_3d_all(config)
 
 
+@cli.command()
+@click.option('--path', type=click.Path(file_okay=False), default=None,
+              help='Folder to generate the synthetic project in (a temporary folder by default, removed afterwards).')
+@click.option('--stages', type=str, default=None,
+              help='Comma separated list of stages to run (default: all except calibrate).')
+@click.option('--n-cams', default=3, type=int, show_default=True)
+@click.option('--n-sessions', default=1, type=int, show_default=True)
+@click.option('--n-trials', default=2, type=int, show_default=True)
+@click.option('--n-frames', default=300, type=int, show_default=True)
+@click.option('--n-joints', default=6, type=int, show_default=True)
+@click.option('--width', default=640, type=int, show_default=True)
+@click.option('--height', default=480, type=int, show_default=True)
+@click.option('--seed', default=0, type=int, show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False), default=None,
+              help='Write the results to this json file.')
+@pass_config
+def benchmark(config, path, stages, n_cams, n_sessions, n_trials, n_frames,
+              n_joints, width, height, seed, output):
+    from .benchmark import benchmark as run_benchmark
+    params = {
+        'n_cams': n_cams,
+        'n_sessions': n_sessions,
+        'n_trials': n_trials,
+        'n_frames': n_frames,
+        'n_joints': n_joints,
+        'size': (width, height),
+        'seed': seed
+    }
+    if stages is not None:
+        stages = [s.strip() for s in stages.split(',') if s.strip() != '']
+    if path is not None:
+        path = full_path(path)
+    run_benchmark(params, stages, path, config['n_workers'], output)
+
 @cli.command()
 def visualizer():
     from .server import run_server
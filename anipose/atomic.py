@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+import os
+from contextlib import contextmanager
+
+## Atomic writing of outputs.
+## Writers write to a hidden temporary file next to the output and rename it
+## over the output once it is complete. An interrupted run thus never leaves a
+## partially written output behind, which would otherwise be considered done
+## by the next run. Temporary files are hidden, so they are never picked up as
+## inputs by the next stages.
+
+def temp_fname(fname):
+    """Hidden temporary file in the same folder (and thus the same file system)
+    as fname, keeping the extension for writers that rely on it"""
+    folder, name = os.path.split(fname)
+    base, ext = os.path.splitext(name)
+    return os.path.join(folder, '.{}.{}.tmp{}'.format(base, os.getpid(), ext))
+
+
+@contextmanager
+def atomic_output(fname):
+    """Yields a temporary path to write to, which replaces fname
+    when the block finishes without error"""
+    tmp_fname = temp_fname(fname)
+    try:
+        yield tmp_fname
+    except BaseException:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
+    os.replace(tmp_fname, fname)
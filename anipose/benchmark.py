@@ -0,0 +1,577 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import sys
+import time
+import json
+import shutil
+import tempfile
+import importlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+import cv2
+import toml
+from aniposelib.cameras import Camera, CameraGroup
+
+from .common import get_calibration_board
+from .filter_pose import write_pose_2d
+from .profiling import get_peak_rss
+
+## Benchmarks of the pipeline stages on synthetic projects.
+## A project is generated with a ring of cameras looking at a moving
+## skeleton, whose projections (with noise and dropouts) are written as
+## DeepLabCut-style 2d pose files, along with small videos of the trials
+## and charuco calibration videos. Each stage is then run in a fresh process
+## on the whole project, and its time, throughput and peak memory are reported.
+
+CAM_NAMES = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+DEFAULT_PARAMS = {
+    'n_cams': 3,
+    'n_sessions': 1,
+    'n_trials': 2,
+    'n_frames': 300,
+    'n_joints': 6,
+    'noise': 2.0,
+    'dropout': 0.05,
+    'size': (640, 480),
+    'calibration_frames': 60,
+    'seed': 0
+}
+
+## name -> (module, function, config overrides, output folders, 2d or 3d frames)
+STAGES = OrderedDict([
+    ('calibrate', ('calibrate', 'calibrate_all', {},
+                   [], 'calibration')),
+    ('filter_medfilt', ('filter_pose', 'filter_pose_all',
+                        {'filter': {'enabled': True, 'type': 'medfilt'}},
+                        ['pose_2d_filter'], '2d')),
+    ('filter_viterbi', ('filter_pose', 'filter_pose_all',
+                        {'filter': {'enabled': True, 'type': 'viterbi'}},
+                        ['pose_2d_filter'], '2d')),
+    ('filter_viterbi_stream', ('filter_pose', 'filter_pose_all',
+                               {'filter': {'enabled': True, 'type': 'viterbi',
+                                           'viterbi_beam': 8, 'viterbi_lag': 200}},
+                               ['pose_2d_filter'], '2d')),
+    ('triangulate', ('triangulate', 'triangulate_all',
+                     {'filter': {'enabled': False},
+                      'triangulation': {'ransac': False, 'optim': False}},
+                     ['pose_3d'], '3d')),
+    ('triangulate_ransac', ('triangulate', 'triangulate_all',
+                            {'filter': {'enabled': False},
+                             'triangulation': {'ransac': True, 'optim': False}},
+                            ['pose_3d'], '3d')),
+    ('triangulate_weighted', ('triangulate', 'triangulate_all',
+                              {'filter': {'enabled': False},
+                               'triangulation': {'ransac': False, 'optim': False,
+                                                 'engine': 'weighted'}},
+                              ['pose_3d'], '3d')),
+    ('triangulate_optim', ('triangulate', 'triangulate_all',
+                           {'filter': {'enabled': False},
+                            'triangulation': {'ransac': False, 'optim': True}},
+                           ['pose_3d'], '3d')),
+    ('triangulate_optim_c2f', ('triangulate', 'triangulate_all',
+                               {'filter': {'enabled': False},
+                                'triangulation': {'ransac': False, 'optim': True,
+                                                  'optim_decimation': [4]}},
+                               ['pose_3d'], '3d')),
+    ('filter_3d', ('filter_3d', 'filter_pose_3d_all',
+                   {'filter3d': {'enabled': True}},
+                   ['pose_3d_filter'], '3d')),
+    ('angles', ('compute_angles', 'compute_angles_all',
+                {'filter3d': {'enabled': False}},
+                ['angles'], '3d')),
+    ('summarize', ('benchmark', 'summarize_3d',
+                   {'filter3d': {'enabled': False}},
+                   ['summaries'], '3d')),
+    ('label_2d', ('label_videos', 'label_videos_all',
+                  {'filter': {'enabled': False}},
+                  ['videos_labeled_2d'], '2d')),
+])
+
+DEFAULT_STAGES = [s for s in STAGES.keys() if s != 'calibrate']
+
+## stages whose outputs are needed by a stage, run (untimed) first if missing
+REQUIRES = {
+    'filter_3d': ['triangulate'],
+    'angles': ['triangulate'],
+    'summarize': ['triangulate', 'angles'],
+}
+
+## stages compared with a reference stage, which is always run before them,
+## reporting the time they save over it
+REFERENCES = {
+    'triangulate_optim_c2f': 'triangulate_optim',
+}
+
+## the calibration the synthetic data was generated with, used by the stages
+## after the calibrate stage replaced it with its own estimate
+TRUE_CALIBRATION = 'calibration-true.toml'
+CALIBRATION_OUTPUTS = ['calibration.toml', 'detections.pickle']
+
+
+def look_at(center, target):
+    """Rotation matrix of a camera at center looking at target,
+    with the y axis of the image pointing down along the world y axis"""
+    z = target - center
+    z = z / np.linalg.norm(z)
+    y = np.array([0, 1, 0]) - z * z[1]
+    y = y / np.linalg.norm(y)
+    x = np.cross(y, z)
+    return np.array([x, y, z])
+
+
+def make_camera_group(n_cams, size, distance=600.0, spread=np.pi/2):
+    width, height = size
+    focal = width
+    matrix = np.array([[focal, 0, width/2],
+                       [0, focal, height/2],
+                       [0, 0, 1]], dtype='float64')
+    angles = np.linspace(-spread/2, spread/2, n_cams)
+    cameras = []
+    for i, theta in enumerate(angles):
+        center = distance * np.array([np.sin(theta), 0.2 * np.cos(2*theta), -np.cos(theta)])
+        R = look_at(center, np.zeros(3))
+        rvec, _ = cv2.Rodrigues(R)
+        tvec = -R.dot(center)
+        cam = Camera(matrix=matrix, dist=np.zeros(5), size=size,
+                     rvec=rvec.ravel(), tvec=tvec, name=CAM_NAMES[i])
+        cameras.append(cam)
+    return CameraGroup(cameras)
+
+
+def make_trajectory(rng, n_frames, n_joints, segment=40.0):
+    """Smooth random trajectory of a chain of joints, shape (n_frames, n_joints, 3)"""
+    t = np.arange(n_frames)[:, None]
+
+    def smooth_signal(n, scale, max_freq=0.03):
+        freqs = rng.uniform(0.002, max_freq, size=(3, n))
+        phases = rng.uniform(0, 2*np.pi, size=(3, n))
+        amps = rng.uniform(0.3, 1, size=(3, n)) * scale / 3
+        out = np.zeros((t.shape[0], n))
+        for f, p, a in zip(freqs, phases, amps):
+            out += a * np.sin(2*np.pi*f*t + p)
+        return out
+
+    root = smooth_signal(3, 60)
+    directions = smooth_signal(3 * (n_joints-1), 1.5).reshape(n_frames, n_joints-1, 3)
+    directions[:, :, 0] += 1
+    directions /= np.linalg.norm(directions, axis=2)[:, :, None]
+
+    points = np.zeros((n_frames, n_joints, 3))
+    points[:, 0] = root
+    for j in range(1, n_joints):
+        points[:, j] = points[:, j-1] + segment * directions[:, j-1]
+    points -= np.mean(points, axis=(0, 1))
+    return points
+
+
+def make_pose_2d(rng, cgroup, points_3d, noise, dropout):
+    """Projects the 3d points to each camera, with gaussian noise,
+    and replaces a fraction of detections with low score outliers.
+    Returns an array of shape (n_cams, n_frames, n_joints, 3) with x, y, score."""
+    n_frames, n_joints, _ = points_3d.shape
+    n_cams = len(cgroup.cameras)
+    p2d = cgroup.project(points_3d.reshape(-1, 3)).reshape(n_cams, n_frames, n_joints, 2)
+
+    out = np.zeros((n_cams, n_frames, n_joints, 3))
+    out[..., :2] = p2d + rng.normal(0, noise, size=p2d.shape)
+    out[..., 2] = rng.uniform(0.8, 1.0, size=(n_cams, n_frames, n_joints))
+
+    bad = rng.uniform(size=(n_cams, n_frames, n_joints)) < dropout
+    for cix, cam in enumerate(cgroup.cameras):
+        width, height = cam.get_size()
+        n_bad = np.sum(bad[cix])
+        out[cix][bad[cix], 0] = rng.uniform(0, width, size=n_bad)
+        out[cix][bad[cix], 1] = rng.uniform(0, height, size=n_bad)
+        out[cix][bad[cix], 2] = rng.uniform(0, 0.3, size=n_bad)
+    return out
+
+
+def write_trial_video(fname, points_2d, size, fps=30.0):
+    """Writes a small video with a dot for each joint"""
+    width, height = size
+    writer = cv2.VideoWriter(fname, cv2.VideoWriter_fourcc(*'MJPG'), fps, (width, height))
+    for frame_points in points_2d:
+        img = np.full((height, width, 3), 40, dtype='uint8')
+        for x, y, score in frame_points:
+            if np.isfinite(x) and np.isfinite(y):
+                cv2.circle(img, (int(x), int(y)), 4, (255, 255, 255), -1)
+        writer.write(img)
+    writer.release()
+
+
+def write_calibration_videos(rng, cgroup, board, folder, n_frames, fps=30.0):
+    """Renders a charuco board moving in front of all the cameras"""
+    pix_per_square = 100
+    numx, numy = board.get_size()
+    square_length = board.square_length
+    board_img = board.draw((numx*pix_per_square, numy*pix_per_square))
+    if len(board_img.shape) == 2:
+        board_img = cv2.cvtColor(board_img, cv2.COLOR_GRAY2BGR)
+
+    ## board image pixels -> board coordinates, centered on the board
+    S = np.array([[square_length/pix_per_square, 0, -numx*square_length/2],
+                  [0, square_length/pix_per_square, -numy*square_length/2],
+                  [0, 0, 1]])
+
+    writers = []
+    for cam in cgroup.cameras:
+        fname = os.path.join(folder, 'calib_{}.avi'.format(cam.get_name()))
+        writers.append(cv2.VideoWriter(fname, cv2.VideoWriter_fourcc(*'MJPG'), fps,
+                                       tuple(cam.get_size())))
+
+    for i in range(n_frames):
+        rvec_board = rng.uniform(-0.4, 0.4, size=3) * np.array([1, 1, 0.5])
+        R_board, _ = cv2.Rodrigues(rvec_board)
+        t_board = rng.uniform(-40, 40, size=3)
+        for cam, writer in zip(cgroup.cameras, writers):
+            R_cam, _ = cv2.Rodrigues(np.array(cam.get_rotation(), dtype='float64'))
+            t_cam = np.array(cam.get_translation())
+            R = R_cam.dot(R_board)
+            t = R_cam.dot(t_board) + t_cam
+            H = cam.get_camera_matrix().dot(np.array([R[:, 0], R[:, 1], t]).T).dot(S)
+            width, height = cam.get_size()
+            img = cv2.warpPerspective(board_img, H, (width, height),
+                                      borderValue=(128, 128, 128))
+            writer.write(img)
+
+    for writer in writers:
+        writer.release()
+
+
+def make_config(params):
+    n_joints = params['n_joints']
+    bodyparts = ['joint{}'.format(i) for i in range(n_joints)]
+    chain = list(zip(bodyparts, bodyparts[1:]))
+    angles = dict()
+    for a, b, c in zip(bodyparts, bodyparts[1:], bodyparts[2:]):
+        angles[b + '_flex'] = [a, b, c]
+
+    return {
+        'nesting': 1,
+        'video_extension': 'avi',
+        'calibration': {
+            'board_type': 'charuco',
+            'board_size': [5, 7],
+            'board_marker_bits': 4,
+            'board_marker_dict_number': 50,
+            'board_marker_length': 18.75,
+            'board_square_side_length': 25,
+            'animal_calibration': False,
+            'fisheye': False
+        },
+        'manual_verification': {
+            'manually_verify': False
+        },
+        'triangulation': {
+            'cam_regex': '_([A-Z])$',
+            'constraints': [list(c) for c in chain],
+            'score_threshold': 0.5
+        },
+        'labeling': {
+            'scheme': [bodyparts]
+        },
+        'angles': angles
+    }
+
+
+def generate_project(path, params=None):
+    """Generates a synthetic project in path. Returns the CameraGroup used."""
+    params = dict(DEFAULT_PARAMS, **(params or dict()))
+    rng = np.random.RandomState(params['seed'])
+    size = tuple(params['size'])
+
+    os.makedirs(path, exist_ok=True)
+    config = make_config(params)
+    with open(os.path.join(path, 'config.toml'), 'w') as f:
+        toml.dump(config, f)
+
+    cgroup = make_camera_group(params['n_cams'], size)
+    calib_folder = os.path.join(path, 'calibration')
+    os.makedirs(calib_folder, exist_ok=True)
+    cgroup.dump(os.path.join(path, TRUE_CALIBRATION))
+    shutil.copy(os.path.join(path, TRUE_CALIBRATION),
+                os.path.join(calib_folder, 'calibration.toml'))
+
+    from .anipose import load_config
+    full_config = load_config(os.path.join(path, 'config.toml'))
+    board = get_calibration_board(full_config)
+    write_calibration_videos(rng, cgroup, board, calib_folder,
+                             params['calibration_frames'])
+
+    bodyparts = config['labeling']['scheme'][0]
+    for snum in range(params['n_sessions']):
+        session = os.path.join(path, 'session{}'.format(snum))
+        pose_folder = os.path.join(session, 'pose-2d')
+        video_folder = os.path.join(session, 'videos-raw')
+        os.makedirs(pose_folder, exist_ok=True)
+        os.makedirs(video_folder, exist_ok=True)
+
+        for tnum in range(params['n_trials']):
+            points_3d = make_trajectory(rng, params['n_frames'], params['n_joints'])
+            pose_2d = make_pose_2d(rng, cgroup, points_3d,
+                                   params['noise'], params['dropout'])
+            metadata = {
+                'scorer': 'synthetic',
+                'bodyparts': bodyparts,
+                'index': np.arange(params['n_frames'])
+            }
+            for cix, cam in enumerate(cgroup.cameras):
+                name = 'trial{}_{}'.format(tnum, cam.get_name())
+                write_pose_2d(pose_2d[cix], metadata,
+                              os.path.join(pose_folder, name + '.h5'))
+                write_trial_video(os.path.join(video_folder, name + '.avi'),
+                                  pose_2d[cix], size)
+
+    return cgroup
+
+
+def summarize_3d(config):
+    from .summarize import summarize_angles, summarize_pose3d
+    summarize_angles(config)
+    summarize_pose3d(config)
+
+
+def update_nested(config, overrides):
+    for key, value in overrides.items():
+        if isinstance(value, dict):
+            config.setdefault(key, dict())
+            update_nested(config[key], value)
+        else:
+            config[key] = value
+
+
+def run_stage_process(path, stage, n_workers):
+    """Runs one stage on the project in path, in the current process.
+    Returns the wall time, cpu time (of this process only, not of the
+    workers) and peak memory. Raises an error if any of its tasks failed."""
+    from .anipose import load_config
+    module_name, fun_name, overrides, _, _ = STAGES[stage]
+    config = load_config(os.path.join(path, 'config.toml'))
+    update_nested(config, overrides)
+    config['n_workers'] = n_workers
+
+    module = importlib.import_module('.' + module_name, 'anipose')
+    fun = getattr(module, fun_name)
+
+    ## stage progress is not part of the benchmark output
+    with open(os.devnull, 'w') as devnull:
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = devnull, devnull
+        try:
+            wall0 = time.perf_counter()
+            cpu0 = time.process_time()
+            failures = fun(config)
+            wall = time.perf_counter() - wall0
+            cpu = time.process_time() - cpu0
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+    if failures:
+        raise RuntimeError('{} tasks failed: {}'.format(
+            len(failures), ', '.join([os.path.relpath(str(f), path)
+                                      for f in failures])))
+
+    return wall, cpu, max(get_peak_rss(), get_peak_rss_children())
+
+
+def get_peak_rss_children():
+    """Peak resident memory of the largest finished worker process"""
+    try:
+        import resource
+    except ImportError:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+
+def calibration_error(path):
+    """Mean distance in pixels between the projections of points around the
+    origin through the estimated calibration and through the true one"""
+    fname = os.path.join(path, 'calibration', 'calibration.toml')
+    if not os.path.exists(fname):
+        return np.nan
+    cgroup_true = CameraGroup.load(os.path.join(path, TRUE_CALIBRATION))
+    cgroup = CameraGroup.load(fname)
+    if len(cgroup.cameras) != len(cgroup_true.cameras):
+        return np.nan
+    ## the calibration is only defined up to a rigid transform, so compare
+    ## the relative poses through the first camera
+    rng = np.random.RandomState(0)
+    p3d_true = rng.uniform(-100, 100, size=(200, 3))
+    R0, _ = cv2.Rodrigues(np.array(cgroup_true.cameras[0].get_rotation(), dtype='float64'))
+    t0 = np.array(cgroup_true.cameras[0].get_translation())
+    p_cam = p3d_true.dot(R0.T) + t0
+    R1, _ = cv2.Rodrigues(np.array(cgroup.cameras[0].get_rotation(), dtype='float64'))
+    t1 = np.array(cgroup.cameras[0].get_translation())
+    p3d = (p_cam - t1).dot(R1)
+    p2d_true = cgroup_true.project(p3d_true)
+    p2d = cgroup.project(p3d)
+    return float(np.mean(np.linalg.norm(p2d - p2d_true, axis=2)))
+
+
+def clear_outputs(path, folders):
+    from .anipose import load_config
+    config = load_config(os.path.join(path, 'config.toml'))
+    for key in folders:
+        name = config['pipeline'][key]
+        targets = [os.path.join(path, name)]
+        for session in os.listdir(path):
+            targets.append(os.path.join(path, session, name))
+        for target in targets:
+            if os.path.isdir(target) and os.path.basename(target) == name:
+                shutil.rmtree(target)
+
+
+def count_outputs(path, folders):
+    from .anipose import load_config
+    config = load_config(os.path.join(path, 'config.toml'))
+    count = 0
+    for root, dirs, files in os.walk(path):
+        if os.path.basename(root) in [config['pipeline'][k] for k in folders]:
+            count += len([f for f in files if not f.startswith('.')])
+    return count
+
+
+def run_benchmark(path, params, stages, n_workers=1):
+    params = dict(DEFAULT_PARAMS, **params)
+    n_frames_2d = params['n_sessions'] * params['n_trials'] * params['n_cams'] * params['n_frames']
+    n_frames_3d = params['n_sessions'] * params['n_trials'] * params['n_frames']
+
+    n_frames_calib = params['n_cams'] * params['calibration_frames']
+    calib_folder = os.path.join(path, 'calibration')
+
+    results = []
+    ctx = get_context('spawn')
+    for stage in stages:
+        _, _, _, folders, kind = STAGES[stage]
+        clear_outputs(path, folders)
+        required_error = None
+        for req in REQUIRES.get(stage, []):
+            if count_outputs(path, STAGES[req][3]) == 0:
+                with ProcessPoolExecutor(1, mp_context=ctx) as pool:
+                    try:
+                        pool.submit(run_stage_process, path, req, n_workers).result()
+                    except Exception as e:
+                        required_error = 'required stage {} failed: {}'.format(req, e)
+        if kind == 'calibration':
+            for name in CALIBRATION_OUTPUTS:
+                if os.path.exists(os.path.join(calib_folder, name)):
+                    os.remove(os.path.join(calib_folder, name))
+        if required_error is not None:
+            wall, cpu, peak_rss = np.nan, np.nan, 0
+            error = required_error
+        else:
+            with ProcessPoolExecutor(1, mp_context=ctx) as pool:
+                future = pool.submit(run_stage_process, path, stage, n_workers)
+                try:
+                    wall, cpu, peak_rss = future.result()
+                    error = None
+                except Exception as e:
+                    wall, cpu, peak_rss = np.nan, np.nan, 0
+                    error = '{}: {}'.format(type(e).__name__, e)
+
+        outputs = count_outputs(path, folders)
+        if error is None and kind != 'calibration' and outputs == 0:
+            wall, cpu, peak_rss = np.nan, np.nan, 0
+            error = 'no outputs were written'
+
+        frames = {'2d': n_frames_2d, '3d': n_frames_3d,
+                  'calibration': n_frames_calib}[kind]
+        result = {
+            'stage': stage,
+            'wall': wall,
+            'cpu': cpu,
+            'frames': frames,
+            'fps': frames / wall if wall > 0 else np.nan,
+            'peak_rss_mb': peak_rss / 2**20,
+            'outputs': outputs,
+            'error': error
+        }
+        walls = dict([(x['stage'], x['wall']) for x in results
+                      if x['error'] is None])
+        if error is None and REFERENCES.get(stage) in walls:
+            result['reference'] = REFERENCES[stage]
+            result['time_saved'] = walls[REFERENCES[stage]] - wall
+        if kind == 'calibration':
+            result['outputs'] = int(os.path.exists(
+                os.path.join(calib_folder, 'calibration.toml')))
+            if error is None and result['outputs'] == 0:
+                result['error'] = 'no calibration was written'
+            elif error is None:
+                result['reprojection_difference'] = calibration_error(path)
+            shutil.copy(os.path.join(path, TRUE_CALIBRATION),
+                        os.path.join(calib_folder, 'calibration.toml'))
+        print_result(result)
+        results.append(result)
+
+    return results
+
+
+def print_header():
+    print('{:<20} {:>9} {:>9} {:>9} {:>11} {:>9} {:>8}'.format(
+        'stage', 'wall (s)', 'cpu (s)', 'frames', 'frames/s', 'peak MB', 'outputs'))
+
+
+def print_result(r):
+    if r['error'] is not None:
+        print('{:<20} {:>9}'.format(r['stage'], 'FAILED'))
+        print('  ' + r['error'])
+        return
+    print('{:<20} {:>9.2f} {:>9.2f} {:>9} {:>11.1f} {:>9.0f} {:>8}'.format(
+        r['stage'], r['wall'], r['cpu'], r['frames'], r['fps'],
+        r['peak_rss_mb'], r['outputs']))
+    if 'time_saved' in r:
+        print('  time saved over {}: {:.2f} s ({:.0f}%)'.format(
+            r['reference'], r['time_saved'],
+            100 * r['time_saved'] / (r['wall'] + r['time_saved'])))
+    if 'reprojection_difference' in r:
+        print('  mean difference with the true projections: {:.2f} px'.format(
+            r['reprojection_difference']))
+
+
+def benchmark(params=None, stages=None, path=None, n_workers=1, output=None):
+    """Generates a synthetic project (in a temporary folder unless path is
+    given) and benchmarks the stages on it"""
+    params = dict(DEFAULT_PARAMS, **(params or dict()))
+    if stages is None:
+        stages = DEFAULT_STAGES
+    for stage in stages:
+        if stage not in STAGES:
+            raise ValueError('Unknown stage "{}", should be one of {}'.format(
+                stage, list(STAGES.keys())))
+    for stage, ref in REFERENCES.items():
+        if stage in stages and ref not in stages[:stages.index(stage)]:
+            stages = list(stages)
+            stages.insert(stages.index(stage), ref)
+
+    cleanup = path is None
+    if path is None:
+        path = tempfile.mkdtemp(prefix='anipose-benchmark-')
+
+    try:
+        print('Generating synthetic project in {}...'.format(path))
+        t0 = time.perf_counter()
+        generate_project(path, params)
+        print('  took {:.1f} s'.format(time.perf_counter() - t0))
+        print()
+
+        print_header()
+        results = run_benchmark(path, params, stages, n_workers)
+    finally:
+        if cleanup:
+            shutil.rmtree(path, ignore_errors=True)
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump({'params': params, 'n_workers': n_workers,
+                       'results': results}, f, indent=2, default=float)
+
+    return results
@@ -3,7 +3,6 @@
 from tqdm import tqdm
 import numpy as np
 import os
-from glob import glob
 from collections import defaultdict
 import pickle
 
@@ -11,17 +10,21 @@ from .common import \
     find_calibration_folder, make_process_fun, process_all, \
     get_cam_name, get_video_name, \
     get_calibration_board, split_full_path, get_video_params
+from .manifest import find_files
+from .atomic import atomic_output
+from .checkpoint import data_key, save_checkpoint, load_checkpoint, \
+    remove_checkpoint
 
 from .triangulate import load_pose2d_fnames, load_offsets_dict
 
-from aniposelib.cameras import CameraGroup
+from aniposelib.cameras import CameraGroup, resample_points, get_error_dict
 
 def get_pose2d_fnames(config, session_path):
     if config['filter']['enabled']:
         pipeline_pose = config['pipeline']['pose_2d_filter']
     else:
         pipeline_pose = config['pipeline']['pose_2d']
-    fnames = glob(os.path.join(session_path, pipeline_pose, '*.h5'))
+    fnames = find_files(config, os.path.join(session_path, pipeline_pose), 'h5')
     return session_path, fnames
 
 
@@ -118,6 +121,81 @@ def process_points_for_calibration(all_points, all_scores):
 
     return points
 
+def get_mu_bounds(error_dict):
+    max_error = 0
+    min_error = 0
+    for k, v in error_dict.items():
+        num, percents = v
+        max_error = max(percents[-1], max_error)
+        min_error = max(percents[0], min_error)
+    return min_error, max_error
+
+
+def bundle_adjust_iter_resumable(cgroup, p2ds, outname, key,
+                                 n_iters=6, start_mu=15, end_mu=1,
+                                 max_nfev=200, ftol=1e-4,
+                                 n_samp_iter=200, n_samp_full=1000,
+                                 error_threshold=0.3):
+    """Same as CameraGroup.bundle_adjust_iter, but saves the camera
+    parameters after each iteration in a checkpoint next to outname,
+    and resumes from the last completed iteration when restarted.
+    The checkpoint is only used if it was saved with the same key."""
+    start = 0
+    ckpt = load_checkpoint(outname, 'adjust', key)
+    if ckpt is not None:
+        start = int(ckpt['iteration'])
+        for cam, params in zip(cgroup.cameras, ckpt['params']):
+            cam.set_params(params)
+        print('resuming bundle adjustment from iteration {}'.format(start))
+
+    mus = np.exp(np.linspace(np.log(start_mu), np.log(end_mu), num=n_iters))
+
+    for i in range(start, n_iters):
+        p2ds_iter, _ = resample_points(p2ds, n_samp=n_samp_full)
+        p3ds = cgroup.triangulate(p2ds_iter)
+        errors_full = cgroup.reprojection_error(p3ds, p2ds_iter, mean=False)
+        errors_norm = cgroup.reprojection_error(p3ds, p2ds_iter, mean=True)
+
+        min_error, max_error = get_mu_bounds(get_error_dict(errors_full))
+        mu = max(min(max_error, mus[i]), min_error)
+
+        good = errors_norm < mu
+        p2ds_samp, _ = resample_points(p2ds_iter[:, good], n_samp=n_samp_iter)
+
+        error = np.median(errors_norm)
+        if error < error_threshold:
+            break
+
+        print('error: {:.2f}, mu: {:.1f}, ratio: {:.3f}'.format(error, mu, np.mean(good)))
+
+        cgroup.bundle_adjust(p2ds_samp, loss='linear', ftol=ftol,
+                             max_nfev=max_nfev, verbose=True)
+
+        params = np.array([cam.get_params() for cam in cgroup.cameras])
+        save_checkpoint(outname, 'adjust', key, params=params, iteration=i+1)
+
+    p2ds_full, _ = resample_points(p2ds, n_samp=n_samp_full)
+    p3ds = cgroup.triangulate(p2ds_full)
+    errors_full = cgroup.reprojection_error(p3ds, p2ds_full, mean=False)
+    errors_norm = cgroup.reprojection_error(p3ds, p2ds_full, mean=True)
+    min_error, max_error = get_mu_bounds(get_error_dict(errors_full))
+    mu = max(max(max_error, end_mu), min_error)
+
+    good = errors_norm < mu
+    cgroup.bundle_adjust(p2ds_full[:, good], loss='linear',
+                         ftol=ftol, max_nfev=max(200, max_nfev),
+                         verbose=True)
+
+    error = cgroup.average_error(p2ds_full, median=True)
+    print('error: ', error)
+    return error
+
+
+def dump_calibration(cgroup, outname):
+    with atomic_output(outname) as tmp_fname:
+        cgroup.dump(tmp_fname)
+
+
 def process_session(config, session_path):
     pipeline_calibration_videos = config['pipeline']['calibration_videos']
     pipeline_calibration_results = config['pipeline']['calibration_results']
@@ -130,9 +208,9 @@ def process_session(config, session_path):
     if calibration_path is None:
         return
 
-    videos = glob(os.path.join(calibration_path,
-                               pipeline_calibration_videos,
-                               '*.'+video_ext))
+    videos = find_files(config, os.path.join(calibration_path,
+                                             pipeline_calibration_videos),
+                        video_ext)
     videos = sorted(videos)
 
 
@@ -190,8 +268,9 @@ def process_session(config, session_path):
                 all_rows = pickle.load(f)
         else:
             all_rows = cgroup.get_rows_videos(video_list, board)
-            with open(rows_fname, 'wb') as f:
-                pickle.dump(all_rows, f)
+            with atomic_output(rows_fname) as tmp_fname:
+                with open(tmp_fname, 'wb') as f:
+                    pickle.dump(all_rows, f)
 
         cgroup.set_camera_sizes_videos(video_list)
 
@@ -210,21 +289,24 @@ def process_session(config, session_path):
     cgroup.metadata['adjusted'] = False
     if error is not None:
         cgroup.metadata['error'] = float(error)
-    cgroup.dump(outname)
-        
+    dump_calibration(cgroup, outname)
+
     if config['calibration']['animal_calibration']:
         all_points, all_scores, all_cam_names = load_2d_data(config, calibration_path)
         imgp = process_points_for_calibration(all_points, all_scores)
         # error = cgroup.bundle_adjust(imgp, threshold=10, ftol=1e-4, loss='huber')
         cgroup = cgroup.subset_cameras_names(all_cam_names)
-        error = cgroup.bundle_adjust_iter(imgp, ftol=1e-4, n_iters=10,
-                                          n_samp_iter=300, n_samp_full=1000,
-                                          max_nfev=500,
-                                          verbose=True)
+        init_params = np.array([cam.get_params() for cam in cgroup.cameras])
+        key = data_key(all_points, all_scores, init_params)
+        error = bundle_adjust_iter_resumable(cgroup, imgp, outname, key,
+                                             ftol=1e-4, n_iters=10,
+                                             n_samp_iter=300, n_samp_full=1000,
+                                             max_nfev=500)
         cgroup.metadata['adjusted'] = True
         cgroup.metadata['error'] = float(error)
 
-    cgroup.dump(outname)
+    dump_calibration(cgroup, outname)
+    remove_checkpoint(outname, 'adjust')
 
 
 calibrate_all = make_process_fun(process_session)
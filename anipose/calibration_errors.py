@@ -5,7 +5,6 @@ import cv2
 from tqdm import trange
 import numpy as np
 import os, os.path
-from glob import glob
 from collections import defaultdict
 import pandas as pd
 
@@ -15,6 +14,9 @@ from .common import \
     get_calibration_board, get_board_type, \
     find_calibration_folder, make_process_fun, \
     get_cam_name, get_video_name, load_intrinsics, load_extrinsics
+from .manifest import find_files
+from .atomic import atomic_output
+from .dependencies import Dependencies, is_up_to_date, record_build
 from .triangulate import triangulate_optim, triangulate_simple, \
     reprojection_error, reprojection_error_und
 from .calibrate_extrinsics import detect_aruco, estimate_pose, fill_points
@@ -161,9 +163,9 @@ def process_session(config, session_path):
     if calibration_path is None:
         return
 
-    videos = glob(os.path.join(calibration_path,
-                               pipeline_calibration_videos,
-                               '*.avi'))
+    videos = find_files(config, os.path.join(calibration_path,
+                                             pipeline_calibration_videos),
+                        'avi')
     videos = sorted(videos)
 
     cam_videos = defaultdict(list)
@@ -191,16 +193,22 @@ def process_session(config, session_path):
         fname_dict = dict(zip(cam_names, fnames))
         fname_dicts[name] = fname_dict
 
+    calib_fname = os.path.join(outdir, 'calibration.toml')
+
     for vidname, fd in fname_dicts.items():
         outname_base = vidname + '.csv'
         outname = os.path.join(outdir, outname_base)
 
-        if os.path.exists(outname):
+        deps = Dependencies([outname], [calib_fname] + sorted(fd.values()),
+                            ['calibration'])
+        if is_up_to_date(config, deps):
             continue
 
         print(outname)
         dout = process_trig_errors(config, fd, intrinsics, extrinsics)
-        dout.to_csv(outname, index=False)
+        with atomic_output(outname) as tmp_fname:
+            dout.to_csv(tmp_fname, index=False)
+        record_build(config, deps)
 
 
 get_errors_all = make_process_fun(process_session)
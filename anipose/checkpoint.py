@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from .atomic import atomic_output
+from .dependencies import make_record
+
+## Checkpoints of long computations (3d optimization, bundle adjustment).
+## Intermediate state is saved as arrays in a hidden .<name>.<tag>.npz file
+## next to the output, along with a key computed from the inputs and config
+## sections it depends on. A restarted run loads the checkpoint and resumes
+## from it if the key still matches, and the checkpoint is removed once the
+## output is written.
+
+def checkpoint_fname(outname, tag):
+    folder, name = os.path.split(outname)
+    return os.path.join(folder, '.{}.{}.npz'.format(name, tag))
+
+
+def checkpoint_key(config, inputs, sections):
+    record = make_record(config, inputs, sections)
+    text = json.dumps(record, sort_keys=True)
+    return hashlib.sha1(text.encode('utf8')).hexdigest()
+
+
+def data_key(*arrays):
+    """Key computed from the contents of arrays, for computations
+    whose inputs are not files"""
+    h = hashlib.sha1()
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        h.update(str((arr.dtype, arr.shape)).encode('utf8'))
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+def save_checkpoint(outname, tag, key, **arrays):
+    fname = checkpoint_fname(outname, tag)
+    with atomic_output(fname) as tmp_fname:
+        with open(tmp_fname, 'wb') as f:
+            np.savez(f, checkpoint_key=np.array(key), **arrays)
+
+
+def load_checkpoint(outname, tag, key):
+    """Returns a dict with the arrays of the checkpoint,
+    or None if there is no valid checkpoint for this key"""
+    fname = checkpoint_fname(outname, tag)
+    if not os.path.exists(fname):
+        return None
+    try:
+        with np.load(fname, allow_pickle=False) as data:
+            if str(data['checkpoint_key']) != key:
+                return None
+            return dict([(k, data[k]) for k in data.files if k != 'checkpoint_key'])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def remove_checkpoint(outname, tag):
+    fname = checkpoint_fname(outname, tag)
+    if os.path.exists(fname):
+        os.remove(fname)
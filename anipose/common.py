@@ -8,6 +8,7 @@ from subprocess import check_output
 import numpy as np
 
 from aniposelib.boards import CharucoBoard, Checkerboard
+from aniposelib.cameras import CameraGroup
 
 def atoi(text):
     return int(text) if text.isdigit() else text
@@ -28,11 +29,29 @@ def wc(filename):
     return int(num)
 
 def get_data_length(fname):
+    from .pose_io import read_pose_meta, write_pose_meta
+    meta = read_pose_meta(fname)
+    if meta is not None:
+        return meta['nframes']
+
+    # output from before anipose recorded metadata, count and record it
     import pandas as pd
+    if fname.endswith('.h5'):
+        with pd.HDFStore(fname, 'r') as store:
+            storer = store.get_storer(store.keys()[0])
+            numlines = storer.nrows if storer.is_table else storer.shape[0]
+    elif fname.endswith('.npz'):
+        with np.load(fname) as data:
+            numlines = len(data['fnum'])
+    else:
+        try:
+            numlines = wc(fname) - 1
+        except:
+            numlines = len(pd.read_csv(fname))
     try:
-        numlines = wc(fname) - 1
-    except:
-        numlines = len(pd.read_csv(fname))
+        write_pose_meta(fname, numlines)
+    except OSError:
+        pass
     return numlines
 
 def get_video_params_cap(cap):
@@ -44,13 +63,15 @@ def get_video_params_cap(cap):
     return params
 
 def get_video_params(fname):
-    cap = cv2.VideoCapture(fname)
-    params = get_video_params_cap(cap)
-    cap.release()
-    return params
+    from .video_info import get_video_info
+    info = get_video_info(fname)
+    keys = ['width', 'height', 'nframes', 'fps']
+    return dict([(k, info[k]) for k in keys])
 
 def get_folders(path):
     folders = next(os.walk(path))[1]
+    # skip hidden folders such as the .anipose state folder
+    folders = [f for f in folders if not f.startswith('.')]
     return sorted(folders)
 
 
@@ -79,21 +100,13 @@ def get_video_name(config, fname):
     vidname = re.sub(cam_regex, '', basename)
     return vidname.strip()
 
-# TODO: get rid of skvideo dependency
 def get_duration(vidname):
-    import skvideo.io
-    metadata = skvideo.io.ffprobe(vidname)
-    duration = float(metadata['video']['@duration'])
-    return duration
+    from .video_info import get_video_info
+    return get_video_info(vidname)['duration']
 
 def get_nframes(vidname):
-    import skvideo.io
-    try:
-        metadata = skvideo.io.ffprobe(vidname)
-        length = int(metadata['video']['@nb_frames'])
-        return length
-    except KeyError:
-        return 0
+    from .video_info import get_video_info
+    return get_video_info(vidname)['nframes']
 
 def full_path(path):
     path_user = os.path.expanduser(path)
@@ -119,13 +132,21 @@ def process_all(config, process_session, **args):
     pipeline_prefix = config['path']
     nesting = config['nesting']
 
+    from .profiling import span
+
+    def run_session(path):
+        with span('session', 'session', path=path):
+            return process_session(config, path, **args)
+
     output = dict()
 
     if nesting == 0:
-        output[()] = process_session(config, pipeline_prefix, **args)
+        output[()] = run_session(pipeline_prefix)
         return output
 
-    folders = get_folders(pipeline_prefix)
+    from .manifest import find_folders
+
+    folders = find_folders(config, pipeline_prefix)
     level = 1
 
     q = deque()
@@ -140,9 +161,9 @@ def process_all(config, process_session, **args):
         path, past_folders, level = q.pop()
 
         if nesting < 0:
-            output[past_folders] = process_session(config, path, **args)
+            output[past_folders] = run_session(path)
 
-            folders = get_folders(path)
+            folders = find_folders(config, path)
             next_folders = [ (os.path.join(path, folder),
                               past_folders + (folder,),
                               level+1)
@@ -150,11 +171,11 @@ def process_all(config, process_session, **args):
             q.extend(next_folders)
         else:
             if level == nesting:
-                output[past_folders] = process_session(config, path, **args)
+                output[past_folders] = run_session(path)
             elif level > nesting:
                 continue
             elif level < nesting:
-                folders = get_folders(path)
+                folders = find_folders(config, path)
                 next_folders = [ (os.path.join(path, folder),
                                   past_folders + (folder,),
                                   level+1)
@@ -165,13 +186,26 @@ def process_all(config, process_session, **args):
 
 def make_process_fun(process_session, **args):
     def fun(config):
-        return process_all(config, process_session, **args)
+        from .scheduler import process_tasks
+        return process_tasks(config, process_session, **args)
     return fun
 
+## Process-wide caches of calibration lookups.
+## Calibration folders are memoized per session path once found, and
+## calibrations are parsed once per process, keyed by the path, mtime and
+## size of calibration.toml (so an updated calibration is reloaded) and the
+## subset of cameras used.
+_calibration_folders = dict()
+_camera_groups = dict()
+
 def find_calibration_folder(config, session_path):
     pipeline_calibration_videos = config['pipeline']['calibration_videos']
     nesting = config['nesting']
 
+    key = (os.path.abspath(session_path), nesting, pipeline_calibration_videos)
+    if key in _calibration_folders:
+        return _calibration_folders[key]
+
     # TODO: fix this for nesting = -1
     level = nesting
     curpath = session_path
@@ -179,11 +213,29 @@ def find_calibration_folder(config, session_path):
     while level >= 0:
         checkpath = os.path.join(curpath, pipeline_calibration_videos)
         if os.path.isdir(checkpath):
+            _calibration_folders[key] = curpath
             return curpath
 
         curpath = os.path.dirname(curpath)
         level -= 1
 
+def load_camera_group(calib_fname, cam_names=None):
+    """CameraGroup.load(calib_fname), with only the cameras cam_names if given.
+    The result is cached and shared within the process, so it must not be
+    modified (subset_cameras_names and other methods return copies)."""
+    path = os.path.abspath(calib_fname)
+    st = os.stat(path)
+    state = (st.st_mtime_ns, st.st_size)
+    key = (path, state, None if cam_names is None else tuple(cam_names))
+    if key not in _camera_groups:
+        for other in [k for k in _camera_groups if k[0] == path and k[1] != state]:
+            del _camera_groups[other]
+        if cam_names is None:
+            _camera_groups[key] = CameraGroup.load(path)
+        else:
+            _camera_groups[key] = load_camera_group(path).subset_cameras_names(cam_names)
+    return _camera_groups[key]
+
 
 
 def get_calibration_board(config):
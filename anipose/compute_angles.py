@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import numpy as np
-from glob import glob
 import pandas as pd
 import os.path
 from tqdm import tqdm, trange
@@ -10,6 +9,9 @@ from collections import defaultdict
 from scipy.spatial.transform import Rotation
 
 from .common import make_process_fun, get_data_length, natural_keys
+from .pose_io import read_pose_3d, write_pose_csv, find_pose_3d
+from .scheduler import Task
+from .dependencies import Dependencies, is_up_to_date
 
 
 # project v onto u
@@ -135,9 +137,9 @@ def angles_crossaxis(vecs, angle):
     return ang_deg
     
 
-def compute_angles(config, labels_fname, outname):
-    data = pd.read_csv(labels_fname)
-
+def compute_angles_data(config, data):
+    """Computes the angles in the config from a table of 3d points
+    in the pose-3d format"""
     cols = [x for x in data.columns if '_error' in x]
     bodyparts = [c.replace('_error', '') for c in cols]
 
@@ -149,8 +151,13 @@ def compute_angles(config, labels_fname, outname):
     outdict = get_angles(vecs, config.get('angles', dict()))
     outdict['fnum'] = data['fnum']
     
-    dout = pd.DataFrame(outdict)
-    dout.to_csv(outname, index=False)
+    return pd.DataFrame(outdict)
+
+
+def compute_angles(config, labels_fname, outname):
+    data = read_pose_3d(labels_fname)
+    dout = compute_angles_data(config, data)
+    write_pose_csv(dout, outname)
 
 
 def process_session(config, session_path):
@@ -163,8 +170,7 @@ def process_session(config, session_path):
         pipeline_3d = config['pipeline']['pose_3d']
     pipeline_angles = config['pipeline']['angles']
 
-    labels_fnames = glob(os.path.join(session_path,
-                                      pipeline_3d, '*.csv'))
+    labels_fnames = find_pose_3d(config, os.path.join(session_path, pipeline_3d))
     labels_fnames = sorted(labels_fnames, key=natural_keys)
 
     outdir = os.path.join(session_path, pipeline_angles)
@@ -178,12 +184,13 @@ def process_session(config, session_path):
 
         out_fname = os.path.join(outdir, basename+'.csv')
 
-        if os.path.exists(out_fname):
+        deps = Dependencies([out_fname], [fname], ['angles'])
+        if is_up_to_date(config, deps):
             continue
 
         print(out_fname)
 
-        compute_angles(config, fname, out_fname)
+        yield Task(out_fname, compute_angles, (config, fname, out_fname), deps)
 
 
 compute_angles_all = make_process_fun(process_session)
@@ -3,13 +3,14 @@
 import os
 import os.path
 import subprocess
-from glob import glob
 import sys
 from collections import deque
 import re
 import cv2
 from multiprocessing import Pool
 from .common import process_all, get_video_params, natural_keys
+from .manifest import find_files
+from .video_info import probe_videos
 
 if len(sys.argv) < 2:
     source_dir = os.getcwd()
@@ -52,14 +53,17 @@ def process_video(fname, outname, video_speed):
 def process_folder(config, path):
     print(path)
 
-    vidnames = glob(os.path.join(path, config['pipeline']['videos_raw'],
-                                 '*.' + config['video_extension']))
+    vidnames = find_files(config, os.path.join(path, config['pipeline']['videos_raw']),
+                          config['video_extension'])
     vidnames = sorted(vidnames, key=natural_keys)
 
     outpath = os.path.join(path, config['pipeline']['videos_raw_mp4'])
 
     os.makedirs(outpath, exist_ok=True)
 
+    # fill the metadata cache for same_length in one go
+    probe_videos(vidnames + find_files(config, outpath, 'mp4'))
+
     pool = Pool(3)
 
     for vidname in vidnames:
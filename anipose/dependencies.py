@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+from collections import namedtuple
+
+## Keeps track of what each output was computed from, so that stages only
+## recompute outputs whose inputs or relevant config sections have changed.
+## For every output there is a small json record in <project>/.anipose/build
+## with the size, mtime and sha1 of each input file and a fingerprint of the
+## config sections the output depends on.
+
+## outputs and inputs are lists of paths, sections is a list of config keys
+## tasks writing outputs of several stages at once may use a list of these
+Dependencies = namedtuple('Dependencies', ['outputs', 'inputs', 'sections'])
+
+STATE_FOLDER = '.anipose'
+
+## files larger than this (usually videos) are compared by size and mtime only
+HASH_MAX_SIZE = 256 * 2**20
+
+
+def get_state_folder(config):
+    return os.path.join(config['path'], STATE_FOLDER)
+
+
+def hash_file(fname, blocksize=2**20):
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def config_fingerprint(config, sections):
+    d = dict([(sec, config.get(sec)) for sec in sorted(sections)])
+    text = json.dumps(d, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode('utf8')).hexdigest()
+
+
+def file_state(fname, old=None):
+    """Returns the size, mtime and hash of a file.
+    The hash is only recomputed if the size or mtime differ from old."""
+    st = os.stat(fname)
+    if old is not None and old['size'] == st.st_size \
+       and old['mtime_ns'] == st.st_mtime_ns:
+        return old
+    if st.st_size > HASH_MAX_SIZE:
+        sha1 = None
+    else:
+        sha1 = hash_file(fname)
+    return {
+        'size': st.st_size,
+        'mtime_ns': st.st_mtime_ns,
+        'sha1': sha1
+    }
+
+
+def record_fname(config, output):
+    relpath = os.path.relpath(os.path.abspath(output), config['path'])
+    key = hashlib.sha1(relpath.encode('utf8')).hexdigest()
+    return os.path.join(get_state_folder(config), 'build', key[:2], key + '.json')
+
+
+def load_record(config, output):
+    fname = record_fname(config, output)
+    if not os.path.exists(fname):
+        return None
+    try:
+        with open(fname, 'r') as f:
+            return json.load(f)
+    except ValueError: # partially written or corrupt record
+        return None
+
+
+def write_record(config, output, record):
+    fname = record_fname(config, output)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmp_fname, 'w') as f:
+        json.dump(record, f, indent=1)
+    os.replace(tmp_fname, fname)
+
+
+def make_record(config, inputs, sections, old=None):
+    old_inputs = dict()
+    if old is not None:
+        old_inputs = old.get('inputs', dict())
+    states = dict()
+    for fname in inputs:
+        fname = os.path.abspath(fname)
+        states[fname] = file_state(fname, old_inputs.get(fname))
+    return {
+        'inputs': states,
+        'sections': sorted(sections),
+        'fingerprint': config_fingerprint(config, sections)
+    }
+
+
+def inputs_changed(record, inputs):
+    old_inputs = record['inputs']
+    inputs = [os.path.abspath(f) for f in inputs]
+    if set(old_inputs.keys()) != set(inputs):
+        return True
+    for fname in inputs:
+        old = old_inputs[fname]
+        if not os.path.exists(fname):
+            return True
+        new = file_state(fname, old)
+        if new is old:
+            continue
+        if new['sha1'] is None or new['sha1'] != old['sha1']:
+            return True
+    return False
+
+
+def inputs_older(deps):
+    """Whether all the inputs exist and were modified before all the outputs,
+    for outputs without a record, which may be older than their inputs"""
+    if not all([os.path.exists(f) for f in deps.inputs]):
+        return False
+    if len(deps.inputs) == 0:
+        return True
+    newest_input = max([os.stat(f).st_mtime_ns for f in deps.inputs])
+    oldest_output = min([os.stat(f).st_mtime_ns for f in deps.outputs])
+    return newest_input <= oldest_output
+
+
+def is_up_to_date(config, deps, legacy=None):
+    """Checks whether all the outputs in deps exist and were computed from
+    the current inputs and config.
+
+    Outputs from before anipose kept track of dependencies have no record.
+    These are considered up to date if all the inputs are older than the
+    outputs and legacy() returns True (or legacy is None), and a record is
+    created for them from the current inputs."""
+    if isinstance(deps, list):
+        return all([is_up_to_date(config, d, legacy) for d in deps])
+
+    if not all([os.path.exists(f) for f in deps.outputs]):
+        return False
+
+    records = [load_record(config, f) for f in deps.outputs]
+
+    if any([r is None for r in records]):
+        if not inputs_older(deps):
+            return False
+        if legacy is not None and not legacy():
+            return False
+        record_build(config, deps)
+        return True
+
+    fingerprint = config_fingerprint(config, deps.sections)
+    for record in records:
+        if record['fingerprint'] != fingerprint:
+            return False
+        if inputs_changed(record, deps.inputs):
+            return False
+
+    return True
+
+
+def record_build(config, deps):
+    """Records the current inputs and config of freshly computed outputs"""
+    if deps is None:
+        return
+    if isinstance(deps, list):
+        for d in deps:
+            record_build(config, d)
+        return
+    old = load_record(config, deps.outputs[0]) if len(deps.outputs) > 0 else None
+    record = make_record(config, deps.inputs, deps.sections, old)
+    for output in deps.outputs:
+        if os.path.exists(output):
+            write_record(config, output, record)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+## Batched triangulation by direct linear transform (DLT).
+## This solves the same systems as CameraGroup.triangulate from aniposelib,
+## but all at once with numpy instead of point by point. Points are grouped
+## by the set of cameras in which they are visible, and the systems of each
+## group, which all have the same size, are solved with a single stacked SVD.
+## Selected with engine = "batched" in the [triangulation] section.
+##
+## RANSAC triangulation is batched the same way: the subsets of cameras are
+## enumerated once, in the order CameraGroup.triangulate_ransac tries them,
+## and each subset is triangulated and scored for all the points that are
+## visible in it and not yet resolved. As in aniposelib, a point takes the
+## first subset with a reprojection error below the threshold, or else the
+## subset with the lowest error.
+##
+## The "weighted" engine solves the same systems with the two equations of
+## each camera multiplied by the score of its detection, so that cameras with
+## uncertain detections pull less on the point than confident ones. This is a
+## weighted least squares DLT, at the same cost as the batched one.
+
+TRIANGULATION_ENGINES = ['aniposelib', 'batched', 'weighted']
+
+## maximum number of points solved in one stacked SVD, to bound memory
+BATCH_SIZE = 100000
+
+
+def get_triangulation_engine(config):
+    engine = config['triangulation']['engine']
+    if engine not in TRIANGULATION_ENGINES:
+        raise ValueError('triangulation.engine should be one of {}, got "{}"'.format(
+            TRIANGULATION_ENGINES, engine))
+    return engine
+
+
+def undistort_points(cgroup, points):
+    """Undistorts a CxNx2 array of points with the cameras of cgroup,
+    leaving missing points as nan"""
+    out = np.full(points.shape, np.nan, dtype='float64')
+    for cnum, cam in enumerate(cgroup.cameras):
+        good = ~np.isnan(points[cnum, :, 0])
+        if np.any(good):
+            sub = np.array(points[cnum, good], dtype='float64')
+            out[cnum, good] = cam.undistort_points(sub)
+    return out
+
+
+def visibility_groups(good):
+    """Groups points by the cameras in which they are visible, from a CxN
+    boolean array. Yields (camera indices, point indices) for each group."""
+    n_cams = good.shape[0]
+    codes = np.zeros(good.shape[1], dtype='int64')
+    for cnum in range(n_cams):
+        codes |= good[cnum].astype('int64') << cnum
+    order = np.argsort(codes, kind='stable')
+    uniq, starts = np.unique(codes[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    for code, start, end in zip(uniq, starts, ends):
+        cams = np.array([c for c in range(n_cams) if (code >> c) & 1], dtype='int64')
+        yield cams, order[start:end]
+
+
+def triangulate_group(points, cam_mats, weights=None):
+    """Triangulates KxNx2 undistorted points, all visible in the K cameras
+    with extrinsics matrices cam_mats (Kx4x4). Returns an Nx3 array.
+    weights (KxN) scales the equations of each camera for each point."""
+    n_cams, n_points, _ = points.shape
+    ## for each camera, the rows x*P[2] - P[0] and y*P[2] - P[1]
+    A = points[:, :, :, None] * cam_mats[:, None, 2:3, :] - cam_mats[:, None, 0:2, :]
+    if weights is not None:
+        A = A * weights[:, :, None, None]
+    A = A.transpose(1, 0, 2, 3).reshape(n_points, n_cams*2, 4)
+    _, _, vh = np.linalg.svd(A, full_matrices=True)
+    p3d = vh[:, -1]
+    return p3d[:, :3] / p3d[:, 3:]
+
+
+def triangulate_batched(cgroup, points, undistort=True, scores=None):
+    """Given a CxNx2 array, this returns an Nx3 array of points,
+    the same as cgroup.triangulate(points). With scores (a CxN array),
+    the equations of each camera are weighted by its score, and points
+    with a score of 0 are left out."""
+    assert points.shape[0] == len(cgroup.cameras), \
+        "Invalid points shape, first dim should be equal to" \
+        " number of cameras ({}), but shape is {}".format(
+            len(cgroup.cameras), points.shape)
+
+    if undistort:
+        points = undistort_points(cgroup, points)
+
+    n_points = points.shape[1]
+    cam_mats = np.array([cam.get_extrinsics_mat() for cam in cgroup.cameras],
+                        dtype='float64')
+    good = ~np.isnan(points[:, :, 0])
+    if scores is not None:
+        scores = np.asarray(scores, dtype='float64')
+        good &= scores > 0
+
+    out = np.full((n_points, 3), np.nan, dtype='float64')
+    for cams, ixs in visibility_groups(good):
+        if len(cams) < 2:
+            continue
+        for start in range(0, len(ixs), BATCH_SIZE):
+            sub = ixs[start:start+BATCH_SIZE]
+            weights = None
+            if scores is not None:
+                weights = scores[cams][:, sub]
+            out[sub] = triangulate_group(points[cams][:, sub], cam_mats[cams], weights)
+    return out
+
+
+def camera_subsets(n_cams):
+    """Subsets of at least 2 of n_cams cameras, in the order in which
+    CameraGroup.triangulate_ransac tries them (all cameras first)"""
+    subsets = []
+    for code in range(2**n_cams - 1, 0, -1):
+        cams = [c for c in range(n_cams) if (code >> (n_cams - 1 - c)) & 1]
+        if len(cams) >= 2:
+            subsets.append(np.array(cams, dtype='int64'))
+    return subsets
+
+
+def mean_reprojection_error(cgroup, cams, p3ds, p2ds):
+    """Mean reprojection error of Nx3 points in the cameras cams,
+    given their KxNx2 (distorted) 2d points"""
+    n_points = p3ds.shape[0]
+    norms = np.empty((len(cams), n_points), dtype='float64')
+    for i, cnum in enumerate(cams):
+        proj = cgroup.cameras[cnum].project(p3ds).reshape(n_points, 2)
+        norms[i] = np.linalg.norm(p2ds[i] - proj, axis=1)
+    good = ~np.isnan(norms)
+    norms[~good] = 0
+    denom = np.sum(good, axis=0).astype('float64')
+    denom[denom < 1.5] = np.nan
+    return np.sum(norms, axis=0) / denom
+
+
+def triangulate_ransac_batched(cgroup, points, min_cams=2, threshold=0.5,
+                               undistort=True, points_und=None):
+    """Given a CxNx2 array, this returns the same as
+    cgroup.triangulate_ransac(points, min_cams=min_cams): an Nx3 array of
+    points, a CxNx1 array of the picked cameras of each point, a CxNx2 array
+    of the 2d points used and an array of length N of errors.
+    points_und may be the points already undistorted."""
+    assert points.shape[0] == len(cgroup.cameras), \
+        "Invalid points shape, first dim should be equal to" \
+        " number of cameras ({}), but shape is {}".format(
+            len(cgroup.cameras), points.shape)
+
+    n_cams, n_points, _ = points.shape
+    points = np.asarray(points, dtype='float64')
+    if points_und is not None:
+        points_und = np.asarray(points_und, dtype='float64')
+    elif undistort:
+        points_und = undistort_points(cgroup, points)
+    else:
+        points_und = points
+    cam_mats = np.array([cam.get_extrinsics_mat() for cam in cgroup.cameras],
+                        dtype='float64')
+
+    good = ~np.isnan(points[:, :, 0])
+    n_visible = np.sum(good, axis=0)
+
+    best_error = np.full(n_points, 200, dtype='float64')
+    best_subset = np.full(n_points, -1, dtype='int64')
+    out = np.full((n_points, 3), np.nan, dtype='float64')
+    done = np.zeros(n_points, dtype='bool')
+
+    subsets = camera_subsets(n_cams)
+    for six, cams in enumerate(subsets):
+        check = ~done & np.all(good[cams], axis=0)
+        if len(cams) < min_cams:
+            check &= n_visible == len(cams)
+        ixs = np.where(check)[0]
+        for start in range(0, len(ixs), BATCH_SIZE):
+            sub = ixs[start:start+BATCH_SIZE]
+            p3ds = triangulate_group(points_und[cams][:, sub], cam_mats[cams])
+            errors = mean_reprojection_error(cgroup, cams, p3ds, points[cams][:, sub])
+            better = errors < best_error[sub]
+            sub, p3ds, errors = sub[better], p3ds[better], errors[better]
+            best_error[sub] = errors
+            best_subset[sub] = six
+            out[sub] = p3ds
+            done[sub[errors < threshold]] = True
+
+    picked_vals = np.zeros((n_cams, n_points, 1), dtype='bool')
+    errors = np.zeros(n_points, dtype='float64')
+    points_2d = np.full((n_cams, n_points, 2), np.nan, dtype='float64')
+    for six, cams in enumerate(subsets):
+        ixs = np.where(best_subset == six)[0]
+        if len(ixs) == 0:
+            continue
+        picked_vals[cams[:, None], ixs, 0] = True
+        points_2d[cams[:, None], ixs] = points[cams[:, None], ixs]
+        errors[ixs] = best_error[ixs]
+
+    return out, picked_vals, points_2d, errors
@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import numpy as np
-from glob import glob
 import pandas as pd
 import os.path
 import cv2
@@ -13,12 +12,15 @@ import threading
 from datetime import datetime
 from ruamel.yaml import YAML
 
-from aniposelib.cameras import CameraGroup
-
 from .common import make_process_fun, process_all, get_nframes, \
     get_video_name, get_cam_name, \
     get_video_params, get_video_params_cap, \
-    get_data_length, natural_keys, true_basename, find_calibration_folder
+    get_data_length, natural_keys, true_basename, find_calibration_folder, \
+    load_camera_group
+from .manifest import find_files
+from .pose_io import read_pose_3d, pose_3d_fname, read_pose_3d_transform
+from .pose_store import open_pose2d_store, read_pose3d_range
+from .video_info import probe_videos
 
 from .triangulate import load_pose2d_fnames, load_offsets_dict
 
@@ -46,17 +48,16 @@ def get_video_params_cap(cap):
     return params
 
 
-def get_projected_points(bodyparts, pose_fname, cgroup, offsets_dict=None):
-    pose_data = pd.read_csv(pose_fname)
+def get_projected_points(bodyparts, pose_fname, cgroup, offsets_dict=None,
+                         frames=None, config=None):
+    if frames is None:
+        pose_data = read_pose_3d(pose_fname)
+    else:
+        pose_data = read_pose3d_range(config, pose_fname, frames[0], frames[1])
     cols = [x for x in pose_data.columns if '_error' in x]
 
 
-    M = np.identity(3)
-    center = np.zeros(3)
-    for i in range(3):
-        center[i] = np.mean(pose_data['center_{}'.format(i)])
-        for j in range(3):
-            M[i, j] = np.mean(pose_data['M_{}{}'.format(i, j)])
+    M, center = read_pose_3d_transform(pose_fname)
 
     bp_dict = dict(zip(bodyparts, range(len(bodyparts))))
 
@@ -89,17 +90,31 @@ def get_projected_points(bodyparts, pose_fname, cgroup, offsets_dict=None):
 
 def get_pose2d_fnames(config, session_path):
     pipeline_pose = config['pipeline']['pose_2d']
-    fnames = glob(os.path.join(session_path, pipeline_pose, '*.h5'))
+    fnames = find_files(config, os.path.join(session_path, pipeline_pose), 'h5')
     return session_path, fnames
 
 def get_videos_fnames(config, session_path):
     pipeline_raw = config['pipeline']['videos_raw']
     ext = config['video_extension']
-    fnames = glob(os.path.join(session_path, pipeline_raw, '*.' + ext))
+    fnames = find_files(config, os.path.join(session_path, pipeline_raw), ext)
     return session_path, fnames
 
 
+def read_trial_frames(config, trial, start, end):
+    """Tracked points, scores and projections of the 3d points
+    for frames start to end of a trial from load_2d_data"""
+    frames = (start, end)
+    out = load_pose2d_fnames(trial['fname_dict'], frames=frames, config=config)
+    proj = get_projected_points(trial['bodyparts'], trial['pose_fname'],
+                                trial['cgroup'], trial['offsets_dict'],
+                                frames=frames, config=config)
+    return out['points'], out['scores'], proj
+
+
 def load_2d_data(config):
+    """Finds the trials with both 2d and 3d pose, and computes the mean
+    reprojection error of each frame. The pose is read in chunks of frames from
+    the pose store, so that long recordings are never loaded whole."""
     pose_fnames = process_all(config, get_pose2d_fnames)
     cam_videos = defaultdict(list)
 
@@ -112,9 +127,8 @@ def load_2d_data(config):
 
     vid_names = sorted(cam_videos.keys())
 
-    all_points = []
-    all_scores = []
-    all_proj = []
+    trials = []
+    all_errors = []
     all_fnames = []
     calib_fnames = []
 
@@ -132,10 +146,10 @@ def load_2d_data(config):
                                        config['pipeline']['calibration_results'],
                                        'calibration.toml')
             if os.path.exists(calib_fname):
-                cgroup = CameraGroup.load(calib_fname)
+                cgroup = load_camera_group(calib_fname)
 
-        pose_fname = os.path.join(session_path, config['pipeline']['pose_3d'],
-                                  vidname+'.csv')
+        pose_fname = pose_3d_fname(
+            config, os.path.join(session_path, config['pipeline']['pose_3d']), vidname)
 
         if cgroup is None or not os.path.exists(pose_fname):
             continue
@@ -144,29 +158,37 @@ def load_2d_data(config):
 
         video_folder = os.path.join(session_path, config['pipeline']['videos_raw'])
         offsets_dict = load_offsets_dict(config, cam_names, video_folder)
-        out = load_pose2d_fnames(fname_dict)
-        points_raw = out['points']
-        scores = out['scores']
-        bodyparts = out['bodyparts']
+        store = open_pose2d_store(config, fname_dict)
+        bodyparts = store.meta['bodyparts']
 
         vid_fnames = [os.path.join(session_path,
                                    config['pipeline']['videos_raw'],
                                    true_basename(f) + '.' + config['video_extension'])
                       for f in fnames]
 
-        points_proj = get_projected_points(
-            bodyparts, pose_fname, cgroup, offsets_dict)
-
-        all_points.append(points_raw)
-        all_scores.append(scores)
-        all_proj.append(points_proj)
+        trial = {
+            'fname_dict': fname_dict,
+            'pose_fname': pose_fname,
+            'cgroup': cgroup,
+            'offsets_dict': offsets_dict,
+            'bodyparts': bodyparts
+        }
+
+        errors = []
+        for start in range(0, len(store), store.chunk_frames):
+            points, scores, proj = read_trial_frames(
+                config, trial, start, start + store.chunk_frames)
+            errors_cur = np.linalg.norm(proj - points, axis=3)
+            errors.append(np.mean(np.mean(errors_cur, axis=2), axis=0))
+
+        trials.append(trial)
+        all_errors.append(np.hstack(errors) if len(errors) > 0 else np.zeros(0))
         all_fnames.append(vid_fnames)
 
 
     out = {
-        'points': all_points,
-        'scores': all_scores,
-        'proj': all_proj,
+        'trials': trials,
+        'errors': all_errors,
         'fnames': all_fnames,
         'cam_names': cam_names,
         'calib_fnames': calib_fnames,
@@ -202,7 +224,7 @@ def get_all_videos_fnames(config):
                                        config['pipeline']['calibration_results'],
                                        'calibration.toml')
             if os.path.exists(calib_fname):
-                cgroup = CameraGroup.load(calib_fname)
+                cgroup = load_camera_group(calib_fname)
 
         # pose_fname = os.path.join(session_path, config['pipeline']['pose_3d'],
         #                           vidname+'.csv')
@@ -246,6 +268,8 @@ def extract_frames_random(config, num_frames_pick=250):
     vidnums = []
     framenums = []
 
+    probe_videos([fname for fnames in all_fnames for fname in fnames])
+
     for vnum, fnames in enumerate(all_fnames):
         num_frames = np.inf
         for fname in fnames:
@@ -371,9 +395,7 @@ def extract_frames_picked(config, mode='bad', num_frames_pick=250):
     d = load_2d_data(config)
 
     print('getting {} frames...'.format(mode))
-    points = d['points']
-    proj = d['proj']
-    scores = d['scores']
+    trials = d['trials']
     fnames = d['fnames']
     cam_names = d['cam_names']
     calib_fnames = d['calib_fnames']
@@ -389,9 +411,9 @@ def extract_frames_picked(config, mode='bad', num_frames_pick=250):
     with open(dlc_config_fname, 'r') as f:
         dlc_config = yaml.load(f)
 
-    nums = [p.shape[1] for p in points]
+    nums = [len(e) for e in d['errors']]
     num_total = np.sum(nums)
-    n_cams = proj[0].shape[0]
+    n_cams = len(trials[0]['cgroup'].cameras)
 
     vidnums = np.zeros(num_total, dtype='int64')
     framenums = np.zeros(num_total, dtype='int64')
@@ -402,12 +424,9 @@ def extract_frames_picked(config, mode='bad', num_frames_pick=250):
         a = start
         b = start + num_frames
 
-        errors_cur = np.linalg.norm(proj[vnum] - points[vnum], axis=3)
-        errors_mean = np.mean(np.mean(errors_cur, axis=2), axis=0)
-
         vidnums[a:b] = vnum
         framenums[a:b] = np.arange(num_frames)
-        errors[a:b] = errors_mean
+        errors[a:b] = d['errors'][vnum]
         start += num_frames
 
     good = np.isfinite(errors)
@@ -509,8 +528,9 @@ def extract_frames_picked(config, mode='bad', num_frames_pick=250):
         if not ret:
             continue
 
-        pred = proj[vidnum][:, framenum]
-        sc = scores[vidnum][:, framenum]
+        _, sc, pred = read_trial_frames(config, trials[vidnum], framenum, framenum+1)
+        pred = pred[:, 0]
+        sc = sc[:, 0]
         pred[sc < 0.3] = np.nan
 
         for cnum in range(n_cams):
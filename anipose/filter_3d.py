@@ -5,11 +5,13 @@ import os.path, os
 import numpy as np
 import pandas as pd
 from numpy import array as arr
-from glob import glob
 from scipy import signal
 from scipy.interpolate import splev, splrep
 
 from .common import make_process_fun, natural_keys
+from .pose_io import read_pose_3d, write_pose_3d, find_pose_3d, pose_3d_fname
+from .scheduler import Task
+from .dependencies import Dependencies, is_up_to_date
 
 def medfilt_data(values, size=15):
     padsize = size+5
@@ -30,8 +32,9 @@ def interpolate_data(vals):
     out[nans] = np.interp(ix(nans), ix(~nans), vals[~nans])
     return out
 
-def filter_pose(config, fname, outname):
-    data = pd.read_csv(fname)
+def filter_pose_3d_data(config, data):
+    """Filters a table of 3d points in the pose-3d format, returns a new table"""
+    data = data.copy()
 
     cols = [x for x in data.columns if '_error' in x]
     bodyparts = [c.replace('_error', '') for c in cols]
@@ -49,8 +52,14 @@ def filter_pose(config, fname, outname):
             values_filt = medfilt_data(values_intp, size=17)
             data[key] = values_filt
         data[bp+'_error'] = 10 # FIXME: hack for plotting
-        
-    data.to_csv(outname, index=False)
+
+    return data
+
+
+def filter_pose(config, fname, outname):
+    data = read_pose_3d(fname)
+    data = filter_pose_3d_data(config, data)
+    write_pose_3d(data, outname)
 
 
 def process_session(config, session_path):
@@ -60,23 +69,22 @@ def process_session(config, session_path):
     pose_folder = os.path.join(session_path, pipeline_pose)
     output_folder = os.path.join(session_path, pipeline_pose_filter)
 
-    pose_files = glob(os.path.join(pose_folder, '*.csv'))
+    pose_files = find_pose_3d(config, pose_folder)
     pose_files = sorted(pose_files, key=natural_keys)
 
     if len(pose_files) > 0:
         os.makedirs(output_folder, exist_ok=True)
 
     for fname in pose_files:
-        basename = os.path.basename(fname)
-        outpath = os.path.join(session_path,
-                               pipeline_pose_filter,
-                               basename)
+        basename = os.path.splitext(os.path.basename(fname))[0]
+        outpath = pose_3d_fname(config, output_folder, basename)
 
-        if os.path.exists(outpath):
+        deps = Dependencies([outpath], [fname], ['filter3d'])
+        if is_up_to_date(config, deps):
             continue
 
         print(outpath)
-        filter_pose(config, fname, outpath)
+        yield Task(outpath, filter_pose, (config, fname, outpath), deps)
 
 
 filter_pose_3d_all = make_process_fun(process_session)
@@ -5,8 +5,7 @@ import os.path, os
 import numpy as np
 import pandas as pd
 from numpy import array as arr
-from glob import glob
-from scipy import signal, stats
+from scipy import signal, stats, special
 from scipy.interpolate import splev, splrep
 from scipy.spatial.distance import cdist
 from scipy.spatial import cKDTree
@@ -17,6 +16,12 @@ from multiprocessing import Pool, get_context
 import pickle
 
 from .common import make_process_fun, natural_keys
+from .manifest import find_files
+from .atomic import atomic_output
+from .pose_io import write_pose_meta, get_pose_2d_format
+from .profiling import span, file_size
+from .scheduler import Task
+from .dependencies import Dependencies, is_up_to_date
 
 
 def nan_helper(y):
@@ -25,12 +30,15 @@ def nan_helper(y):
 
 def remove_dups(pts, thres=7):
     tindex = np.repeat(np.arange(pts.shape[0])[:, None], pts.shape[1], axis=1)*100
-    pts_ix = np.dstack([pts, tindex])
-    tree = cKDTree(pts_ix.reshape(-1, 3))
+    pts_ix = np.dstack([pts, tindex]).reshape(-1, 3)
+
+    # recent scipy versions refuse nans in the tree
+    good = np.where(np.all(np.isfinite(pts_ix), axis=1))[0]
+    tree = cKDTree(pts_ix[good])
 
     shape = (pts.shape[0], pts.shape[1])
     pairs = tree.query_pairs(thres)
-    indices = [b for a, b in pairs]
+    indices = [good[b] for a, b in pairs]
 
     if len(pairs) == 0:
         return pts
@@ -41,64 +49,107 @@ def remove_dups(pts, thres=7):
 
     return pts_out
 
-def viterbi_path(points, scores, n_back=3, thres_dist=30):
+## maximum number of transition probabilities computed at once by viterbi_path
+VITERBI_BLOCK_SIZE = 2**18
+
+
+def viterbi_particles(points, scores, n_back=3):
+    """Candidate positions of each frame for viterbi_path: the points of
+    the frame and of the n_back-1 previous ones, with their scores halved
+    for each frame back. Returns an array of shape (frames, particles, 3)
+    with x, y, score and the number of valid particles of each frame."""
     n_frames = points.shape[0]
 
     points_nans = remove_dups(points, thres=5)
     # points_nans[scores < 0.01] = np.nan
 
-    num_points = np.sum(~np.isnan(points_nans[:, :, 0]), axis=1)
+    good = ~np.isnan(points_nans[:, :, 0])
+    num_points = np.sum(good, axis=1)
     num_max = np.max(num_points)
 
+    ## the valid points of each frame first, in their order
+    order = np.argsort(~good, axis=1, kind='stable')[:, :num_max]
+    points_valid = np.take_along_axis(points, order[:, :, None], axis=1)
+    scores_valid = np.take_along_axis(scores, order, axis=1)
+
     particles = np.zeros((n_frames, num_max * n_back + 1, 3), dtype='float64')
     valid = np.zeros(n_frames, dtype='int64')
-    for i in range(n_frames):
-        s = 0
-        for j in range(n_back):
-            if i-j < 0:
-                break
-            ixs = np.where(~np.isnan(points_nans[i-j, :, 0]))[0]
-            n_valid = len(ixs)
-            particles[i, s:s+n_valid, :2] = points[i-j, ixs]
-            particles[i, s:s+n_valid, 2] = scores[i-j, ixs] * np.power(2.0, -j)
-            s += n_valid
-        if s == 0:
-            particles[i, 0] = [-1, -1, 0.001] # missing point
-            s = 1
-        valid[i] = s
+    slots = np.arange(num_max)
+    for j in range(min(n_back, n_frames)):
+        frames = np.arange(j, n_frames)
+        n_valid = num_points[frames - j]
+        check = slots[None, :] < n_valid[:, None]
+        fixs = np.broadcast_to(frames[:, None], check.shape)[check]
+        pixs = (valid[frames][:, None] + slots[None, :])[check]
+        particles[fixs, pixs, :2] = points_valid[frames - j][check]
+        particles[fixs, pixs, 2] = scores_valid[frames - j][check] * np.power(2.0, -j)
+        valid[frames] += n_valid
+
+    missing = valid == 0
+    particles[missing, 0] = [-1, -1, 0.001] # missing point
+    valid[missing] = 1
+
+    return particles, valid
+
+
+def transition_logprob(pa, pb, thres_dist):
+    """Log probabilities of moving from the particles pa (..., A, 2) to the
+    particles pb (..., B, 2), of shape (..., B, A)"""
+    diffs = pb[..., :, None, :] - pa[..., None, :, :]
+    dists = np.sqrt(np.sum(np.square(diffs), axis=-1))
+    cdf_high = stats.norm.logcdf(dists + 2, scale=thres_dist)
+    cdf_low = stats.norm.logcdf(dists - 2, scale=thres_dist)
+    cdfs = np.stack([cdf_high, cdf_low], axis=-1)
+    return logsumexp(cdfs, b=[1,-1], axis=-1)
+
+
+def viterbi_path(points, scores, n_back=3, thres_dist=30):
+    """Most likely path through the points (frames, possible, 2) with scores
+    (frames, possible), allowing jumps back to the points of the n_back-1
+    previous frames. Returns the points and scores of the path.
+    The transition probabilities are computed for blocks of frames at once,
+    so only the maximization over the previous frame runs frame by frame."""
+    n_frames = points.shape[0]
+
+    particles, valid = viterbi_particles(points, scores, n_back)
 
     ## viterbi algorithm
     n_particles = np.max(valid)
+    particles = particles[:, :n_particles]
+    positions = particles[:, :, :2]
+
+    is_valid = np.arange(n_particles)[None, :] < valid[:, None]
+    with np.errstate(divide='ignore'):
+        log_scores = np.log(particles[:, :, 2])
+    log_scores[~is_valid] = -np.inf
 
     T_logprob = np.zeros((n_frames, n_particles), dtype='float64')
     T_logprob[:] = -np.inf
     T_back = np.zeros((n_frames, n_particles), dtype='int64')
 
-    T_logprob[0, :valid[0]] = np.log(particles[0, :valid[0], 2])
+    T_logprob[0] = log_scores[0]
     T_back[0, :] = -1
 
-    for i in range(1, n_frames):
-        va, vb = valid[i-1], valid[i]
-        pa = particles[i-1, :va, :2]
-        pb = particles[i, :vb, :2]
-
-        dists = cdist(pa, pb)
-        cdf_high = stats.norm.logcdf(dists + 2, scale=thres_dist)
-        cdf_low = stats.norm.logcdf(dists - 2, scale=thres_dist)
-        cdfs = np.array([cdf_high, cdf_low])
-        P_trans = logsumexp(cdfs.T, b=[1,-1], axis=2)
+    block = max(VITERBI_BLOCK_SIZE // (n_particles * n_particles), 1)
+    for start in range(1, n_frames, block):
+        end = min(start + block, n_frames)
+        pa = positions[start-1:end-1]
+        pb = positions[start:end]
+        P_trans = transition_logprob(pa, pb, thres_dist)
 
         P_trans[P_trans < -100] = -100
 
         # take care of missing transitions
-        P_trans[pb[:, 0] == -1, :] = np.log(0.001)
-        P_trans[:, pa[:, 0] == -1] = np.log(0.001)
+        P_trans[pb[:, :, 0] == -1] = np.log(0.001)
+        missing_a = np.broadcast_to((pa[:, :, 0] == -1)[:, None, :], P_trans.shape)
+        P_trans[missing_a] = np.log(0.001)
 
-        pflat = particles[i, :vb, 2]
-        possible = T_logprob[i-1, :va] + P_trans
+        for i in range(start, end):
+            possible = T_logprob[i-1] + P_trans[i-start]
+            T_logprob[i] = np.max(possible, axis=1) + log_scores[i]
+            T_back[i] = np.argmax(possible, axis=1)
 
-        T_logprob[i, :vb] = np.max(possible, axis=1) + np.log(pflat)
-        T_back[i, :vb] = np.argmax(possible, axis=1)
+    T_back[1:][~is_valid[1:]] = 0
 
     out = np.zeros(n_frames, dtype='int')
     out[-1] = np.argmax(T_logprob[-1])
@@ -106,8 +157,7 @@ def viterbi_path(points, scores, n_back=3, thres_dist=30):
     for i in range(n_frames-1, 0, -1):
         out[i-1] = T_back[i, out[i]]
 
-    trace = [particles[i, out[i]] for i in range(n_frames)]
-    trace = np.array(trace)
+    trace = particles[np.arange(n_frames), out]
 
     points_new = trace[:, :2]
     scores_new = trace[:, 2]
@@ -116,14 +166,182 @@ def viterbi_path(points, scores, n_back=3, thres_dist=30):
     return points_new, scores_new
 
 
+## Streaming variant of viterbi_path, for long recordings and large n_back.
+## The frames are processed viterbi_chunk frames at a time, keeping only the
+## back pointers of the frames not decided yet. With a lag, a frame is decided
+## once lag more frames have been seen, by backtracking from the best state
+## at that point (fixed-lag smoothing); without, only at the end of the trial.
+## With a beam, only the beam most likely states are kept at each frame, so
+## the transitions computed at each frame grow with the number of particles
+## instead of its square. The transitions of the kept states are computed
+## frame by frame, as log(cdf(d+2) - cdf(d-2)) directly. This only differs
+## from transition_logprob for jumps of more than about 8 offset_threshold,
+## whose probability is negligible either way. With neither, the path is the
+## same as viterbi_path.
+
+VITERBI_CHUNK_FRAMES = 2000
+
+
+def transition_logprob_direct(pa, pb, thres_dist):
+    """Same as transition_logprob for particles pa (A, 2) and pb (B, 2),
+    with less overhead for small arrays"""
+    dists = np.sqrt(np.sum(np.square(pb[:, None, :] - pa[None, :, :]), axis=-1))
+    cdf_high = special.log_ndtr((dists + 2) / thres_dist)
+    cdf_low = special.log_ndtr((dists - 2) / thres_dist)
+    with np.errstate(divide='ignore'):
+        return cdf_high + np.log1p(-np.exp(cdf_low - cdf_high))
+
+
+def pad_particles(arr, width, value):
+    """Pads axis 1 of arr (the particles of each frame) to width with value"""
+    n = arr.shape[1]
+    if n >= width:
+        return arr
+    pad = [(0, 0)] * arr.ndim
+    pad[1] = (0, width - n)
+    return np.pad(arr, pad, constant_values=value)
+
+
+def viterbi_path_stream(points, scores, n_back=3, thres_dist=30, beam=0, lag=0,
+                        chunk_frames=VITERBI_CHUNK_FRAMES):
+    """Same as viterbi_path, with bounded memory (see above). Yields
+    (start, points_new, scores_new) for consecutive ranges of frames."""
+    n_frames = points.shape[0]
+    missing_logprob = np.log(0.001)
+
+    prev_pos = None
+    prev_logprob = None
+    pending_particles = []
+    pending_back = []
+    n_pending = 0
+    emit_start = 0
+
+    for c0 in range(0, n_frames, chunk_frames):
+        c1 = min(c0 + chunk_frames, n_frames)
+        h = min(n_back - 1, c0)
+        particles, valid = viterbi_particles(points[c0-h:c1], scores[c0-h:c1], n_back)
+        particles = particles[h:, :np.max(valid[h:])]
+        valid = valid[h:]
+        n_chunk, width = particles.shape[:2]
+        positions = particles[:, :, :2]
+
+        is_valid = np.arange(width)[None, :] < valid[:, None]
+        with np.errstate(divide='ignore'):
+            log_scores = np.log(particles[:, :, 2])
+        log_scores[~is_valid] = -np.inf
+
+        T_back = np.zeros((n_chunk, width), dtype='int64')
+        start = 0
+        if prev_pos is None:
+            prev_logprob = log_scores[0]
+            prev_pos = positions[0]
+            T_back[0] = -1
+            start = 1
+
+        if beam <= 0:
+            ## the same as viterbi_path, from the last frame of the previous chunk
+            width_all = max(width, len(prev_pos))
+            pos_all = np.concatenate([
+                pad_particles(prev_pos[None], width_all, 0),
+                pad_particles(positions, width_all, 0)])
+            logprob = pad_particles(prev_logprob[None], width_all, -np.inf)[0]
+            log_scores = pad_particles(log_scores, width_all, -np.inf)
+            T_back = pad_particles(T_back, width_all, 0)
+
+            block = max(VITERBI_BLOCK_SIZE // (width_all * width_all), 1)
+            for b0 in range(start, n_chunk, block):
+                b1 = min(b0 + block, n_chunk)
+                pa = pos_all[b0:b1]
+                pb = pos_all[b0+1:b1+1]
+                P_trans = transition_logprob(pa, pb, thres_dist)
+                P_trans[P_trans < -100] = -100
+                P_trans[pb[:, :, 0] == -1] = missing_logprob
+                missing_a = np.broadcast_to((pa[:, :, 0] == -1)[:, None, :], P_trans.shape)
+                P_trans[missing_a] = missing_logprob
+
+                for i in range(b0, b1):
+                    possible = logprob + P_trans[i-b0]
+                    T_back[i] = np.argmax(possible, axis=1)
+                    logprob = np.max(possible, axis=1) + log_scores[i]
+            T_back = T_back[:, :width]
+            T_back[start:][~is_valid[start:]] = 0
+            prev_logprob = logprob[:width]
+        else:
+            logprob = prev_logprob
+            pa_all = prev_pos
+            for i in range(start, n_chunk):
+                keep = np.argsort(-logprob, kind='stable')[:beam]
+                keep = keep[np.isfinite(logprob[keep])]
+                if len(keep) == 0:
+                    keep = np.array([0])
+                pa = pa_all[keep]
+                pb = positions[i, :valid[i]]
+                P_trans = transition_logprob_direct(pa, pb, thres_dist)
+                P_trans[P_trans < -100] = -100
+                P_trans[pb[:, 0] == -1] = missing_logprob
+                P_trans[:, pa[:, 0] == -1] = missing_logprob
+
+                possible = logprob[keep] + P_trans
+                best = np.argmax(possible, axis=1)
+                logprob = np.full(width, -np.inf)
+                logprob[:valid[i]] = possible[np.arange(valid[i]), best] + log_scores[i, :valid[i]]
+                T_back[i, :valid[i]] = keep[best]
+                pa_all = positions[i]
+            prev_logprob = logprob
+
+        prev_pos = positions[-1]
+        pending_particles.append(particles)
+        pending_back.append(T_back)
+        n_pending += n_chunk
+
+        ## decide the frames at least lag frames behind the last one
+        if c1 == n_frames:
+            n_decide = n_pending
+        elif lag > 0:
+            n_decide = n_pending - lag
+        else:
+            n_decide = 0
+        if n_decide <= 0:
+            continue
+
+        width_all = max([p.shape[1] for p in pending_particles])
+        all_particles = np.concatenate([pad_particles(p, width_all, 0)
+                                        for p in pending_particles])
+        all_back = np.concatenate([pad_particles(b, width_all, 0)
+                                   for b in pending_back])
+
+        out = np.zeros(n_pending, dtype='int64')
+        out[-1] = np.argmax(prev_logprob)
+        for i in range(n_pending-1, 0, -1):
+            out[i-1] = all_back[i, out[i]]
+
+        trace = all_particles[np.arange(n_decide), out[:n_decide]]
+        yield emit_start, trace[:, :2], trace[:, 2]
+
+        emit_start += n_decide
+        n_pending -= n_decide
+        pending_particles = [all_particles[n_decide:]]
+        pending_back = [all_back[n_decide:]]
+
+
 def viterbi_path_wrapper(args):
-    jix, pts, scs, max_offset, thres_dist = args
-    pts_new, scs_new = viterbi_path(pts, scs, max_offset, thres_dist)
+    jix, pts, scs, max_offset, thres_dist, beam, lag = args
+    if beam <= 0 and lag <= 0:
+        pts_new, scs_new = viterbi_path(pts, scs, max_offset, thres_dist)
+        return jix, pts_new, scs_new
+    n_frames = pts.shape[0]
+    pts_new = np.empty((n_frames, 2), dtype='float64')
+    scs_new = np.empty(n_frames, dtype='float64')
+    for start, pts_chunk, scs_chunk in viterbi_path_stream(
+            pts, scs, max_offset, thres_dist, beam, lag):
+        pts_new[start:start+len(pts_chunk)] = pts_chunk
+        scs_new[start:start+len(scs_chunk)] = scs_chunk
     return jix, pts_new, scs_new
 
 
 def load_pose_2d(fname):
-    data_orig = pd.read_hdf(fname)
+    with span('load_pose_2d', 'io', bytes=file_size(fname)):
+        data_orig = pd.read_hdf(fname)
     scorer = data_orig.columns.levels[0][0]
     data = data_orig.loc[:, scorer]
 
@@ -165,16 +383,19 @@ def filter_pose_viterbi(config, all_points, bodyparts):
 
     max_offset = config['filter']['n_back']
     thres_dist = config['filter']['offset_threshold']
+    beam = config['filter']['viterbi_beam']
+    lag = config['filter']['viterbi_lag']
 
     iterable = [ (jix, points_full[:, jix, :], scores_full[:, jix],
-                  max_offset, thres_dist)
+                  max_offset, thres_dist, beam, lag)
                  for jix in range(n_joints) ]
 
-    results = pool.imap_unordered(viterbi_path_wrapper, iterable)
+    with span('viterbi_path', 'compute', frames=n_frames*n_joints):
+        results = pool.imap_unordered(viterbi_path_wrapper, iterable)
 
-    for jix, pts_new, scs_new in tqdm(results, ncols=70):
-        points[:, jix] = pts_new
-        scores[:, jix] = scs_new
+        for jix, pts_new, scs_new in tqdm(results, ncols=70):
+            points[:, jix] = pts_new
+            scores[:, jix] = scs_new
 
     pool.close()
     pool.join()
@@ -182,10 +403,10 @@ def filter_pose_viterbi(config, all_points, bodyparts):
     return points, scores
 
 
-def write_pose_2d(all_points, metadata, outname=None):
-    points = all_points[:, :, :2]
-    scores = all_points[:, :, 2]
-
+def write_pose_2d(all_points, metadata, outname=None, format='fast'):
+    """Makes a DeepLabCut-style table from all_points of shape
+    (frames, bodyparts, 3), and writes it to outname if given,
+    in format 'fast' or 'dlc' (see pose_2d_format)."""
     scorer = metadata['scorer']
     bodyparts = metadata['bodyparts']
     index = metadata['index']
@@ -194,14 +415,17 @@ def write_pose_2d(all_points, metadata, outname=None):
         [[scorer], bodyparts, ['x', 'y', 'likelihood']],
         names=['scorer', 'bodyparts', 'coords'])
 
-    dout = pd.DataFrame(columns=columns, index=index)
-
-    dout.loc[:, (scorer, bodyparts, 'x')] = points[:, :, 0]
-    dout.loc[:, (scorer, bodyparts, 'y')] = points[:, :, 1]
-    dout.loc[:, (scorer, bodyparts, 'likelihood')] = scores
+    n_frames, n_joints = all_points.shape[:2]
+    values = np.asarray(all_points[:, :, :3], dtype='float64').reshape(n_frames, n_joints*3)
+    dout = pd.DataFrame(values, columns=columns, index=index, copy=True)
 
     if outname is not None:
-        dout.to_hdf(outname, 'df_with_missing', format='table', mode='w')
+        with span('write_pose_2d', 'io', frames=all_points.shape[0]) as info:
+            with atomic_output(outname) as tmp_fname:
+                dout.to_hdf(tmp_fname, key='df_with_missing', format='table', mode='w',
+                            index=(format == 'dlc'))
+            write_pose_meta(outname, all_points.shape[0], all_points.shape)
+            info['bytes'] = file_size(outname)
 
     return dout
 
@@ -348,9 +572,7 @@ FILTER_MAPPING = {
 
 POSSIBLE_FILTERS = FILTER_MAPPING.keys()
 
-def process_session(config, session_path):
-    pipeline_pose = config['pipeline']['pose_2d']
-    pipeline_pose_filter = config['pipeline']['pose_2d_filter']
+def get_filter_types(config):
     filter_types = config['filter']['type']
     if not isinstance(filter_types, list):
         filter_types = [filter_types]
@@ -359,10 +581,34 @@ def process_session(config, session_path):
         assert filter_type in POSSIBLE_FILTERS, \
             "Invalid filter type, should be one of {}, but found {}".format(POSSIBLE_FILTERS, filter_type)
 
+    return filter_types
+
+
+def filter_pose_data(config, all_points, bodyparts, filter_types):
+    """Applies the filters in filter_types in order to the output of load_pose_2d.
+    Returns an array of shape (n_frames, n_joints, 3) with x, y, score."""
+    for filter_type in filter_types:
+        filter_fun = FILTER_MAPPING[filter_type]
+        points, scores = filter_fun(config, all_points, bodyparts)
+        all_points = wrap_points(points, scores)
+    return all_points[:, :, 0]
+
+
+def filter_pose_file(config, fname, outpath, filter_types):
+    all_points, metadata = load_pose_2d(fname)
+    points = filter_pose_data(config, all_points, metadata['bodyparts'], filter_types)
+    write_pose_2d(points, metadata, outpath, get_pose_2d_format(config))
+
+
+def process_session(config, session_path):
+    pipeline_pose = config['pipeline']['pose_2d']
+    pipeline_pose_filter = config['pipeline']['pose_2d_filter']
+    filter_types = get_filter_types(config)
+
     pose_folder = os.path.join(session_path, pipeline_pose)
     output_folder = os.path.join(session_path, pipeline_pose_filter)
 
-    pose_files = glob(os.path.join(pose_folder, '*.h5'))
+    pose_files = find_files(config, pose_folder, 'h5')
     pose_files = sorted(pose_files, key=natural_keys)
 
     if len(pose_files) > 0:
@@ -374,18 +620,13 @@ def process_session(config, session_path):
                                pipeline_pose_filter,
                                basename)
 
-        if os.path.exists(outpath):
+        deps = Dependencies([outpath], [fname], ['filter'])
+        if is_up_to_date(config, deps):
             continue
 
         print(outpath)
-        all_points, metadata = load_pose_2d(fname)
-
-        for filter_type in filter_types:
-            filter_fun = FILTER_MAPPING[filter_type]
-            points, scores = filter_fun(config, all_points, metadata['bodyparts'])
-            all_points = wrap_points(points, scores)
-
-        write_pose_2d(all_points[:, :, 0], metadata, outpath)
+        yield Task(outpath, filter_pose_file,
+                   (config, fname, outpath, filter_types), deps)
 
 
 filter_pose_all = make_process_fun(process_session)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+from collections import defaultdict
+
+from .common import make_process_fun, find_calibration_folder, \
+    load_camera_group, get_video_name, get_cam_name, natural_keys
+from .manifest import find_files
+from .undistorted import get_undistorted
+from .pose_io import write_pose_csv, write_pose_3d, pose_3d_fname, \
+    as_stored_pose_3d, get_pose_2d_format
+from .checkpoint import checkpoint_key, remove_checkpoint
+from .scheduler import Task
+from .dependencies import Dependencies, is_up_to_date
+from .filter_pose import load_pose_2d, write_pose_2d, \
+    filter_pose_data, get_filter_types
+from .triangulate import load_pose2d_fnames, load_pose2d_dataframes, \
+    load_offsets_dict, triangulate_data, use_calibration_frame, \
+    get_calibration_frame, coordinate_frame_inputs
+from .filter_3d import filter_pose_3d_data
+from .compute_angles import compute_angles_data
+
+## Fused version of the filter -> triangulate -> filter-3d -> angles part of
+## run-data. Each trial is carried through all the stages in memory, without
+## writing and parsing the intermediate files in between. The outputs are the
+## same as running the stages one by one, and are recorded as such, so the
+## separate commands consider them up to date.
+## With final_only, the intermediate outputs (filtered 2d pose, and unfiltered
+## 3d pose if filter3d is enabled) are not written at all.
+
+
+def get_fused_outputs(config, session_path, name, fnames_2d, final_only):
+    """Returns a dict with the paths of the outputs of each stage for one trial,
+    or None for the outputs that should not be written"""
+    pipeline = config['pipeline']
+    filter3d = config['filter3d']['enabled']
+    outputs = dict()
+
+    if config['filter']['enabled'] and not final_only:
+        outputs['pose_2d_filter'] = [
+            os.path.join(session_path, pipeline['pose_2d_filter'], os.path.basename(f))
+            for f in fnames_2d]
+    else:
+        outputs['pose_2d_filter'] = None
+
+    if filter3d and final_only:
+        outputs['pose_3d'] = None
+    else:
+        outputs['pose_3d'] = pose_3d_fname(
+            config, os.path.join(session_path, pipeline['pose_3d']), name)
+
+    if filter3d:
+        outputs['pose_3d_filter'] = pose_3d_fname(
+            config, os.path.join(session_path, pipeline['pose_3d_filter']), name)
+    else:
+        outputs['pose_3d_filter'] = None
+
+    if 'angles' in config:
+        outputs['angles'] = os.path.join(session_path, pipeline['angles'], name + '.csv')
+    else:
+        outputs['angles'] = None
+
+    return outputs
+
+
+def get_fused_dependencies(config, fnames_2d, calib_fname, outputs):
+    """Dependencies of each output. These match the ones of the separate
+    stages whenever the input of the stage is written too."""
+    deps = []
+
+    if outputs['pose_2d_filter'] is not None:
+        for fname, outname in zip(fnames_2d, outputs['pose_2d_filter']):
+            deps.append(Dependencies([outname], [fname], ['filter']))
+        inputs = list(outputs['pose_2d_filter'])
+        sections = []
+    else:
+        # 2d filtering (if any) happens in memory, from the raw 2d pose
+        inputs = list(fnames_2d)
+        sections = ['filter'] if config['filter']['enabled'] else []
+
+    inputs = inputs + [calib_fname] + \
+        coordinate_frame_inputs(config, os.path.dirname(calib_fname))
+    sections += ['triangulation', 'cameras']
+
+    chain = [('pose_3d', []), ('pose_3d_filter', ['filter3d']), ('angles', ['angles'])]
+    for key, stage_sections in chain:
+        sections = sections + stage_sections
+        outname = outputs[key]
+        if outname is None:
+            continue
+        deps.append(Dependencies([outname], inputs, sorted(set(sections))))
+        if key != 'angles':
+            inputs = [outname]
+            sections = []
+
+    return deps
+
+
+def run_trial_fused(config, cgroup, fname_dict, offsets_dict, outputs, calib_fname,
+                    frame=None):
+    cam_names = sorted(fname_dict.keys())
+
+    checkpoint = None
+    if config['triangulation']['optim']:
+        ckpt_outname = outputs['pose_3d'] or outputs['pose_3d_filter']
+        key = checkpoint_key(config, list(fname_dict.values()) + [calib_fname],
+                             ['filter', 'triangulation', 'cameras'])
+        checkpoint = (ckpt_outname, key)
+
+    if config['filter']['enabled']:
+        filter_types = get_filter_types(config)
+        dlabs_dict = dict()
+        for cix, cname in enumerate(cam_names):
+            all_points, metadata = load_pose_2d(fname_dict[cname])
+            points = filter_pose_data(config, all_points, metadata['bodyparts'],
+                                      filter_types)
+            outname = None
+            if outputs['pose_2d_filter'] is not None:
+                outname = outputs['pose_2d_filter'][cix]
+            dlabs_dict[cname] = write_pose_2d(points, metadata, outname,
+                                              get_pose_2d_format(config))
+        pose_2d = load_pose2d_dataframes(dlabs_dict, offsets_dict, cam_names)
+    else:
+        pose_2d = load_pose2d_fnames(fname_dict, offsets_dict, cam_names)
+        if config['triangulation']['undistort_cache']:
+            pose_2d['points_undistorted'] = get_undistorted(
+                cgroup, pose_2d, fname_dict, offsets_dict)
+
+    data = triangulate_data(config, cgroup, pose_2d, checkpoint, frame)
+    # the next stages get the data as they would read it back
+    if outputs['pose_3d'] is not None:
+        write_pose_3d(data, outputs['pose_3d'])
+        data = as_stored_pose_3d(data, outputs['pose_3d'])
+
+    if config['filter3d']['enabled']:
+        data = filter_pose_3d_data(config, data)
+        write_pose_3d(data, outputs['pose_3d_filter'])
+        data = as_stored_pose_3d(data, outputs['pose_3d_filter'])
+
+    if outputs['angles'] is not None:
+        dout = compute_angles_data(config, data)
+        write_pose_csv(dout, outputs['angles'])
+
+    if checkpoint is not None:
+        remove_checkpoint(checkpoint[0], 'optim')
+
+
+def process_session(config, session_path, final_only=False):
+    pipeline_videos_raw = config['pipeline']['videos_raw']
+    pipeline_pose = config['pipeline']['pose_2d']
+
+    calibration_path = find_calibration_folder(config, session_path)
+    if calibration_path is None:
+        return
+
+    calib_fname = os.path.join(calibration_path,
+                               config['pipeline']['calibration_results'],
+                               'calibration.toml')
+    if not os.path.exists(calib_fname):
+        print('session {}: no calibration found, skipping'.format(session_path))
+        return
+
+    pose_files = find_files(config, os.path.join(session_path, pipeline_pose), 'h5')
+
+    cam_videos = defaultdict(list)
+    for pf in pose_files:
+        name = get_video_name(config, pf)
+        cam_videos[name].append(pf)
+
+    vid_names = sorted(cam_videos.keys(), key=natural_keys)
+    if len(vid_names) == 0:
+        return
+
+    video_folder = os.path.join(session_path, pipeline_videos_raw)
+
+    frame = None
+    if use_calibration_frame(config):
+        # estimated from the raw 2d pose, as the filtered one is not written yet
+        frame = get_calibration_frame(config, os.path.dirname(calib_fname), 'pose_2d')
+
+    for name in vid_names:
+        fnames = cam_videos[name]
+        cam_names = [get_cam_name(config, f) for f in fnames]
+        fname_dict = dict(zip(cam_names, fnames))
+
+        outputs = get_fused_outputs(config, session_path, name, fnames, final_only)
+        deps = get_fused_dependencies(config, fnames, calib_fname, outputs)
+        if is_up_to_date(config, deps):
+            continue
+
+        for out in outputs.values():
+            if out is None:
+                continue
+            out_fnames = out if isinstance(out, list) else [out]
+            for fname in out_fnames:
+                os.makedirs(os.path.dirname(fname), exist_ok=True)
+
+        trial_path = os.path.join(session_path, name)
+        print(trial_path)
+
+        offsets_dict = load_offsets_dict(config, cam_names, video_folder)
+        cgroup_subset = load_camera_group(calib_fname, sorted(cam_names))
+
+        yield Task(trial_path, run_trial_fused,
+                   (config, cgroup_subset, fname_dict, offsets_dict, outputs,
+                    calib_fname, frame), deps)
+
+
+fused_all = make_process_fun(process_session, final_only=False)
+fused_final_all = make_process_fun(process_session, final_only=True)
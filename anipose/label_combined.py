@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import numpy as np
-from glob import glob
 import pandas as pd
 import os.path
 import cv2
@@ -11,26 +10,34 @@ from scipy import signal
 import queue
 import threading
 
-from aniposelib.cameras import CameraGroup
-
 from .common import make_process_fun, get_nframes, \
     get_video_name, get_cam_name, \
     get_video_params, get_video_params_cap, \
-    get_data_length, natural_keys, true_basename, find_calibration_folder
+    get_data_length, natural_keys, true_basename, find_calibration_folder, \
+    load_camera_group
+from .manifest import find_files
+from .pose_io import read_pose_3d, pose_3d_fname, read_pose_3d_transform
 
 from .triangulate import load_offsets_dict
 
 from .label_videos import label_frame
+from .scheduler import Task
+from .dependencies import Dependencies, is_up_to_date
+from .profiling import Accumulator
 
 def nan_helper(y):
     return np.isnan(y), lambda z: z.nonzero()[0]
 
-def write_frame_thread(writer, q):
+def write_frame_thread(writer, q, encode=None):
     while True:
         frame = q.get(block=True)
         if frame is None:
             return
-        writer.write(frame)
+        if encode is not None:
+            with encode:
+                writer.write(frame)
+        else:
+            writer.write(frame)
         # writer.writeFrame(frame)
 
 def turn_to_black(frame):
@@ -271,19 +278,14 @@ def get_projected_points(config, pose_fname, cgroup, offsets_dict):
     except KeyError:
         scheme = []
 
-    pose_data = pd.read_csv(pose_fname)
+    pose_data = read_pose_3d(pose_fname)
     cols = [x for x in pose_data.columns if '_error' in x]
     if len(scheme) == 0:
         bodyparts = [c.replace('_error', '') for c in cols]
     else:
         bodyparts = sorted(set([x for dx in scheme for x in dx]))
 
-    M = np.identity(3)
-    center = np.zeros(3)
-    for i in range(3):
-        center[i] = np.mean(pose_data['center_{}'.format(i)])
-        for j in range(3):
-            M[i, j] = np.mean(pose_data['M_{}{}'.format(i, j)])
+    M, center = read_pose_3d_transform(pose_fname)
 
     bp_dict = dict(zip(bodyparts, range(len(bodyparts))))
 
@@ -385,12 +387,16 @@ def visualize_combined(config, pose_fname, cgroup, offsets_dict,
 
     q = queue.Queue(maxsize=50)
 
+    decode = Accumulator('video_decode', fname=fname_3d)
+    encode = Accumulator('video_encode', fname=out_fname)
+
     thread = threading.Thread(target=write_frame_thread,
-                              args=(writer, q))
+                              args=(writer, q, encode))
     thread.start()
 
     for framenum in trange(nframes, ncols=70):
-        ret, frames_2d, frame_3d = read_frames(caps_2d, cap_3d)
+        with decode:
+            ret, frames_2d, frame_3d = read_frames(caps_2d, cap_3d)
         if not ret:
             break
 
@@ -415,6 +421,8 @@ def visualize_combined(config, pose_fname, cgroup, offsets_dict,
     q.put(None)
     thread.join()
     writer.release()
+    decode.close()
+    encode.close()
 
 def process_session(config, session_path):
     # filtered = config['filter']['enabled']
@@ -434,14 +442,14 @@ def process_session(config, session_path):
 
     video_ext = config['video_extension']
 
-    vid_fnames_2d = glob(os.path.join(session_path,
-                                      pipeline_videos_raw, "*."+video_ext))
+    vid_fnames_2d = find_files(config, os.path.join(session_path, pipeline_videos_raw),
+                               video_ext)
 
     # vid_fnames_2d = glob(os.path.join(session_path,
     #                                   pipeline_videos_labeled_2d, "*.avi"))
 
-    vid_fnames_3d = glob(os.path.join(session_path,
-                                      pipeline_videos_labeled_3d, "*.mp4"))
+    vid_fnames_3d = find_files(config, os.path.join(session_path, pipeline_videos_labeled_3d),
+                               'mp4')
     vid_fnames_3d = sorted(vid_fnames_3d, key=natural_keys)
 
     fnames_2d = defaultdict(list)
@@ -461,7 +469,7 @@ def process_session(config, session_path):
                                    config['pipeline']['calibration_results'],
                                    'calibration.toml')
         if os.path.exists(calib_fname):
-            cgroup = CameraGroup.load(calib_fname)
+            cgroup = load_camera_group(calib_fname)
 
     # angle_fnames = glob(os.path.join(session_path,
     #                                  pipeline_angles, '*.csv'))
@@ -476,11 +484,7 @@ def process_session(config, session_path):
         basename = true_basename(vid_fname)
 
         out_fname = os.path.join(outdir, basename+'.mp4')
-        pose_fname = os.path.join(session_path, pipeline_pose_3d, basename+'.csv')
-
-        if os.path.exists(out_fname) and \
-           abs(get_nframes(out_fname) - get_nframes(vid_fname)) < 100:
-            continue
+        pose_fname = pose_3d_fname(config, os.path.join(session_path, pipeline_pose_3d), basename)
 
         if not os.path.exists(pose_fname):
             print(out_fname, 'missing 3d data')
@@ -500,15 +504,23 @@ def process_session(config, session_path):
 
         cam_names = [get_cam_name(config, fname) for fname in fnames_2d_current]
 
+        deps = Dependencies([out_fname],
+                            [pose_fname, calib_fname, fname_3d_current] + fnames_2d_current,
+                            ['triangulation', 'cameras', 'labeling'])
+        legacy = lambda: abs(get_nframes(out_fname) - get_nframes(vid_fname)) < 100
+        if is_up_to_date(config, deps, legacy):
+            continue
+
         print(out_fname)
 
         video_folder = os.path.join(session_path, pipeline_videos_raw)
         offsets_dict = load_offsets_dict(config, cam_names, video_folder)
 
-        cgroup_subset = cgroup.subset_cameras_names(cam_names)
+        cgroup_subset = load_camera_group(calib_fname, cam_names)
 
-        visualize_combined(config, pose_fname, cgroup_subset, offsets_dict,
-                           fnames_2d_current, fname_3d_current, out_fname)
+        yield Task(out_fname, visualize_combined,
+                   (config, pose_fname, cgroup_subset, offsets_dict,
+                    fnames_2d_current, fname_3d_current, out_fname), deps)
 
 
 label_combined_all = make_process_fun(process_session)
@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import numpy as np
-from glob import glob
 import pandas as pd
 import os.path
 import cv2
@@ -18,10 +17,13 @@ from .common import make_process_fun, get_nframes, \
     get_video_params, get_video_params_cap, \
     get_data_length, natural_keys, true_basename, find_calibration_folder, \
     nan_helper
+from .manifest import find_files
 
 from .triangulate import load_offsets_dict
 
 from .label_videos import label_frame
+from .scheduler import Task
+from .dependencies import Dependencies, is_up_to_date
 
 
 def write_frame_thread(writer, q):
@@ -156,7 +158,7 @@ def process_session(config, session_path):
 
     video_ext = config['video_extension']
 
-    vid_fnames = glob(os.path.join(session_path, pipeline_videos_raw, "*." + video_ext))
+    vid_fnames = find_files(config, os.path.join(session_path, pipeline_videos_raw), video_ext)
 
     fnames_raw = defaultdict(list)
     for vid in vid_fnames:
@@ -174,10 +176,6 @@ def process_session(config, session_path):
         vids_raw = sorted(fnames_raw[vidname], key=natural_keys)
         vid_fname = vids_raw[0]
         
-        if os.path.exists(out_fname) and \
-           abs(get_nframes(out_fname) - get_nframes(vid_fname)) < 100:
-            continue
-
         vids_2d = [os.path.join(session_path, pipeline_videos_labeled_2d,
                                 true_basename(f) + '.mp4')
                    for f in vids_raw]
@@ -195,9 +193,15 @@ def process_session(config, session_path):
             print(out_fname, 'missing labeled filtered 2d videos')
             continue
 
+        deps = Dependencies([out_fname], vids_raw + vids_2d + vids_2d_filtered, [])
+        legacy = lambda: abs(get_nframes(out_fname) - get_nframes(vid_fname)) < 100
+        if is_up_to_date(config, deps, legacy):
+            continue
+
         print(out_fname)
         
-        visualize_compare(config, vids_raw, vids_2d, vids_2d_filtered, out_fname)
+        yield Task(out_fname, visualize_compare,
+                   (config, vids_raw, vids_2d, vids_2d_filtered, out_fname), deps)
 
 
 label_filter_compare_all = make_process_fun(process_session)
@@ -2,7 +2,6 @@
 
 import os.path
 import numpy as np
-from glob import glob
 import pandas as pd
 import cv2
 import skvideo.io
@@ -11,6 +10,10 @@ from tqdm import trange
 from matplotlib.pyplot import get_cmap
 
 from .common import make_process_fun, natural_keys, get_nframes
+from .manifest import find_files
+from .scheduler import Task
+from .dependencies import Dependencies, is_up_to_date
+from .profiling import Accumulator
 
 def connect(img, points, bps, bodyparts, col=(0,255,0,255)):
     try:
@@ -108,8 +111,12 @@ def visualize_labels(config, labels_fname, vid_fname, outname):
 
     all_points = points
 
+    decode = Accumulator('video_decode', fname=vid_fname)
+    encode = Accumulator('video_encode', fname=outname)
+
     for ix in trange(last, ncols=70):
-        ret, frame = cap.read()
+        with decode:
+            ret, frame = cap.read()
         if not ret:
             break
 
@@ -117,10 +124,14 @@ def visualize_labels(config, labels_fname, vid_fname, outname):
         points = all_points[:, :, ix]
         img = label_frame(img, points, scheme, bodyparts)
 
-        writer.writeFrame(img)
+        with encode:
+            writer.writeFrame(img)
 
     cap.release()
-    writer.close()
+    with encode:
+        writer.close()
+    decode.close()
+    encode.close()
 
 
 
@@ -137,7 +148,7 @@ def process_session(config, session_path, filtered=False):
 
     print(session_path)
 
-    labels_fnames = glob(os.path.join(session_path, pipeline_pose, '*.h5'))
+    labels_fnames = find_files(config, os.path.join(session_path, pipeline_pose), 'h5')
     labels_fnames = sorted(labels_fnames, key=natural_keys)
 
     outdir = os.path.join(session_path, pipeline_videos_labeled)
@@ -153,12 +164,14 @@ def process_session(config, session_path, filtered=False):
         vidname = os.path.join(session_path, pipeline_videos_raw, basename+'.'+video_ext)
 
         if os.path.exists(vidname):
-            if os.path.exists(out_fname) and \
-               abs(get_nframes(out_fname) - get_nframes(vidname)) < 100:
+            deps = Dependencies([out_fname], [fname, vidname], ['labeling'])
+            legacy = lambda: abs(get_nframes(out_fname) - get_nframes(vidname)) < 100
+            if is_up_to_date(config, deps, legacy):
                 continue
             print(out_fname)
 
-            visualize_labels(config, fname, vidname, out_fname)
+            yield Task(out_fname, visualize_labels,
+                       (config, fname, vidname, out_fname), deps)
 
 
 label_videos_all = make_process_fun(process_session, filtered=False)
@@ -4,7 +4,6 @@ from mayavi import mlab
 mlab.options.offscreen = True
 
 import numpy as np
-from glob import glob
 import pandas as pd
 import os.path
 import cv2
@@ -16,6 +15,12 @@ from collections import defaultdict
 from matplotlib.pyplot import get_cmap
 
 from .common import make_process_fun, get_nframes, get_video_name, get_video_params, get_data_length, natural_keys
+from .manifest import find_files
+from .pose_io import read_pose_3d, find_pose_3d
+from .video_info import probe_videos
+from .scheduler import Task
+from .dependencies import Dependencies, is_up_to_date
+from .profiling import Accumulator
 
 
 def connect(points, bps, bp_dict, color):
@@ -50,7 +55,7 @@ def visualize_labels(config, labels_fname, outname, fps=300):
     except KeyError:
         scheme = []
 
-    data = pd.read_csv(labels_fname)
+    data = read_pose_3d(labels_fname)
     cols = [x for x in data.columns if '_error' in x]
 
     if len(scheme) == 0:
@@ -123,6 +128,9 @@ def visualize_labels(config, labels_fname, outname, fps=300):
 
     mlab.view(focalpoint='auto', distance='auto')
 
+    render = Accumulator('render_3d', fname=labels_fname)
+    encode = Accumulator('video_encode', fname=outname)
+
     for framenum in trange(data.shape[0], ncols=70):
         fig.scene.disable_render = True
 
@@ -140,14 +148,19 @@ def visualize_labels(config, labels_fname, outname, fps=300):
 
         fig.scene.disable_render = False
 
-        img = mlab.screenshot()
+        with render:
+            img = mlab.screenshot()
 
         mlab.view(*view, reset_roll=False)
 
-        writer.writeFrame(img)
+        with encode:
+            writer.writeFrame(img)
 
     mlab.close(all=True)
-    writer.close()
+    with encode:
+        writer.close()
+    render.close()
+    encode.close()
 
 
 
@@ -163,17 +176,17 @@ def process_session(config, session_path, filtered=False):
 
     video_ext = config['video_extension']
 
-    vid_fnames = glob(os.path.join(session_path,
-                                   pipeline_videos_raw, "*."+video_ext))
+    vid_fnames = find_files(config, os.path.join(session_path, pipeline_videos_raw),
+                            video_ext)
     orig_fnames = defaultdict(list)
     for vid in vid_fnames:
         vidname = get_video_name(config, vid)
         orig_fnames[vidname].append(vid)
 
-    labels_fnames = glob(os.path.join(session_path,
-                                      pipeline_3d, '*.csv'))
+    labels_fnames = find_pose_3d(config, os.path.join(session_path, pipeline_3d))
     labels_fnames = sorted(labels_fnames, key=natural_keys)
 
+    probe_videos(vid_fnames)
 
     outdir = os.path.join(session_path, pipeline_videos_labeled_3d)
 
@@ -186,15 +199,17 @@ def process_session(config, session_path, filtered=False):
 
         out_fname = os.path.join(outdir, basename+'.mp4')
 
-        if os.path.exists(out_fname) and \
-           abs(get_nframes(out_fname) - get_data_length(fname)) < 100:
+        deps = Dependencies([out_fname], [fname], ['triangulation', 'labeling'])
+        legacy = lambda: abs(get_nframes(out_fname) - get_data_length(fname)) < 100
+        if is_up_to_date(config, deps, legacy):
             continue
         print(out_fname)
 
         some_vid = orig_fnames[basename][0]
         params = get_video_params(some_vid)
 
-        visualize_labels(config, fname, out_fname, params['fps'])
+        yield Task(out_fname, visualize_labels,
+                   (config, fname, out_fname, params['fps']), deps)
 
 
 label_videos_3d_all = make_process_fun(process_session, filtered=False)
@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import numpy as np
-from glob import glob
 import pandas as pd
 import os.path
 import cv2
@@ -11,17 +10,45 @@ from scipy import signal
 import queue
 import threading
 
-from aniposelib.cameras import CameraGroup
-
 from .common import make_process_fun, get_nframes, \
     get_video_name, get_cam_name, \
     get_video_params, get_video_params_cap, \
-    get_data_length, natural_keys, true_basename, find_calibration_folder
+    get_data_length, natural_keys, true_basename, find_calibration_folder, \
+    load_camera_group
+from .manifest import find_files
+from .pose_io import find_pose_3d
+from .video_info import probe_videos
 
 from .triangulate import load_offsets_dict
 from .filter_pose import write_pose_2d
 from .project_2d import get_projected_points
 from .label_videos import visualize_labels
+from .scheduler import Task
+from .dependencies import Dependencies, is_up_to_date
+
+def label_proj_trial(config, pose_fname, cgroup, offsets_dict,
+                     cam_names, vid_fnames, out_fnames):
+    bodyparts, points_2d_proj, all_scores = get_projected_points(
+        config, pose_fname, cgroup, offsets_dict)
+
+    metadata = {
+        'scorer': 'scorer',
+        'bodyparts': bodyparts,
+        'index': np.arange(points_2d_proj.shape[2])
+    }
+
+    n_cams, n_joints, n_frames, _ = points_2d_proj.shape
+
+    pts = np.zeros((n_frames, n_joints, 3), dtype='float64')
+
+    for cix, (cname, vidname, outname) in enumerate(zip(cam_names, vid_fnames, out_fnames)):
+        pts[:, :, :2] = points_2d_proj[cix].swapaxes(0, 1)
+        pts[:, :, 2] = all_scores.T
+        dlabs = write_pose_2d(pts, metadata)
+
+        print(outname)
+        visualize_labels(config, dlabs, vidname, outname)
+
 
 ## REFACTOR: this code is very similar to project_2d
 def process_session(config, session_path):
@@ -31,12 +58,12 @@ def process_session(config, session_path):
 
     video_ext = config['video_extension']
 
-    vid_fnames_2d = glob(os.path.join(
-        session_path, pipeline_videos_raw, "*."+video_ext))
+    vid_fnames_2d = find_files(
+        config, os.path.join(session_path, pipeline_videos_raw), video_ext)
     vid_fnames_2d = sorted(vid_fnames_2d, key=natural_keys)
 
-    pose_fnames_3d = glob(os.path.join(
-        session_path, pipeline_pose_3d, "*.csv"))
+    pose_fnames_3d = find_pose_3d(
+        config, os.path.join(session_path, pipeline_pose_3d))
     pose_fnames_3d = sorted(pose_fnames_3d, key=natural_keys)
     
     if len(pose_fnames_3d) == 0:
@@ -59,7 +86,7 @@ def process_session(config, session_path):
                                    config['pipeline']['calibration_results'],
                                    'calibration.toml')
         if os.path.exists(calib_fname):
-            cgroup = CameraGroup.load(calib_fname)
+            cgroup = load_camera_group(calib_fname)
 
     if cgroup is None:
         print('session {}: no calibration found, skipping'.format(session_path))
@@ -68,6 +95,9 @@ def process_session(config, session_path):
     outdir = os.path.join(session_path, pipeline_videos_2d_projected)
     os.makedirs(outdir, exist_ok=True)
 
+    # fill the metadata cache for the frame count checks of older outputs in one go
+    probe_videos(vid_fnames_2d + find_files(config, outdir, 'mp4'))
+
     for pose_fname in pose_fnames_3d:
         basename = true_basename(pose_fname)
 
@@ -82,7 +112,13 @@ def process_session(config, session_path):
         out_fnames = [os.path.join(outdir, true_basename(fname) + '.mp4')
                       for fname in fnames_2d_current]
 
-        if all([os.path.exists(f) for f in out_fnames]):
+        deps = Dependencies(out_fnames,
+                            [pose_fname, calib_fname] + fnames_2d_current,
+                            ['triangulation', 'cameras', 'labeling'])
+        legacy = lambda: all([os.path.exists(out) and
+                              abs(get_nframes(out) - get_nframes(vid)) < 50
+                              for vid, out in zip(fnames_2d_current, out_fnames)])
+        if is_up_to_date(config, deps, legacy):
             continue
 
         # print(pose_fname)
@@ -93,30 +129,10 @@ def process_session(config, session_path):
         video_folder = os.path.join(session_path, pipeline_videos_raw)
         offsets_dict = load_offsets_dict(config, cam_names, video_folder)
 
-        cgroup_subset = cgroup.subset_cameras_names(cam_names)
-
-        bodyparts, points_2d_proj, all_scores = get_projected_points(
-            config, fname_3d_current, cgroup_subset, offsets_dict)
-
-        metadata = {
-            'scorer': 'scorer',
-            'bodyparts': bodyparts,
-            'index': np.arange(points_2d_proj.shape[2])
-        }
-
-        n_cams, n_joints, n_frames, _ = points_2d_proj.shape
-        
-        pts = np.zeros((n_frames, n_joints, 3), dtype='float64')
-        
-        for cix, (cname, vidname, outname) in enumerate(zip(cam_names, fnames_2d_current, out_fnames)):
-            pts[:, :, :2] = points_2d_proj[cix].swapaxes(0, 1)
-            pts[:, :, 2] = all_scores.T
-            dlabs = write_pose_2d(pts, metadata, outname)
-
-            if os.path.exists(outname) and \
-               abs(get_nframes(outname) - get_nframes(vidname)) < 50:
-                continue
-            print(outname)
-            visualize_labels(config, dlabs, vidname, outname)
+        cgroup_subset = load_camera_group(calib_fname, cam_names)
+
+        yield Task(pose_fname, label_proj_trial,
+                   (config, fname_3d_current, cgroup_subset, offsets_dict,
+                    cam_names, fnames_2d_current, out_fnames), deps)
 
 label_proj_all = make_process_fun(process_session)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import uuid
+import socket
+import hashlib
+import threading
+from contextlib import contextmanager
+
+from .dependencies import get_state_folder
+
+## Lease files, so that several nodes can process the same (shared) project
+## without doing the same trial twice.
+## Before running a task, a node creates <project>/.anipose/leases/<key>.lease
+## with O_EXCL, which only one node can do. The key hashes the stage and the
+## name of the task, as several stages name their tasks after the same file
+## (e.g. project_2d and label_videos_proj both after the 3d pose file).
+## While the task runs, a heartbeat thread keeps touching the lease.
+## A lease that has not been touched for lease_timeout seconds belongs to a
+## node that crashed, and is reclaimed by renaming it out of the way (which
+## again only one node can do).
+
+_held = dict() # lease path -> token
+_held_lock = threading.Lock()
+_heartbeat_thread = None
+
+
+def is_enabled(config):
+    return config.get('distributed', dict()).get('enabled', False)
+
+
+def make_token():
+    return '{}-{}-{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+
+
+def lease_fname(config, name, stage=''):
+    relpath = os.path.relpath(os.path.abspath(name), config['path'])
+    key = hashlib.sha1((stage + ':' + relpath).encode('utf8')).hexdigest()
+    return os.path.join(get_state_folder(config), 'leases', key + '.lease')
+
+
+def read_token(fname):
+    try:
+        with open(fname, 'r') as f:
+            return json.load(f)['token']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def create_lease(fname, name, token):
+    try:
+        fd = os.open(fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    info = {
+        'token': token,
+        'name': name,
+        'host': socket.gethostname(),
+        'pid': os.getpid(),
+        'time': time.time()
+    }
+    with os.fdopen(fd, 'w') as f:
+        json.dump(info, f)
+    return True
+
+
+def reclaim_stale(fname, lease_timeout):
+    """Removes the lease in fname if it expired. Returns True if it did."""
+    try:
+        age = time.time() - os.stat(fname).st_mtime
+    except FileNotFoundError:
+        return True
+    if age < lease_timeout:
+        return False
+
+    stale_token = read_token(fname)
+    moved = '{}.{}.stale'.format(fname, make_token())
+    try:
+        os.rename(fname, moved)
+    except FileNotFoundError: # someone else reclaimed it first
+        return True
+
+    if read_token(moved) != stale_token:
+        # the lease was reclaimed and taken again between our check and the
+        # rename, so put it back unless yet another node took it since
+        try:
+            os.link(moved, fname)
+        except OSError:
+            pass
+        os.remove(moved)
+        return False
+
+    print('W: reclaimed expired lease {}'.format(fname))
+    os.remove(moved)
+    return True
+
+
+def heartbeat_loop(interval):
+    while True:
+        time.sleep(interval)
+        with _held_lock:
+            held = list(_held.items())
+        for fname, token in held:
+            try:
+                os.utime(fname)
+            except OSError:
+                pass
+            if read_token(fname) != token and fname in _held:
+                print('W: lost lease {}, another node may be processing the same trial'.format(fname))
+
+
+def start_heartbeat(config):
+    global _heartbeat_thread
+    if _heartbeat_thread is not None and _heartbeat_thread.is_alive():
+        return
+    interval = config['distributed']['heartbeat']
+    _heartbeat_thread = threading.Thread(target=heartbeat_loop, args=(interval,),
+                                         daemon=True)
+    _heartbeat_thread.start()
+
+
+def acquire(config, name, stage=''):
+    """Tries to take the lease for name within stage. Returns the lease file
+    if successful, or None if another node holds it."""
+    fname = lease_fname(config, name, stage)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    token = make_token()
+
+    if not create_lease(fname, name, token):
+        if not reclaim_stale(fname, config['distributed']['lease_timeout']):
+            return None
+        if not create_lease(fname, name, token):
+            return None
+
+    with _held_lock:
+        _held[fname] = token
+    start_heartbeat(config)
+    return fname
+
+
+def release(fname):
+    with _held_lock:
+        token = _held.pop(fname, None)
+    if token is not None and read_token(fname) == token:
+        try:
+            os.remove(fname)
+        except FileNotFoundError:
+            pass
+
+
+@contextmanager
+def task_lease(config, name, stage=''):
+    """Holds the lease for name within stage for the duration of the block.
+    Yields whether the lease was obtained (always True if distributed mode
+    is disabled)."""
+    if not is_enabled(config):
+        yield True
+        return
+
+    fname = acquire(config, name, stage)
+    if fname is None:
+        yield False
+        return
+
+    try:
+        yield True
+    finally:
+        release(fname)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import sqlite3
+
+from .dependencies import get_state_folder
+
+## Project manifest: an index of the folders in a project and the files in them,
+## stored in <project>/.anipose/manifest.sqlite.
+## A folder is only listed again when its mtime changes (i.e. when files or
+## folders were added, removed or renamed in it), so that walking a large
+## project on a network filesystem only costs one stat per folder.
+## Only the listings are indexed: the sessions are still walked folder by
+## folder, and each stage still finds its trials, cameras and outputs from
+## the listings and stats the files it checks.
+
+MANIFEST_NAME = 'manifest.sqlite'
+
+## folders modified more recently than this are not cached, as the mtime
+## resolution of some filesystems is too coarse to notice further changes
+MTIME_SLACK_NS = 2 * 10**9
+
+_connections = dict()
+
+
+def get_connection(config):
+    fname = os.path.join(get_state_folder(config), MANIFEST_NAME)
+    key = (fname, os.getpid())
+    if key in _connections:
+        return _connections[key]
+
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    conn = sqlite3.connect(fname, timeout=60)
+    conn.execute('CREATE TABLE IF NOT EXISTS folders ('
+                 'path TEXT PRIMARY KEY, mtime_ns INTEGER, '
+                 'folders TEXT, files TEXT)')
+    conn.commit()
+    _connections[key] = conn
+    return conn
+
+
+def scan_folder(path):
+    folders = []
+    files = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir():
+                folders.append(entry.name)
+            else:
+                files.append(entry.name)
+    return sorted(folders), sorted(files)
+
+
+def list_folder(config, path):
+    """Returns the sorted names of folders and files within path,
+    from the manifest if path has not changed since it was last listed."""
+    path = os.path.abspath(path)
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError):
+        return [], []
+
+    try:
+        conn = get_connection(config)
+        row = conn.execute('SELECT mtime_ns, folders, files FROM folders WHERE path = ?',
+                           (path,)).fetchone()
+    except sqlite3.Error:
+        return scan_folder(path)
+
+    if row is not None and row[0] == mtime_ns:
+        return json.loads(row[1]), json.loads(row[2])
+
+    folders, files = scan_folder(path)
+    if time.time_ns() - mtime_ns < MTIME_SLACK_NS:
+        return folders, files
+    try:
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?)',
+                         (path, mtime_ns, json.dumps(folders), json.dumps(files)))
+    except sqlite3.Error:
+        pass # manifest is only a cache, listing is still correct
+    return folders, files
+
+
+def find_folders(config, path):
+    """Like common.get_folders, but goes through the manifest"""
+    folders, _ = list_folder(config, path)
+    return [f for f in folders if not f.startswith('.')]
+
+
+def find_files(config, folder, ext):
+    """Equivalent to glob(os.path.join(folder, '*.' + ext)),
+    but goes through the manifest"""
+    _, files = list_folder(config, folder)
+    suffix = '.' + ext
+    return [os.path.join(folder, f) for f in files
+            if f.endswith(suffix) and not f.startswith('.')]
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import numpy as np
+
+from .atomic import atomic_output, temp_fname
+from .profiling import span, file_size
+
+## Small metadata sidecars for pose outputs.
+## Writers record the number of frames and the shape of the data next to each
+## output, in a hidden file .<name>.meta.json, along with the size and mtime of
+## the output when it was written. This lets readers get the length of an
+## output without opening it, and the sidecar is ignored once the output is
+## modified by anything else.
+##
+## 3d pose can also be stored in a binary npz format instead of csv, set by
+## pose_3d_format in the [storage] section of the config. It holds one
+## compressed float32 array per field (xyz, error, ncams, score) of shape
+## (frames, bodyparts, ...), and the bodyparts and coordinate transform once.
+## Readers convert either format to the same table as the csv, loading only
+## the arrays needed for the requested columns. The coordinate transform of a
+## csv is also recorded once in its sidecar, so that read_pose_3d_transform
+## gets it from either format without reading the M_ij and center_i columns.
+##
+## 2d pose is always stored as DeepLabCut-style hdf5 tables, set by
+## pose_2d_format in the [storage] section. The default "fast" format skips
+## the on-disk index of the frame numbers that pandas builds for queries,
+## which takes most of the time to write and is never used. "dlc" writes the
+## files exactly as DeepLabCut does. Both are read the same way by pandas.
+
+def meta_fname(fname):
+    folder, name = os.path.split(fname)
+    return os.path.join(folder, '.' + name + '.meta.json')
+
+
+def write_pose_meta(fname, nframes, shape=None, transform=None):
+    st = os.stat(fname)
+    meta = {
+        'nframes': int(nframes),
+        'shape': [int(x) for x in shape] if shape is not None else None,
+        'size': st.st_size,
+        'mtime_ns': st.st_mtime_ns
+    }
+    if transform is not None:
+        M, center = transform
+        meta['M'] = np.asarray(M).tolist()
+        meta['center'] = np.asarray(center).tolist()
+    out_fname = meta_fname(fname)
+    tmp_fname = '{}.{}.tmp'.format(out_fname, os.getpid())
+    with open(tmp_fname, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_fname, out_fname)
+
+
+def read_pose_meta(fname):
+    """Returns the metadata recorded for fname, or None if there is none
+    or fname changed since it was recorded."""
+    try:
+        with open(meta_fname(fname), 'r') as f:
+            meta = json.load(f)
+        st = os.stat(fname)
+    except (OSError, ValueError):
+        return None
+    if meta.get('size') != st.st_size or meta.get('mtime_ns') != st.st_mtime_ns:
+        return None
+    return meta
+
+
+def read_pose_csv(fname):
+    """Reads a table of pose data (3d points, angles)"""
+    import pandas as pd
+    with span('read_pose_csv', 'io', bytes=file_size(fname)) as info:
+        data = pd.read_csv(fname)
+        info['frames'] = len(data)
+    return data
+
+
+def write_pose_csv(dout, fname, transform=None):
+    """Writes a table of pose data (3d points, angles) as a csv,
+    with its metadata sidecar"""
+    with span('write_pose_csv', 'io', frames=dout.shape[0]) as info:
+        with atomic_output(fname) as tmp_fname:
+            dout.to_csv(tmp_fname, index=False)
+        write_pose_meta(fname, dout.shape[0], dout.shape, transform)
+        info['bytes'] = file_size(fname)
+
+
+POSE_2D_FORMATS = ['fast', 'dlc']
+
+
+def get_pose_2d_format(config):
+    fmt = config['storage']['pose_2d_format']
+    if fmt not in POSE_2D_FORMATS:
+        raise ValueError('storage.pose_2d_format should be one of {}, got "{}"'.format(
+            POSE_2D_FORMATS, fmt))
+    return fmt
+
+
+POSE_3D_FORMATS = ['npz', 'csv']
+
+## per bodypart columns of the pose-3d table, in order, with their npz array
+POSE_3D_FIELDS = [('x', 'xyz'), ('y', 'xyz'), ('z', 'xyz'),
+                  ('error', 'error'), ('ncams', 'ncams'), ('score', 'score')]
+
+
+def get_pose_3d_format(config):
+    fmt = config['storage']['pose_3d_format']
+    if fmt not in POSE_3D_FORMATS:
+        raise ValueError('storage.pose_3d_format should be one of {}, got "{}"'.format(
+            POSE_3D_FORMATS, fmt))
+    return fmt
+
+
+def pose_3d_fname(config, folder, name):
+    """Path of the 3d pose of trial name in folder.
+    Trials already stored in the other format keep it,
+    so that existing outputs are not recomputed."""
+    fmt = get_pose_3d_format(config)
+    fname = os.path.join(folder, name + '.' + fmt)
+    if not os.path.exists(fname):
+        for other in POSE_3D_FORMATS:
+            other_fname = os.path.join(folder, name + '.' + other)
+            if os.path.exists(other_fname):
+                return other_fname
+    return fname
+
+
+def find_pose_3d(config, folder):
+    """All the 3d pose files in folder, in either format.
+    If a trial exists in both, only the configured format is returned."""
+    from .manifest import find_files
+    fmt = get_pose_3d_format(config)
+    fnames = dict()
+    for ext in POSE_3D_FORMATS:
+        for fname in find_files(config, folder, ext):
+            name = os.path.splitext(os.path.basename(fname))[0]
+            if name not in fnames or ext == fmt:
+                fnames[name] = fname
+    return sorted(fnames.values())
+
+
+def get_pose_3d_transform(dout):
+    """Rotation matrix and center of the coordinate frame of a table in the
+    pose-3d format, the same on all rows (identity if it has none)"""
+    M = np.identity(3)
+    center = np.zeros(3)
+    if len(dout) > 0 and 'M_00' in dout.columns:
+        for i in range(3):
+            center[i] = dout['center_{}'.format(i)].iloc[0]
+            for j in range(3):
+                M[i, j] = dout['M_{}{}'.format(i, j)].iloc[0]
+    return M, center
+
+
+def pack_pose_3d(dout):
+    """Converts a table in the pose-3d format into a dict of arrays"""
+    cols = [x for x in dout.columns if x.endswith('_error')]
+    bodyparts = [c[:-len('_error')] for c in cols]
+
+    arrays = {'bodyparts': np.array(bodyparts, dtype='U')}
+    xyz_cols = [bp + '_' + v for bp in bodyparts for v in 'xyz']
+    arrays['xyz'] = np.array(dout[xyz_cols], dtype='float32')\
+                      .reshape(len(dout), len(bodyparts), 3)
+    for field in ['error', 'ncams', 'score']:
+        field_cols = [bp + '_' + field for bp in bodyparts]
+        arrays[field] = np.array(dout[field_cols], dtype='float32')
+
+    M, center = get_pose_3d_transform(dout)
+    arrays['M'] = M
+    arrays['center'] = center
+    arrays['fnum'] = np.array(dout['fnum'], dtype='int64')
+    return arrays
+
+
+def unpack_pose_3d(arrays, columns=None):
+    """Converts arrays (a dict or a loaded npz file) into a table in the
+    pose-3d format, with only the given columns if columns is not None"""
+    import pandas as pd
+    bodyparts = [str(bp) for bp in arrays['bodyparts']]
+    fields = dict(POSE_3D_FIELDS)
+
+    if columns is None:
+        columns = [bp + '_' + f for bp in bodyparts for f, _ in POSE_3D_FIELDS]
+        columns += ['M_{}{}'.format(i, j) for i in range(3) for j in range(3)]
+        columns += ['center_{}'.format(i) for i in range(3)]
+        columns += ['fnum']
+
+    loaded = dict()
+    def get(name):
+        if name not in loaded:
+            loaded[name] = arrays[name]
+        return loaded[name]
+
+    bp_index = dict(zip(bodyparts, range(len(bodyparts))))
+    n_frames = len(get('fnum'))
+    out = dict()
+    for col in columns:
+        if col == 'fnum':
+            out[col] = get('fnum')
+        elif col.startswith('M_') and len(col) == 4:
+            out[col] = np.full(n_frames, get('M')[int(col[2]), int(col[3])])
+        elif col.startswith('center_') and len(col) == 8:
+            out[col] = np.full(n_frames, get('center')[int(col[7])])
+        else:
+            bp, field = col.rsplit('_', 1)
+            if bp not in bp_index or field not in fields:
+                raise KeyError('column {} not found in 3d pose'.format(col))
+            values = get(fields[field])
+            if field in 'xyz':
+                values = values[:, bp_index[bp], 'xyz'.index(field)]
+            else:
+                values = values[:, bp_index[bp]]
+            out[col] = values.astype('float64')
+    return pd.DataFrame(out, columns=columns)
+
+
+def read_pose_3d(fname, columns=None):
+    """Reads 3d pose in either format as a table in the pose-3d format,
+    with only the given columns if columns is not None"""
+    import pandas as pd
+    with span('read_pose_3d', 'io', bytes=file_size(fname)) as info:
+        if fname.endswith('.npz'):
+            with np.load(fname, allow_pickle=False) as arrays:
+                data = unpack_pose_3d(arrays, columns)
+        else:
+            data = pd.read_csv(fname, usecols=columns)
+        info['frames'] = len(data)
+    return data
+
+
+def iter_npz_array(fname, key, chunk_frames):
+    """Yields the array key of the npz file fname, chunk_frames rows at a
+    time, decompressing only these rows (always yields at least once)"""
+    import zipfile
+    with zipfile.ZipFile(fname) as zf, zf.open(key + '.npy') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        if fortran_order: # not written by anipose, read it whole
+            arr = np.frombuffer(f.read(), dtype).reshape(shape, order='F')
+        else:
+            arr = None
+        row_bytes = int(np.prod(shape[1:])) * dtype.itemsize
+        start = 0
+        while True:
+            n = min(chunk_frames, shape[0] - start)
+            if arr is not None:
+                chunk = arr[start:start+n]
+            else:
+                chunk = np.frombuffer(f.read(n * row_bytes), dtype)\
+                          .reshape((n,) + tuple(shape[1:]))
+            if n > 0 or start == 0:
+                yield chunk
+            start += n
+            if start >= shape[0]:
+                break
+
+
+def read_pose_3d_transform(fname):
+    """Rotation matrix and center of the coordinate frame of a 3d pose file,
+    without reading its points"""
+    import pandas as pd
+    if fname.endswith('.npz'):
+        with np.load(fname, allow_pickle=False) as arrays:
+            return np.array(arrays['M']), np.array(arrays['center'])
+    meta = read_pose_meta(fname)
+    if meta is not None and 'M' in meta:
+        return np.array(meta['M']), np.array(meta['center'])
+    # older csv files, without the transform in the sidecar
+    return get_pose_3d_transform(pd.read_csv(fname, nrows=1))
+
+
+def write_pose_3d(dout, fname):
+    """Writes a table in the pose-3d format, in the format given by
+    the extension of fname, with its metadata sidecar"""
+    if not fname.endswith('.npz'):
+        write_pose_csv(dout, fname, get_pose_3d_transform(dout))
+        return
+    with span('write_pose_3d', 'io', frames=dout.shape[0]) as info:
+        arrays = pack_pose_3d(dout)
+        with atomic_output(fname) as tmp_fname:
+            with open(tmp_fname, 'wb') as f:
+                np.savez_compressed(f, **arrays)
+        write_pose_meta(fname, dout.shape[0], arrays['xyz'].shape)
+        info['bytes'] = file_size(fname)
+
+
+def write_pose_3d_chunks(chunks, fname, n_frames):
+    """Writes the tables in the pose-3d format given by the iterator chunks,
+    with n_frames frames in total, one after the other as a single output,
+    without holding all of them in memory"""
+    if not fname.endswith('.npz'):
+        with span('write_pose_3d', 'io', frames=n_frames) as info:
+            with atomic_output(fname) as tmp_fname:
+                for i, dout in enumerate(chunks):
+                    dout.to_csv(tmp_fname, index=False, header=(i == 0),
+                                mode='w' if i == 0 else 'a')
+                    shape = (n_frames, dout.shape[1])
+                    if i == 0:
+                        transform = get_pose_3d_transform(dout)
+            write_pose_meta(fname, n_frames, shape, transform)
+            info['bytes'] = file_size(fname)
+        return
+
+    ## the arrays over frames are filled in temporary .npy files, and then
+    ## compressed into the npz the same way as np.savez_compressed would
+    import zipfile
+    tmp_arrays = dict()
+    try:
+        with span('write_pose_3d', 'io', frames=n_frames) as info:
+            start = 0
+            for dout in chunks:
+                arrays = pack_pose_3d(dout)
+                end = start + len(dout)
+                for key in ['xyz', 'error', 'ncams', 'score', 'fnum']:
+                    arr = arrays.pop(key)
+                    if key not in tmp_arrays:
+                        tmp_arrays[key] = np.lib.format.open_memmap(
+                            temp_fname(fname) + '.' + key + '.npy', mode='w+',
+                            dtype=arr.dtype, shape=(n_frames,) + arr.shape[1:])
+                    if end > start:
+                        tmp_arrays[key][start:end] = arr
+                start = end
+            for arr in tmp_arrays.values():
+                arr.flush()
+
+            with atomic_output(fname) as tmp_fname:
+                with zipfile.ZipFile(tmp_fname, mode='w', compression=zipfile.ZIP_DEFLATED,
+                                     allowZip64=True) as zf:
+                    for key, arr in arrays.items():
+                        with zf.open(key + '.npy', 'w', force_zip64=True) as f:
+                            np.lib.format.write_array(f, np.asanyarray(arr))
+                    for key, arr in tmp_arrays.items():
+                        zf.write(arr.filename, key + '.npy')
+            write_pose_meta(fname, n_frames, tmp_arrays['xyz'].shape)
+            info['bytes'] = file_size(fname)
+    finally:
+        for arr in tmp_arrays.values():
+            if os.path.exists(arr.filename):
+                os.remove(arr.filename)
+
+
+def as_stored_pose_3d(dout, fname):
+    """The table that reading fname back would give after writing dout to it"""
+    if fname is None or not fname.endswith('.npz'):
+        return dout
+    return unpack_pose_3d(pack_pose_3d(dout))
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import shutil
+import hashlib
+import itertools
+
+import numpy as np
+
+from .dependencies import get_state_folder
+from .profiling import span
+
+## Chunked on-disk copies of pose data, for reading ranges of frames of long
+## recordings without loading whole trials in memory.
+## A store holds a few named arrays whose first axis is the frame, split into
+## .npy chunks of storage.store_chunk_frames frames, which are memory-mapped
+## when read so only the requested frames are loaded. Stores are kept in
+## <project>/.anipose/store, built from the pose files the first time a range
+## is requested, and rebuilt when any of these files change. They are built
+## one chunk at a time, without loading the whole pose files.
+
+STORE_VERSION = 1
+
+
+def store_folder(config, sources):
+    relpaths = [os.path.relpath(os.path.abspath(f), config['path']) for f in sources]
+    key = hashlib.sha1('\n'.join(relpaths).encode('utf8')).hexdigest()
+    return os.path.join(get_state_folder(config), 'store', key[:2], key)
+
+
+def sources_state(sources):
+    state = dict()
+    for fname in sources:
+        st = os.stat(fname)
+        state[os.path.abspath(fname)] = [st.st_size, st.st_mtime_ns]
+    return state
+
+
+def chunk_fname(folder, name, num):
+    return os.path.join(folder, '{}-{:05d}.npy'.format(name, num))
+
+
+def write_store(folder, blocks, meta, chunk_frames):
+    """Writes a store in folder, replacing any previous one. blocks yields
+    the chunks in order, as dicts of arrays with the same number of frames
+    on the first axis: chunk_frames frames, except for the last chunk.
+    It must yield at least one (possibly empty) chunk."""
+    meta = dict(meta)
+
+    parent, name = os.path.split(folder)
+    os.makedirs(parent, exist_ok=True)
+    tmp_folder = os.path.join(parent, '.{}.{}.tmp'.format(name, os.getpid()))
+    if os.path.exists(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+
+    n_frames = 0
+    for num, block in enumerate(blocks):
+        n = min([len(arr) for arr in block.values()])
+        for key, arr in block.items():
+            np.save(chunk_fname(tmp_folder, key, num), arr[:n])
+        n_frames += n
+        meta['arrays'] = sorted(block.keys())
+
+    meta['version'] = STORE_VERSION
+    meta['n_frames'] = int(n_frames)
+    meta['chunk_frames'] = int(chunk_frames)
+    with open(os.path.join(tmp_folder, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    # the previous store is only deleted once the new one is in place
+    old_folder = None
+    if os.path.exists(folder):
+        old_folder = os.path.join(parent, '.{}.{}.old'.format(name, os.getpid()))
+        try:
+            os.rename(folder, old_folder)
+        except OSError: # replaced by another process at the same time
+            old_folder = None
+    try:
+        os.rename(tmp_folder, folder)
+    except OSError: # built by another process at the same time
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+    if old_folder is not None:
+        shutil.rmtree(old_folder, ignore_errors=True)
+
+
+class PoseStore:
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.n_frames = self.meta['n_frames']
+        self.chunk_frames = self.meta['chunk_frames']
+        self._chunks = dict()
+
+    def __len__(self):
+        return self.n_frames
+
+    def _chunk(self, name, num):
+        key = (name, num)
+        if key not in self._chunks:
+            self._chunks[key] = np.load(chunk_fname(self.folder, name, num),
+                                        mmap_mode='r')
+        return self._chunks[key]
+
+    def read(self, name, start=0, end=None):
+        """Frames start to end (excluded) of array name"""
+        if end is None or end > self.n_frames:
+            end = self.n_frames
+        start = max(start, 0)
+        first = self._chunk(name, 0)
+        if end <= start:
+            return np.zeros((0,) + first.shape[1:], dtype=first.dtype)
+
+        parts = []
+        for num in range(start // self.chunk_frames, (end - 1) // self.chunk_frames + 1):
+            offset = num * self.chunk_frames
+            chunk = self._chunk(name, num)
+            parts.append(chunk[max(start - offset, 0):end - offset])
+        return np.concatenate(parts, axis=0)
+
+
+def open_store(config, sources, build):
+    """Opens the store built from the files sources, building it with
+    build(chunk_frames) -> (blocks, meta) if it is missing or out of date
+    (see write_store for blocks)"""
+    folder = store_folder(config, sources)
+    state = sources_state(sources)
+    try:
+        store = PoseStore(folder)
+        if store.meta.get('version') == STORE_VERSION and store.meta.get('sources') == state:
+            return store
+    except (OSError, ValueError):
+        pass
+
+    chunk_frames = config['storage']['store_chunk_frames']
+    with span('build_pose_store', 'io'):
+        blocks, meta = build(chunk_frames)
+        meta['sources'] = state
+        write_store(folder, blocks, meta, chunk_frames)
+    return PoseStore(folder)
+
+
+def open_pose2d_store(config, fname_dict, cam_names=None):
+    """Store of the 2d pose of one trial, with arrays 'points' of shape
+    (frames, cameras, joints, 2) and 'scores' of shape (frames, cameras, joints),
+    without the crop offsets"""
+    from .triangulate import iter_pose2d_chunks
+    if cam_names is None:
+        cam_names = sorted(fname_dict.keys())
+    sources = [fname_dict[cname] for cname in cam_names]
+
+    def build(chunk_frames):
+        chunks = iter_pose2d_chunks(fname_dict, None, cam_names, chunk_frames)
+        first = next(chunks)
+        meta = {'cam_names': cam_names, 'bodyparts': first['bodyparts']}
+
+        def blocks():
+            for out in itertools.chain([first], chunks):
+                yield {
+                    'points': np.ascontiguousarray(out['points'].swapaxes(0, 1)),
+                    'scores': np.ascontiguousarray(out['scores'].swapaxes(0, 1))
+                }
+
+        return blocks(), meta
+
+    return open_store(config, sources, build)
+
+
+def read_pose2d_range(config, fname_dict, offsets_dict=None, cam_names=None,
+                      start=0, end=None, dtype='float64'):
+    """Same as load_pose2d_fnames, for frames start to end only"""
+    if cam_names is None:
+        cam_names = sorted(fname_dict.keys())
+    store = open_pose2d_store(config, fname_dict, cam_names)
+    with span('read_pose2d_range', 'io') as info:
+        points = store.read('points', start, end).swapaxes(0, 1).astype(dtype)
+        scores = store.read('scores', start, end).swapaxes(0, 1).astype(dtype)
+        info['frames'] = points.shape[1]
+
+    if offsets_dict is not None:
+        for cix, cname in enumerate(cam_names):
+            dx, dy = offsets_dict[cname]
+            points[cix, :, :, 0] += dx
+            points[cix, :, :, 1] += dy
+
+    return {
+        'cam_names': cam_names,
+        'points': points,
+        'scores': scores,
+        'bodyparts': store.meta['bodyparts']
+    }
+
+
+def iter_csv_blocks(fname, header, chunk_frames):
+    """Yields the arrays over frames of a csv 3d pose file, chunk_frames
+    frames at a time"""
+    import pandas as pd
+    n_chunks = 0
+    for dout in pd.read_csv(fname, chunksize=chunk_frames):
+        n_chunks += 1
+        yield pack_frame_arrays(dout)
+    if n_chunks == 0:
+        yield pack_frame_arrays(header)
+
+
+def pack_frame_arrays(dout):
+    """The arrays over frames of pack_pose_3d(dout)"""
+    from .pose_io import pack_pose_3d
+    arrays = pack_pose_3d(dout)
+    for key in ['bodyparts', 'M', 'center']:
+        arrays.pop(key)
+    return arrays
+
+
+def open_pose3d_store(config, fname):
+    """Store of a 3d pose file (in either format), with the arrays of the
+    npz format and the bodyparts and transform in its metadata"""
+    from .pose_io import iter_npz_array, read_pose_3d_transform
+    import pandas as pd
+
+    def build(chunk_frames):
+        M, center = read_pose_3d_transform(fname)
+        if fname.endswith('.npz'):
+            with np.load(fname, allow_pickle=False) as arrays:
+                bodyparts = [str(bp) for bp in arrays['bodyparts']]
+            names = ['xyz', 'error', 'ncams', 'score', 'fnum']
+            parts = [iter_npz_array(fname, name, chunk_frames) for name in names]
+            blocks = (dict(zip(names, arrs)) for arrs in zip(*parts))
+        else:
+            header = pd.read_csv(fname, nrows=0)
+            bodyparts = [c[:-len('_error')] for c in header.columns
+                         if c.endswith('_error')]
+            blocks = iter_csv_blocks(fname, header, chunk_frames)
+        meta = {
+            'bodyparts': bodyparts,
+            'M': np.array(M).tolist(),
+            'center': np.array(center).tolist()
+        }
+        return blocks, meta
+
+    return open_store(config, [fname], build)
+
+
+def read_pose3d_range(config, fname, start=0, end=None, columns=None):
+    """Same as read_pose_3d, for frames start to end only"""
+    from .pose_io import unpack_pose_3d
+    store = open_pose3d_store(config, fname)
+
+    class Arrays:
+        def __getitem__(self, key):
+            if key in ['bodyparts', 'M', 'center']:
+                return np.array(store.meta[key])
+            return store.read(key, start, end)
+
+    with span('read_pose3d_range', 'io') as info:
+        data = unpack_pose_3d(Arrays(), columns)
+        info['frames'] = len(data)
+    data.index = data.index + max(start, 0)
+    return data
@@ -9,6 +9,7 @@ import io
 from contextlib import redirect_stdout
 
 from .common import natural_keys, make_process_fun
+from .manifest import find_files
 
 def rename_dlc_files(folder, base):
     files = glob(os.path.join(folder, base+'*'))
@@ -29,7 +30,7 @@ def process_session(config, session_path):
     source_folder = os.path.join(session_path, pipeline_videos_raw)
     outdir = os.path.join(session_path, pipeline_pose)
 
-    videos = glob(os.path.join(source_folder, '*.'+video_ext))
+    videos = find_files(config, source_folder, video_ext)
     videos = sorted(videos, key=natural_keys)
 
     if len(videos) > 0:
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import glob
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from .dependencies import get_state_folder
+
+## Optional timing instrumentation, enabled with anipose --profile.
+## Each instrumented block records an event with its wall time, cpu time,
+## resident memory at its start and end, and optionally the number of frames
+## and bytes it processed. The peak memory of the process so far is recorded
+## too, but it is a high-water mark over the lifetime of the process, not of
+## the block.
+## Every process (including the scheduler's workers) appends its events as
+## json lines to its own file in <project>/.anipose/profile/<run>/, and at the
+## end of the command these are merged into events.jsonl and trace.json
+## (Chrome trace format, viewable in chrome://tracing or Perfetto), and a
+## summary table is printed.
+
+_folder = None
+_file = None
+_lock = threading.Lock()
+
+
+def get_peak_rss():
+    """Peak resident memory of this process in bytes"""
+    try:
+        import resource
+    except ImportError: # not available on windows
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+
+def get_current_rss():
+    """Current resident memory of this process in bytes,
+    or 0 if it cannot be read (only implemented on linux)"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return 0
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def start_profiling(config):
+    """Creates a new profiling run folder for this command and enables
+    profiling in this process. The folder is stored in config['profile']
+    so that worker processes record their events there too."""
+    run = time.strftime('%Y%m%d-%H%M%S') + '-{}'.format(os.getpid())
+    folder = os.path.join(get_state_folder(config), 'profile', run)
+    os.makedirs(folder, exist_ok=True)
+    config['profile'] = folder
+    setup_profiling(config)
+
+
+def setup_profiling(config):
+    """Enables profiling in this process if it is enabled in config"""
+    global _folder, _file
+    folder = config.get('profile')
+    if folder is None or folder == _folder:
+        return
+    if _file is not None:
+        _file.close()
+    _folder = folder
+    fname = os.path.join(folder, 'events-{}.jsonl'.format(os.getpid()))
+    _file = open(fname, 'a')
+
+
+def is_enabled():
+    return _file is not None
+
+
+def record_event(name, cat, start, wall, cpu, rss_start, args):
+    event = {
+        'name': name,
+        'cat': cat,
+        'ts': start,
+        'wall': wall,
+        'cpu': cpu,
+        'pid': os.getpid(),
+        'tid': threading.get_ident(),
+        'rss_start': rss_start,
+        'rss_end': get_current_rss(),
+        'process_peak_rss': get_peak_rss(),
+        'args': args
+    }
+    line = json.dumps(event, default=str) + '\n'
+    with _lock:
+        _file.write(line)
+        _file.flush()
+
+
+@contextmanager
+def span(name, cat='stage', **args):
+    """Records the time taken by the block as one event.
+    Yields a dict, in which the block can put extra information,
+    such as the number of 'frames' or 'bytes' processed."""
+    if not is_enabled():
+        yield dict()
+        return
+
+    start = time.time()
+    rss0 = get_current_rss()
+    wall0 = time.perf_counter()
+    cpu0 = time.process_time()
+    try:
+        yield args
+    finally:
+        wall = time.perf_counter() - wall0
+        cpu = time.process_time() - cpu0
+        record_event(name, cat, start, wall, cpu, rss0, args)
+
+
+class Accumulator:
+    """Accumulates the time of many short blocks (e.g. decoding each frame
+    of a video) and records them as a single event on close()."""
+
+    def __init__(self, name, cat='video', **args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.count = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.start = time.time()
+        self.rss0 = get_current_rss() if is_enabled() else 0
+
+    def __enter__(self):
+        if is_enabled():
+            self.wall0 = time.perf_counter()
+            self.cpu0 = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        if is_enabled():
+            self.wall += time.perf_counter() - self.wall0
+            self.cpu += time.process_time() - self.cpu0
+            self.count += 1
+
+    def close(self):
+        if is_enabled() and self.count > 0:
+            args = dict(self.args)
+            args.setdefault('frames', self.count)
+            record_event(self.name, self.cat, self.start, self.wall, self.cpu,
+                         self.rss0, args)
+
+
+def file_size(fname):
+    try:
+        return os.path.getsize(fname)
+    except OSError:
+        return 0
+
+
+def load_events(folder):
+    events = []
+    for fname in sorted(glob.glob(os.path.join(folder, 'events-*.jsonl'))):
+        with open(fname, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                try:
+                    events.append(json.loads(line))
+                except ValueError: # partially written by a killed worker
+                    continue
+    return sorted(events, key=lambda e: e['ts'])
+
+
+def write_chrome_trace(events, fname):
+    trace = []
+    for e in events:
+        trace.append({
+            'name': e['name'],
+            'cat': e['cat'],
+            'ph': 'X',
+            'ts': e['ts'] * 1e6,
+            'dur': e['wall'] * 1e6,
+            'pid': e['pid'],
+            'tid': e['tid'],
+            'args': dict(e['args'], cpu=e['cpu'], rss_start=e['rss_start'],
+                         rss_end=e['rss_end'],
+                         process_peak_rss=e['process_peak_rss'])
+        })
+    with open(fname, 'w') as f:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+
+def summarize_events(events):
+    groups = defaultdict(list)
+    for e in events:
+        groups[(e['cat'], e['name'])].append(e)
+
+    rows = []
+    for (cat, name), evs in groups.items():
+        frames = sum([e['args'].get('frames', 0) or 0 for e in evs])
+        nbytes = sum([e['args'].get('bytes', 0) or 0 for e in evs])
+        wall = sum([e['wall'] for e in evs])
+        rows.append({
+            'cat': cat,
+            'name': name,
+            'count': len(evs),
+            'wall': wall,
+            'cpu': sum([e['cpu'] for e in evs]),
+            'frames': frames,
+            'fps': frames / wall if wall > 0 and frames > 0 else None,
+            'mb': nbytes / 2**20,
+            'rss_mb': max([e['rss_end'] for e in evs]) / 2**20,
+            'rss_growth_mb': max([e['rss_end'] - e['rss_start'] for e in evs]) / 2**20,
+            'process_peak_mb': max([e['process_peak_rss'] for e in evs]) / 2**20
+        })
+    return sorted(rows, key=lambda r: -r['wall'])
+
+
+def print_summary(rows):
+    """Prints the summary table. 'RSS MB' is the largest resident memory
+    at the end of a block, 'RSS +MB' the largest growth of resident memory
+    during a block, and 'proc peak MB' the peak memory of the processes
+    running the blocks, since they started."""
+    header = '{:<8} {:<28} {:>6} {:>10} {:>10} {:>10} {:>10} {:>9} {:>9} {:>9} {:>12}'
+    line = '{:<8} {:<28} {:>6} {:>10.2f} {:>10.2f} {:>10} {:>10} {:>9.1f} {:>9.0f} {:>9.0f} {:>12.0f}'
+    print(header.format('category', 'name', 'count', 'wall (s)', 'cpu (s)',
+                        'frames', 'frames/s', 'MB', 'RSS MB', 'RSS +MB', 'proc peak MB'))
+    for r in rows:
+        fps = '' if r['fps'] is None else '{:.1f}'.format(r['fps'])
+        print(line.format(r['cat'], r['name'][:28], r['count'], r['wall'], r['cpu'],
+                          r['frames'] or '', fps, r['mb'], r['rss_mb'],
+                          r['rss_growth_mb'], r['process_peak_mb']))
+
+
+def finish_profiling(config):
+    """Merges the events of all the processes of this run,
+    writes the traces and prints the summary"""
+    global _file, _folder
+    folder = config.get('profile')
+    if folder is None:
+        return
+    if _file is not None:
+        _file.close()
+        _file = None
+        _folder = None
+
+    events = load_events(folder)
+    with open(os.path.join(folder, 'events.jsonl'), 'w') as f:
+        for e in events:
+            f.write(json.dumps(e, default=str) + '\n')
+    for fname in glob.glob(os.path.join(folder, 'events-*.jsonl')):
+        os.remove(fname)
+    write_chrome_trace(events, os.path.join(folder, 'trace.json'))
+
+    print()
+    print('Profile written to {}'.format(folder))
+    print_summary(summarize_events(events))
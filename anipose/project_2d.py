@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import numpy as np
-from glob import glob
 import pandas as pd
 import os.path
 import cv2
@@ -11,28 +10,31 @@ from scipy import signal
 import queue
 import threading
 
-from aniposelib.cameras import CameraGroup
-
 from .common import make_process_fun, get_nframes, \
     get_video_name, get_cam_name, \
     get_video_params, get_video_params_cap, \
-    get_data_length, natural_keys, true_basename, find_calibration_folder
+    get_data_length, natural_keys, true_basename, find_calibration_folder, \
+    load_camera_group
+from .manifest import find_files
+from .pose_io import read_pose_3d, find_pose_3d, get_pose_2d_format, \
+    read_pose_3d_transform
+from .pose_store import read_pose3d_range
 
 from .triangulate import load_offsets_dict
 from .filter_pose import write_pose_2d
+from .scheduler import Task
+from .dependencies import Dependencies, is_up_to_date
 
-def get_projected_points(config, pose_fname, cgroup, offsets_dict):
+def get_projected_points(config, pose_fname, cgroup, offsets_dict, frames=None):
 
-    pose_data = pd.read_csv(pose_fname)
+    if frames is None:
+        pose_data = read_pose_3d(pose_fname)
+    else:
+        pose_data = read_pose3d_range(config, pose_fname, frames[0], frames[1])
     cols = [x for x in pose_data.columns if '_error' in x]
     bodyparts = [c.replace('_error', '') for c in cols]
 
-    M = np.identity(3)
-    center = np.zeros(3)
-    for i in range(3):
-        center[i] = np.mean(pose_data['center_{}'.format(i)])
-        for j in range(3):
-            M[i, j] = np.mean(pose_data['M_{}{}'.format(i, j)])
+    M, center = read_pose_3d_transform(pose_fname)
 
     bp_dict = dict(zip(bodyparts, range(len(bodyparts))))
 
@@ -71,6 +73,27 @@ def get_projected_points(config, pose_fname, cgroup, offsets_dict):
     return bodyparts, points_2d_proj, all_scores
 
 
+def project_2d_trial(config, pose_fname, cgroup, offsets_dict,
+                     cam_names, out_fnames):
+    bodyparts, points_2d_proj, all_scores = get_projected_points(
+        config, pose_fname, cgroup, offsets_dict)
+
+    metadata = {
+        'scorer': 'scorer',
+        'bodyparts': bodyparts,
+        'index': np.arange(points_2d_proj.shape[2])
+    }
+
+    n_cams, n_joints, n_frames, _ = points_2d_proj.shape
+
+    pts = np.zeros((n_frames, n_joints, 3), dtype='float64')
+
+    for cix, (cname, outname) in enumerate(zip(cam_names, out_fnames)):
+        pts[:, :, :2] = points_2d_proj[cix].swapaxes(0, 1)
+        pts[:, :, 2] = all_scores.T
+        write_pose_2d(pts, metadata, outname, get_pose_2d_format(config))
+
+
 def process_session(config, session_path):
     pipeline_videos_raw = config['pipeline']['videos_raw']
     pipeline_pose_3d = config['pipeline']['pose_3d']
@@ -78,12 +101,12 @@ def process_session(config, session_path):
 
     video_ext = config['video_extension']
 
-    vid_fnames_2d = glob(os.path.join(
-        session_path, pipeline_videos_raw, "*."+video_ext))
+    vid_fnames_2d = find_files(
+        config, os.path.join(session_path, pipeline_videos_raw), video_ext)
     vid_fnames_2d = sorted(vid_fnames_2d, key=natural_keys)
 
-    pose_fnames_3d = glob(os.path.join(
-        session_path, pipeline_pose_3d, "*.csv"))
+    pose_fnames_3d = find_pose_3d(
+        config, os.path.join(session_path, pipeline_pose_3d))
     pose_fnames_3d = sorted(pose_fnames_3d, key=natural_keys)
     
     if len(pose_fnames_3d) == 0:
@@ -106,7 +129,7 @@ def process_session(config, session_path):
                                    config['pipeline']['calibration_results'],
                                    'calibration.toml')
         if os.path.exists(calib_fname):
-            cgroup = CameraGroup.load(calib_fname)
+            cgroup = load_camera_group(calib_fname)
 
     if cgroup is None:
         print('session {}: no calibration found, skipping'.format(session_path))
@@ -129,7 +152,9 @@ def process_session(config, session_path):
         out_fnames = [os.path.join(outdir, true_basename(fname) + '.h5')
                       for fname in fnames_2d_current]
 
-        if all([os.path.exists(f) for f in out_fnames]):
+        deps = Dependencies(out_fnames, [pose_fname, calib_fname],
+                            ['triangulation', 'cameras'])
+        if is_up_to_date(config, deps):
             continue
 
         print(pose_fname)
@@ -140,24 +165,10 @@ def process_session(config, session_path):
         video_folder = os.path.join(session_path, pipeline_videos_raw)
         offsets_dict = load_offsets_dict(config, cam_names, video_folder)
 
-        cgroup_subset = cgroup.subset_cameras_names(cam_names)
-
-        bodyparts, points_2d_proj, all_scores = get_projected_points(
-            config, fname_3d_current, cgroup_subset, offsets_dict)
-
-        metadata = {
-            'scorer': 'scorer',
-            'bodyparts': bodyparts,
-            'index': np.arange(points_2d_proj.shape[2])
-        }
-
-        n_cams, n_joints, n_frames, _ = points_2d_proj.shape
-        
-        pts = np.zeros((n_frames, n_joints, 3), dtype='float64')
-        
-        for cix, (cname, outname) in enumerate(zip(cam_names, out_fnames)):
-            pts[:, :, :2] = points_2d_proj[cix].swapaxes(0, 1)
-            pts[:, :, 2] = all_scores.T
-            write_pose_2d(pts, metadata, outname)
+        cgroup_subset = load_camera_group(calib_fname, cam_names)
+
+        yield Task(pose_fname, project_2d_trial,
+                   (config, fname_3d_current, cgroup_subset, offsets_dict,
+                    cam_names, out_fnames), deps)
 
 project_2d_all = make_process_fun(process_session)
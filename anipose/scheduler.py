@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import io
+import sys
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout, redirect_stderr
+from inspect import isgenerator
+from multiprocessing import cpu_count, get_context
+
+from .common import process_all
+from .dependencies import record_build, is_up_to_date
+from . import leases
+from .profiling import setup_profiling, span
+
+## A single unit of work, usually one trial of one stage.
+## process_session functions yield these instead of running each trial
+## themselves, so that the scheduler can fan them out over a process pool.
+## fun(*args) is called to run the task, name is used to report it.
+## If deps is given, the inputs and config of the outputs are recorded
+## once the task succeeds (see dependencies.py)
+## In distributed mode, the task only runs if this node can take the
+## lease for its name within its stage, given by fun (see leases.py)
+Task = namedtuple('Task', ['name', 'fun', 'args', 'deps'], defaults=[None])
+
+## returned by run_task if another node took the task
+SKIPPED = 'skipped'
+
+
+def get_n_workers(config):
+    n_workers = config.get('n_workers', 1)
+    if n_workers is None or n_workers <= 0:
+        n_workers = cpu_count()
+    return n_workers
+
+
+def task_stage(task):
+    return '{}.{}'.format(task.fun.__module__, task.fun.__qualname__)
+
+
+def run_task(config, task):
+    """Runs the task and records its outputs.
+    Returns None if it succeeded, SKIPPED if another node has it,
+    or the traceback as a string if it failed"""
+    setup_profiling(config)
+    with leases.task_lease(config, task.name, task_stage(task)) as claimed:
+        if not claimed:
+            return SKIPPED
+        # another node may have finished it since the session was listed
+        if leases.is_enabled(config) and task.deps is not None and \
+           is_up_to_date(config, task.deps, legacy=lambda: False):
+            return SKIPPED
+        try:
+            with span(task.fun.__name__, 'task', trial=task.name):
+                task.fun(*task.args)
+        except Exception:
+            return traceback.format_exc()
+        record_build(config, task.deps)
+    return None
+
+
+def run_task_captured(config, task):
+    """Runs the task in a worker process, capturing everything it prints
+    so that the output of different trials does not get interleaved"""
+    out = io.StringIO()
+    with redirect_stdout(out), redirect_stderr(out):
+        error = run_task(config, task)
+    return out.getvalue(), error
+
+
+def report_failures(failures):
+    if len(failures) == 0:
+        return
+    print('{} trials failed:'.format(len(failures)))
+    for name in failures:
+        print('  ' + str(name))
+
+
+def process_tasks_serial(config, process_session, **args):
+    failures = []
+
+    def run_session(config, session_path):
+        out = process_session(config, session_path, **args)
+        if not isgenerator(out):
+            return out
+        names = []
+        for task in out:
+            names.append(task.name)
+            error = run_task(config, task)
+            if error == SKIPPED:
+                print('{} taken by another node, skipping'.format(task.name))
+            elif error is not None:
+                print(error, end='', file=sys.stdout)
+                failures.append(task.name)
+        return names
+
+    process_all(config, run_session)
+    report_failures(failures)
+    return failures
+
+
+def process_tasks_parallel(config, process_session, n_workers, **args):
+    tasks = []
+
+    def collect_session(config, session_path):
+        out = process_session(config, session_path, **args)
+        if not isgenerator(out):
+            return out
+        session_tasks = list(out)
+        tasks.extend(session_tasks)
+        return [task.name for task in session_tasks]
+
+    process_all(config, collect_session)
+
+    if len(tasks) == 0:
+        return []
+
+    n_workers = min(n_workers, len(tasks))
+    print('running {} tasks on {} workers'.format(len(tasks), n_workers))
+
+    failures = []
+    ctx = get_context('spawn')
+    with ProcessPoolExecutor(n_workers, mp_context=ctx) as pool:
+        futures = dict()
+        for ix, task in enumerate(tasks):
+            futures[pool.submit(run_task_captured, config, task)] = ix
+
+        for future in as_completed(futures):
+            task = tasks[futures[future]]
+            try:
+                text, error = future.result()
+            except Exception:
+                # the worker itself died (e.g. out of memory)
+                text, error = '', traceback.format_exc()
+
+            if error == SKIPPED:
+                print('-- {} taken by another node, skipping'.format(task.name))
+                continue
+
+            print('-- {}'.format(task.name))
+            if len(text) > 0:
+                print(text, end='' if text.endswith('\n') else '\n')
+            if error is not None:
+                print(error, end='')
+                failures.append(futures[future])
+
+    failures = [tasks[ix].name for ix in sorted(failures)]
+    report_failures(failures)
+    return failures
+
+
+def process_tasks(config, process_session, **args):
+    """Walks over all the sessions like process_all. If process_session
+    yields Tasks, these are run either right away (n_workers = 1) or
+    distributed over a pool of n_workers processes once all sessions have
+    been walked. Failures of individual tasks are reported at the end
+    instead of stopping the run, and their names are returned."""
+    n_workers = get_n_workers(config)
+    if n_workers <= 1:
+        return process_tasks_serial(config, process_session, **args)
+    else:
+        return process_tasks_parallel(config, process_session, n_workers, **args)
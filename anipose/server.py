@@ -5,7 +5,6 @@ from flask import request, safe_join, send_from_directory
 from flask_compress import Compress
 from flask_ipban import IpBan
 
-from glob import glob
 import os
 from collections import deque, defaultdict
 import re
@@ -18,11 +17,14 @@ import numpy as np
 
 from .anipose import load_config
 from .common import find_calibration_folder, \
-    get_video_name, get_cam_name, natural_keys, true_basename
+    get_video_name, get_cam_name, natural_keys, true_basename, get_video_params, \
+    load_camera_group
+from .manifest import find_files, find_folders
+from .pose_io import read_pose_3d, pose_3d_fname
+from .pose_store import read_pose3d_range
 from .project_2d import get_projected_points
 from .triangulate import load_offsets_dict
 
-from aniposelib.cameras import CameraGroup
 import toml
 import json
 
@@ -50,13 +52,9 @@ ip_ban.init_app(app)
 ip_ban.load_nuisances()
 
 def get_video_fnames(config, session_path):
-    fnames = glob(safe_join(session_path, config['pipeline']['videos_raw_mp4'], '*.mp4'))
+    fnames = find_files(config, safe_join(session_path, config['pipeline']['videos_raw_mp4']), 'mp4')
     return fnames
 
-def get_folders(path):
-    folders = next(os.walk(path))[1]
-    return sorted(folders)
-
 def generate_token(length): 
     letters = string.ascii_letters + '_'
     token = ''.join(random.choice(letters) for i in range(length))
@@ -71,7 +69,7 @@ def process_all(config, source_dir, process_session, **args):
     if x is not None:
         output[()] = x
 
-    folders = get_folders(pipeline_prefix)
+    folders = find_folders(config, pipeline_prefix)
     level = 1
 
     q = deque()
@@ -89,7 +87,7 @@ def process_all(config, source_dir, process_session, **args):
         if x is not None:
             output[past_folders] = x
 
-        folders = get_folders(path)
+        folders = find_folders(config, path)
         next_folders = [ (safe_join(path, folder),
                           past_folders + (folder,),
                           level+1)
@@ -137,19 +135,28 @@ def get_config(session, append_prefix=True):
     config = load_config(config_fname)
     return config
 
-def load_2d_projections(session, folders, fname):
+def get_frame_range():
+    """Range of frames requested with the start and end query arguments,
+    or None for the whole trial"""
+    start = request.args.get('start', type=int)
+    end = request.args.get('end', type=int)
+    if start is None and end is None:
+        return None
+    return (start or 0, end)
+
+def load_2d_projections(session, folders, fname, frames=None):
     config = get_config(session)
 
     pipeline_calibration_videos = config.get('pipeline', {}).get('calibration_videos', 'calibration')
     search_path = os.path.normpath(safe_join(prefix, session, *folders))
     calib_folder = find_calibration_folder(config, search_path) 
     calib_fname = safe_join(calib_folder, pipeline_calibration_videos, "calibration.toml")
-    cgroup = CameraGroup.load(os.path.normpath(calib_fname))
+    cgroup = load_camera_group(os.path.normpath(calib_fname))
 
     offsets_dict = load_offsets_dict(config, cgroup.get_names())
 
     bodyparts, points_2d_proj, all_scores = get_projected_points(
-        config, fname, cgroup, offsets_dict)
+        config, fname, cgroup, offsets_dict, frames)
 
     cam_names = cgroup.get_names()
 
@@ -214,14 +221,17 @@ def get_3d(session, folders, filename):
     config = get_config(session)
     folders = folders.split('|')
     path = safe_join(prefix, session, *folders)
-    path = safe_join(path, 'pose-3d', filename + '.csv')
+    path = pose_3d_fname(config, safe_join(path, 'pose-3d'), filename)
     path = os.path.normpath(path)
-    data = pd.read_csv(path)
 
-    cols = [x for x in data.columns if '_error' in x]
     # bodyparts = sorted([c.replace('_error', '') for c in cols])
-    config = get_config(session)
     bodyparts = get_bodyparts_scheme(config['labeling']['scheme'])
+    columns = [bp + '_' + c for bp in bodyparts for c in ['x', 'y', 'z', 'error']]
+    frames = get_frame_range()
+    if frames is None:
+        data = read_pose_3d(path, columns)
+    else:
+        data = read_pose3d_range(config, path, frames[0], frames[1], columns)
 
     vecs = []
     for bp in bodyparts:
@@ -251,9 +261,9 @@ def get_2d_proj(session, folders, filename):
 
     folders = folders.split('|')
     path = os.path.normpath(safe_join(prefix, session))
-    fname = safe_join(path, *folders, 'pose-3d', filename + '.csv')
+    fname = pose_3d_fname(get_config(session), safe_join(path, *folders, 'pose-3d'), filename)
 
-    projs = load_2d_projections(session, folders, fname)
+    projs = load_2d_projections(session, folders, fname, get_frame_range())
     return jsonify(projs)
 
 def get_bodyparts_scheme(scheme):
@@ -410,9 +420,7 @@ def get_framerate(session, folders, filename):
     config = get_config(session)
     path = safe_join(prefix, session, folders.replace('|', '/'),
                      config['pipeline']['videos_raw_mp4'], filename + '.mp4')
-    cap = cv2.VideoCapture(path)
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    cap.release()
+    fps = get_video_params(path)['fps']
     print(path, fps)
     return jsonify(fps)
 
@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import numpy as np
-from glob import glob
 import pandas as pd
 import os.path
 from tqdm import tqdm, trange
@@ -10,35 +9,36 @@ from collections import defaultdict
 from pprint import pprint
 
 from .common import process_all, true_basename, natural_keys, get_cam_name
+from .manifest import find_files
+from .pose_io import read_pose_3d, find_pose_3d
+from .atomic import atomic_output
 
 def get_angle_fnames(config, session_path):
-    fnames = glob(os.path.join(session_path,
-                               config['pipeline']['angles'],
-                               '*.csv'))
+    fnames = find_files(config, os.path.join(session_path,
+                                             config['pipeline']['angles']),
+                        'csv')
     return fnames
 
 def get_pose3d_fnames(config, session_path):
-    fnames = glob(os.path.join(session_path,
-                               config['pipeline']['pose_3d'],
-                               '*.csv'))
+    fnames = find_pose_3d(config, os.path.join(session_path,
+                                               config['pipeline']['pose_3d']))
     return fnames
 
 def get_pose3d_filtered_fnames(config, session_path):
-    fnames = glob(os.path.join(session_path,
-                               config['pipeline']['pose_3d_filter'],
-                               '*.csv'))
+    fnames = find_pose_3d(config, os.path.join(session_path,
+                                               config['pipeline']['pose_3d_filter']))
     return fnames
 
 def get_pose2d_fnames(config, session_path):
-    fnames = glob(os.path.join(session_path,
-                               config['pipeline']['pose_2d'],
-                               '*.h5'))
+    fnames = find_files(config, os.path.join(session_path,
+                                             config['pipeline']['pose_2d']),
+                        'h5')
     return fnames
 
 def get_pose2d_filtered_fnames(config, session_path):
-    fnames = glob(os.path.join(session_path,
-                               config['pipeline']['pose_2d_filter'],
-                               '*.h5'))
+    fnames = find_files(config, os.path.join(session_path,
+                                             config['pipeline']['pose_2d_filter']),
+                        'h5')
     return fnames
 
 def make_summarize_fun(get_fnames_session, output_fname, h5=False):
@@ -56,6 +56,8 @@ def make_summarize_fun(get_fnames_session, output_fname, h5=False):
                     d = pd.read_hdf(fname)
                     scorer = d.columns.levels[0][0]
                     d = d[scorer]
+                elif fname.endswith('.npz'):
+                    d = read_pose_3d(fname)
                 else:
                     d = pd.read_csv(fname)
 
@@ -77,12 +79,14 @@ def make_summarize_fun(get_fnames_session, output_fname, h5=False):
         outname = os.path.join(outdir, output_fname)
 
         print('Saving output...')
-        dout.to_csv(outname, index=False)
+        with atomic_output(outname) as tmp_fname:
+            dout.to_csv(tmp_fname, index=False)
 
         if h5:
             basename = true_basename(outname)
             outfull_new = os.path.join(outdir, basename+'.h5')
-            dout.to_hdf(outfull_new, 'df_with_missing', format='table', mode='w')
+            with atomic_output(outfull_new) as tmp_fname:
+                dout.to_hdf(tmp_fname, key='df_with_missing', format='table', mode='w')
 
     return summarize_fun
 
@@ -133,4 +137,5 @@ def summarize_errors(config):
     outname = os.path.join(outdir, 'errors.csv')
 
     print('Saving output...')
-    dout.to_csv(outname, index=False)
+    with atomic_output(outname) as tmp_fname:
+        dout.to_csv(tmp_fname, index=False)
@@ -9,20 +9,10 @@ from glob import glob
 from collections import defaultdict
 import pandas as pd
 
-from .common import get_folders, true_basename, get_video_name
+from .common import get_folders, true_basename, get_video_name, load_camera_group
 from .triangulate import load_offsets_dict, load_pose2d_fnames
 from .compute_angles import get_angles
-
-from aniposelib.cameras import CameraGroup
-
-def get_transform(row):
-    M = np.identity(3)
-    center = np.zeros(3)
-    for i in range(3):
-        center[i] = np.mean(row['center_{}'.format(i)])
-        for j in range(3):
-            M[i, j] = np.mean(row['M_{}{}'.format(i, j)])
-    return M, center
+from .pose_io import read_pose_3d, pose_3d_fname, read_pose_3d_transform
 
 ## TODO: handle missing cameras
 def get_errors_group(config, group, scorer=None):
@@ -81,11 +71,12 @@ def get_errors_group(config, group, scorer=None):
         fnum = row['framenum']
         prefix = os.path.dirname(os.path.dirname(fname))
         vidname = get_video_name(config, fname)
-        pose_path = os.path.join(prefix, pipeline_pose_3d, vidname + '.csv')
+        pose_path = pose_3d_fname(config, os.path.join(prefix, pipeline_pose_3d), vidname)
         paths_3d.append(pose_path)
         if curr_path != pose_path:
-            curr_pose = pd.read_csv(pose_path)
+            curr_pose = read_pose_3d(pose_path)
             curr_fnum = np.array(curr_pose['fnum'])
+            M, center = read_pose_3d_transform(pose_path)
             curr_path = pose_path
         try:
             ix = np.where(curr_fnum == fnum)[0][0]
@@ -93,7 +84,6 @@ def get_errors_group(config, group, scorer=None):
             print("W: frame {} not found in 3D data for video {}".format(fnum, fname))
             continue
         row = curr_pose.iloc[ix]
-        M, center = get_transform(row)
         pts = np.array([(row[bp+'_x'], row[bp+'_y'], row[bp+'_z']) for bp in bodyparts])
         pts_t = (pts + center).dot(np.linalg.inv(M.T))
         points_3d_pred[i] = pts_t
@@ -107,8 +97,7 @@ def get_errors_group(config, group, scorer=None):
         calib_fname = calib_fnames[i]
         if curr_calib_fname != calib_fname:
             print(calib_fname)
-            curr_cgroup = CameraGroup.load(calib_fname)
-            curr_cgroup = curr_cgroup.subset_cameras_names(cam_names)
+            curr_cgroup = load_camera_group(calib_fname, cam_names)
             print(curr_cgroup.get_names())
             curr_calib_fname = calib_fname
         pts = points_labeled[:, i]
@@ -1,21 +1,36 @@
 #!/usr/bin/env python3
 
-from tqdm import trange
+from tqdm import tqdm, trange
+from multiprocessing import cpu_count, get_context
 import numpy as np
 from collections import defaultdict
 import os
 import os.path
+import time
+import hashlib
+import json
 import pandas as pd
 import toml
 from numpy import array as arr
-from glob import glob
 from scipy import optimize
 import cv2
 
-from .common import make_process_fun, find_calibration_folder, \
-    get_video_name, get_cam_name, natural_keys
-
-from aniposelib.cameras import CameraGroup
+from .common import make_process_fun, find_calibration_folder, process_all, \
+    load_camera_group, get_video_name, get_cam_name, natural_keys, get_data_length
+from .manifest import find_files
+from .pose_io import write_pose_3d, write_pose_3d_chunks, pose_3d_fname
+from .atomic import atomic_output, temp_fname
+from .dlt import get_triangulation_engine, triangulate_batched, \
+    triangulate_ransac_batched
+from .checkpoint import checkpoint_key, save_checkpoint, load_checkpoint, \
+    remove_checkpoint
+from .pose_store import read_pose2d_range
+from .undistorted import get_undistorted, iter_undistorted_chunks
+from .profiling import span, file_size
+from .scheduler import Task, get_n_workers
+from .dependencies import Dependencies, is_up_to_date
+
+from aniposelib.cameras import interpolate_data, medfilt_data
 
 def proj(u, v):
     """Project u onto v"""
@@ -31,8 +46,10 @@ def get_median(all_points_3d, ix):
     return np.median(pts, axis=0)
 
 
-def correct_coordinate_frame(config, all_points_3d, bodyparts):
-    """Given a config and a set of points and bodypart names, this function will rotate the coordinate frame to match the one in config"""
+def get_coordinate_frame(config, all_points_3d, bodyparts):
+    """Rotation matrix and center of the coordinate frame specified in config,
+    estimated from all_points_3d of shape (frames, bodyparts, 3). Only the
+    bodyparts of the axes are read, so it may be a memory-mapped array."""
     bp_index = dict(zip(bodyparts, range(len(bodyparts))))
     axes_mapping = dict(zip('xyz', range(3)))
 
@@ -69,40 +86,298 @@ def correct_coordinate_frame(config, all_points_3d, bodyparts):
 
     M /= np.linalg.norm(M, axis=1)[:,None]
 
-    center = get_median(all_points_3d, bp_index[ref_point])
+    ref_points = np.asarray(all_points_3d[:, [bp_index[ref_point]]])
+    center_new = get_median(ref_points.dot(M.T), 0)
+
+    return M, center_new
 
-    all_points_3d_adj = all_points_3d.dot(M.T)
-    center_new = get_median(all_points_3d_adj, bp_index[ref_point])
-    all_points_3d_adj = all_points_3d_adj - center_new
 
+def correct_coordinate_frame(config, all_points_3d, bodyparts):
+    """Given a config and a set of points and bodypart names, this function will rotate the coordinate frame to match the one in config"""
+    M, center_new = get_coordinate_frame(config, all_points_3d, bodyparts)
+    all_points_3d_adj = all_points_3d.dot(M.T) - center_new
     return all_points_3d_adj, M, center_new
 
 
-def load_pose2d_fnames(fname_dict, offsets_dict=None, cam_names=None):
+## The coordinate frame is normally estimated from each trial on its own.
+## With coordinate_frame = "calibration" in the [triangulation] section, it is
+## estimated once per calibration folder instead, from frames sampled evenly
+## across all the trials of all the sessions using it, and cached in
+## coordinate_frame.toml next to calibration.toml. It is estimated while
+## listing the sessions, and the triangulation tasks only load it. It is
+## estimated again when the calibration, the axes, the reference point or
+## the 2d pose files it was estimated from change.
+
+COORDINATE_FRAME_SOURCES = ['trial', 'calibration']
+
+## maximum number of frames of each trial used to estimate the frame,
+## read as this many evenly spaced blocks of consecutive frames
+FRAME_SAMPLE_FRAMES = 1000
+FRAME_SAMPLE_BLOCKS = 10
+
+
+def has_coordinate_frame(config):
+    return 'reference_point' in config['triangulation'] and 'axes' in config['triangulation']
+
+
+def get_coordinate_frame_source(config):
+    source = config['triangulation']['coordinate_frame']
+    if source not in COORDINATE_FRAME_SOURCES:
+        raise ValueError('triangulation.coordinate_frame should be one of {}, got "{}"'.format(
+            COORDINATE_FRAME_SOURCES, source))
+    return source
+
+
+def use_calibration_frame(config):
+    return has_coordinate_frame(config) and \
+        get_coordinate_frame_source(config) == 'calibration'
+
+
+def coordinate_frame_fname(calib_folder):
+    return os.path.join(calib_folder, 'coordinate_frame.toml')
+
+
+def coordinate_frame_inputs(config, calib_folder):
+    """Extra inputs of the outputs triangulated with config"""
+    if use_calibration_frame(config):
+        return [coordinate_frame_fname(calib_folder)]
+    return []
+
+
+def coordinate_frame_key(config, calib_folder):
+    h = hashlib.sha1()
+    with open(os.path.join(calib_folder, 'calibration.toml'), 'rb') as f:
+        h.update(f.read())
+    spec = [config['triangulation'][key] for key in
+            ['reference_point', 'axes', 'score_threshold', 'engine']]
+    h.update(json.dumps(spec).encode('utf8'))
+    return h.hexdigest()
+
+
+def coordinate_frame_sources(config, trials):
+    """Size and mtime of the 2d pose files of trials, by path relative to the
+    project, to check later that the frame was estimated from these files"""
+    sources = dict()
+    for fname_dict, _ in trials:
+        for fname in fname_dict.values():
+            st = os.stat(fname)
+            relpath = os.path.relpath(os.path.abspath(fname), config['path'])
+            sources[relpath] = [st.st_size, st.st_mtime_ns]
+    return sources
+
+
+def sources_unchanged(config, sources):
+    for relpath, state in sources.items():
+        try:
+            st = os.stat(os.path.join(config['path'], relpath))
+        except OSError:
+            return False
+        if [st.st_size, st.st_mtime_ns] != list(state):
+            return False
+    return True
+
+
+def load_coordinate_frame(config, calib_folder):
+    """The cached (M, center) of calib_folder, or None if there is none or
+    it is out of date. The cache is valid for any trial using calib_folder,
+    as long as the 2d pose files it was estimated from are unchanged."""
+    fname = coordinate_frame_fname(calib_folder)
+    try:
+        frame = toml.load(fname)
+    except (OSError, ValueError):
+        return None
+    if frame.get('key') != coordinate_frame_key(config, calib_folder):
+        return None
+    sources = frame.get('sources', dict())
+    if len(sources) == 0 or not sources_unchanged(config, sources):
+        return None
+    return np.array(frame['M'], dtype='float64'), np.array(frame['center'], dtype='float64')
+
+
+def sample_pose2d_frames(fname_dict, offsets_dict, cam_names):
+    """2d pose of up to FRAME_SAMPLE_FRAMES frames of one trial, as
+    load_pose2d_fnames would return it, reading only these frames"""
+    n_frames = min([get_data_length(fname_dict[cname]) for cname in cam_names])
+    if n_frames <= FRAME_SAMPLE_FRAMES:
+        ranges = [(0, n_frames)]
+    else:
+        block = FRAME_SAMPLE_FRAMES // FRAME_SAMPLE_BLOCKS
+        starts = np.linspace(0, n_frames - block, FRAME_SAMPLE_BLOCKS).astype('int64')
+        ranges = [(start, start + block) for start in starts]
+
+    parts = []
+    for start, stop in ranges:
+        dlabs_dict = dict([(cname, pd.read_hdf(fname_dict[cname], start=start, stop=stop))
+                           for cname in cam_names])
+        parts.append(load_pose2d_dataframes(dlabs_dict, offsets_dict, cam_names))
+    out = parts[0]
+    out['points'] = np.concatenate([p['points'] for p in parts], axis=1)
+    out['scores'] = np.concatenate([p['scores'] for p in parts], axis=1)
+    return out
+
+
+def estimate_coordinate_frame(config, calib_folder, trials):
+    """Coordinate frame estimated from the frames sampled from trials,
+    a list of (fname_dict, offsets_dict), pooled together"""
+    ref_point = config['triangulation']['reference_point']
+    frame_bps = [ref_point]
+    for _, bp_l, bp_r in config['triangulation']['axes']:
+        frame_bps += [bp_l, bp_r]
+    frame_bps = sorted(set(frame_bps))
+
+    calib_fname = os.path.join(calib_folder, 'calibration.toml')
+    pooled = []
+    for fname_dict, offsets_dict in trials:
+        cam_names = sorted(fname_dict.keys())
+        cgroup = load_camera_group(calib_fname, cam_names)
+        pose_2d = sample_pose2d_frames(fname_dict, offsets_dict, cam_names)
+        bp_index = dict(zip(pose_2d['bodyparts'], range(len(pose_2d['bodyparts']))))
+        ixs = [bp_index[bp] for bp in frame_bps]
+
+        points = pose_2d['points'][:, :, ixs]
+        scores = pose_2d['scores'][:, :, ixs]
+        points[scores < config['triangulation']['score_threshold']] = np.nan
+        n_cams, n_frames = points.shape[:2]
+
+        p3d = triangulate_dlt(config, cgroup, points.reshape(n_cams, -1, 2),
+                              progress=False, scores=scores.reshape(n_cams, -1))
+        pooled.append(p3d.reshape(n_frames, len(frame_bps), 3))
+
+    pooled = np.concatenate(pooled, axis=0)
+    M, center = get_coordinate_frame(config, pooled, frame_bps)
+    return M, center, pooled.shape[0]
+
+
+def session_trials(config, session_path, pipeline_pose):
+    """(fname_dict, offsets_dict) of each trial of the session, from the
+    2d pose files in its pipeline_pose folder, in order of the trial names"""
+    pose_files = find_files(config, os.path.join(session_path, config['pipeline'][pipeline_pose]), 'h5')
+    video_folder = os.path.join(session_path, config['pipeline']['videos_raw'])
+
+    cam_videos = defaultdict(list)
+    for pf in pose_files:
+        cam_videos[get_video_name(config, pf)].append(pf)
+
+    trials = []
+    for name in sorted(cam_videos.keys(), key=natural_keys):
+        fnames = cam_videos[name]
+        cam_names = [get_cam_name(config, f) for f in fnames]
+        trials.append((dict(zip(cam_names, fnames)),
+                       load_offsets_dict(config, sorted(cam_names), video_folder)))
+    return trials
+
+
+def calibration_trials(config, calib_folder, pipeline_pose):
+    """Trials of all the sessions of the project using calib_folder,
+    in order of the session paths (so not depending on the walk order)"""
+    def process_session(config, session_path):
+        calibration_path = find_calibration_folder(config, session_path)
+        if calibration_path is None:
+            return []
+        folder = os.path.join(calibration_path, config['pipeline']['calibration_results'])
+        if os.path.abspath(folder) != os.path.abspath(calib_folder):
+            return []
+        return session_trials(config, session_path, pipeline_pose)
+
+    output = process_all(config, process_session)
+    trials = []
+    for key in sorted(output.keys()):
+        trials.extend(output[key] or [])
+    return trials
+
+
+def get_calibration_frame(config, calib_folder, pipeline_pose):
+    """The coordinate frame of calib_folder, from its cache if it is up to
+    date, or else estimated from the 2d pose in the pipeline_pose folders of
+    all the sessions using it (see estimate_coordinate_frame) and cached.
+    Returns (M, center), or None if these sessions have no trials."""
+    frame = load_coordinate_frame(config, calib_folder)
+    if frame is not None:
+        return frame
+
+    trials = calibration_trials(config, calib_folder, pipeline_pose)
+    if len(trials) == 0:
+        return None
+
+    with span('estimate_coordinate_frame', 'compute') as info:
+        M, center, n_frames = estimate_coordinate_frame(config, calib_folder, trials)
+        info['frames'] = n_frames
+    print('estimated coordinate frame from {} frames of {} trials'.format(
+        n_frames, len(trials)))
+
+    out = {
+        'key': coordinate_frame_key(config, calib_folder),
+        'M': M.tolist(),
+        'center': center.tolist(),
+        'n_frames': int(n_frames),
+        'n_trials': len(trials),
+        'sources': coordinate_frame_sources(config, trials)
+    }
+    fname = coordinate_frame_fname(calib_folder)
+    with atomic_output(fname) as tmp_fname:
+        with open(tmp_fname, 'w') as f:
+            toml.dump(out, f)
+    return M, center
+
+
+def load_pose2d_fnames(fname_dict, offsets_dict=None, cam_names=None,
+                       frames=None, config=None, dtype='float64'):
+    """Loads the 2d pose of one trial from the files in fname_dict.
+    frames may be a (start, end) range of frames to load; with a config, these
+    are read from the chunked pose store of the project instead of loading
+    the whole files. dtype may be 'float32' to halve the memory used."""
     if cam_names is None:
         cam_names = sorted(fname_dict.keys())
-    pose_names = [fname_dict[cname] for cname in cam_names]
+    if frames is not None:
+        start, end = frames
+        if config is not None:
+            return read_pose2d_range(config, fname_dict, offsets_dict, cam_names,
+                                     start, end, dtype)
+        out = load_pose2d_fnames(fname_dict, offsets_dict, cam_names, dtype=dtype)
+        out['points'] = out['points'][:, start:end]
+        out['scores'] = out['scores'][:, start:end]
+        return out
+    nbytes = sum([file_size(fname_dict[cname]) for cname in cam_names])
+    with span('load_pose2d_fnames', 'io', bytes=nbytes) as info:
+        dlabs_dict = dict([(cname, pd.read_hdf(fname_dict[cname]))
+                           for cname in cam_names])
+        out = load_pose2d_dataframes(dlabs_dict, offsets_dict, cam_names, dtype)
+        info['frames'] = out['points'].shape[1]
+    return out
+
+
+def get_pose2d_columns(columns, joint_names):
+    """Positions of the x, y and likelihood columns of each joint in the columns
+    of a 2d pose table (without the scorer level), -1 for missing ones.
+    Returns an int array of shape (joints, 3)."""
+    bp_index = columns.names.index('bodyparts')
+    coord_index = columns.names.index('coords')
+    positions = dict()
+    for i, col in enumerate(columns):
+        positions.setdefault((col[bp_index], col[coord_index]), i)
+    return np.array([[positions.get((joint, coord), -1)
+                      for coord in ['x', 'y', 'likelihood']]
+                     for joint in joint_names])
+
+
+def load_pose2d_dataframes(dlabs_dict, offsets_dict=None, cam_names=None,
+                           dtype='float64'):
+    """Like load_pose2d_fnames, but from 2d pose tables already in memory"""
+    if cam_names is None:
+        cam_names = sorted(dlabs_dict.keys())
 
     if offsets_dict is None:
         offsets_dict = dict([(cname, (0,0)) for cname in cam_names])
 
     datas = []
-    for ix_cam, (cam_name, pose_name) in \
-            enumerate(zip(cam_names, pose_names)):
-        dlabs = pd.read_hdf(pose_name)
+    for cam_name in cam_names:
+        dlabs = dlabs_dict[cam_name]
         if len(dlabs.columns.levels) > 2:
             scorer = dlabs.columns.levels[0][0]
             dlabs = dlabs.loc[:, scorer]
 
         bp_index = dlabs.columns.names.index('bodyparts')
         joint_names = list(dlabs.columns.get_level_values(bp_index).unique())
-        dx = offsets_dict[cam_name][0]
-        dy = offsets_dict[cam_name][1]
-
-        for joint in joint_names:
-            dlabs.loc[:, (joint, 'x')] += dx
-            dlabs.loc[:, (joint, 'y')] += dy
-
         datas.append(dlabs)
 
     n_cams = len(cam_names)
@@ -110,16 +385,19 @@ def load_pose2d_fnames(fname_dict, offsets_dict=None, cam_names=None):
     n_frames = min([d.shape[0] for d in datas])
 
     # frame, camera, bodypart, xy
-    points = np.full((n_cams, n_frames, n_joints, 2), np.nan, 'float')
-    scores = np.full((n_cams, n_frames, n_joints), np.zeros(1), 'float')#initialise as zeros, instead of NaN, makes more sense? 
-
-    for cam_ix, dlabs in enumerate(datas):
-        for joint_ix, joint_name in enumerate(joint_names):
-            try:
-                points[cam_ix, :, joint_ix] = np.array(dlabs.loc[:, (joint_name, ('x', 'y'))])[:n_frames] 
-                scores[cam_ix, :, joint_ix] = np.array(dlabs.loc[:, (joint_name, ('likelihood'))])[:n_frames].ravel()
-            except KeyError:
-                pass
+    points = np.full((n_cams, n_frames, n_joints, 2), np.nan, dtype)
+    scores = np.zeros((n_cams, n_frames, n_joints), dtype)
+
+    for cam_ix, (cam_name, dlabs) in enumerate(zip(cam_names, datas)):
+        ## select the columns by position on the underlying array,
+        ## joints missing from this camera are left as nan
+        cols = get_pose2d_columns(dlabs.columns, joint_names)
+        found = np.all(cols >= 0, axis=1)
+        values = dlabs.to_numpy(dtype='float64')[:n_frames]
+        xyl = values[:, cols[found].ravel()].reshape(n_frames, np.sum(found), 3)
+        xyl[:, :, :2] += offsets_dict[cam_name]
+        points[cam_ix][:, found] = xyl[:, :, :2]
+        scores[cam_ix][:, found] = xyl[:, :, 2]
 
     return {
         'cam_names': cam_names,
@@ -167,29 +445,258 @@ def load_constraints(config, bodyparts, key='constraints'):
     return constraints
 
 
-def triangulate(config,
-                calib_folder, video_folder, pose_folder,
-                fname_dict, output_fname):
-
-    cam_names = sorted(fname_dict.keys())
-
-    calib_fname = os.path.join(calib_folder, 'calibration.toml')
-    cgroup = CameraGroup.load(calib_fname)
-
-    offsets_dict = load_offsets_dict(config, cam_names, video_folder)
-
-    out = load_pose2d_fnames(fname_dict, offsets_dict, cam_names)
-    all_points_raw = out['points']
-    all_scores = out['scores']
-    bodyparts = out['bodyparts']
-
-    cgroup = cgroup.subset_cameras_names(cam_names)
+def optim_points(config, cgroup, points_2d, points_3d_init,
+                 constraints, constraints_weak, scale_smooth=None, verbose=True,
+                 max_nfev=None):
+    """Runs cgroup.optim_points with the parameters in config, stopping after
+    max_nfev evaluations of the residuals if given"""
+    if scale_smooth is None:
+        scale_smooth = config['triangulation']['scale_smooth']
+    if max_nfev is not None:
+        return optim_points_capped(config, cgroup, points_2d, points_3d_init,
+                                   constraints, constraints_weak, scale_smooth,
+                                   max_nfev)
+    return cgroup.optim_points(
+        points_2d, points_3d_init,
+        constraints=constraints,
+        constraints_weak=constraints_weak,
+        # scores=scores_2d,
+        scale_smooth=scale_smooth,
+        scale_length=config['triangulation']['scale_length'],
+        scale_length_weak=config['triangulation']['scale_length_weak'],
+        n_deriv_smooth=config['triangulation']['n_deriv_smooth'],
+        reproj_error_threshold=config['triangulation']['reproj_error_threshold'],
+        verbose=verbose)
+
+
+def optim_points_capped(config, cgroup, points_2d, points_3d_init,
+                        constraints, constraints_weak, scale_smooth, max_nfev):
+    """Same as cgroup.optim_points, with at most max_nfev evaluations.
+    CameraGroup.optim_points has no iteration limit, so this runs the same
+    least squares problem with the residuals and jacobian sparsity of
+    aniposelib."""
+    t = config['triangulation']
+    constraints = np.array(constraints)
+    constraints_weak = np.array(constraints_weak)
+
+    points_intp = np.apply_along_axis(interpolate_data, 0, points_3d_init)
+    x0 = cgroup._initialize_params_triangulation(
+        points_intp, constraints, constraints_weak)
+    x0[~np.isfinite(x0)] = 0
+    jac = cgroup._jac_sparsity_triangulation(
+        points_2d, constraints, constraints_weak, t['n_deriv_smooth'])
+
+    opt = optimize.least_squares(
+        cgroup._error_fun_triangulation, x0=x0, jac_sparsity=jac,
+        loss='linear', ftol=1e-3, max_nfev=max_nfev,
+        args=(points_2d, constraints, constraints_weak, None,
+              scale_smooth * get_default_smooth(points_3d_init),
+              t['scale_length'], t['scale_length_weak'],
+              t['reproj_error_threshold'], 'soft_l1', t['n_deriv_smooth'], None))
+    return opt.x[:points_3d_init.size].reshape(points_3d_init.shape)
+
+
+def get_default_smooth(points_3d):
+    """Scale of the smoothness term that cgroup.optim_points derives from
+    the initial 3d points, multiplied by scale_smooth"""
+    points_intp = np.apply_along_axis(interpolate_data, 0, points_3d)
+    points_med = np.apply_along_axis(medfilt_data, 0, points_intp, size=7)
+    return 1.0/np.mean(np.abs(np.diff(points_med, axis=0)))
+
+
+def get_optim_windows(n_frames, window, overlap):
+    """Windows (start, end) of window frames covering n_frames frames,
+    overlapping by at least overlap frames"""
+    overlap = min(overlap, window // 2)
+    if n_frames <= window:
+        return [(0, n_frames)]
+    starts = [0]
+    while starts[-1] + window < n_frames:
+        starts.append(starts[-1] + window - overlap)
+    starts[-1] = n_frames - window
+    return [(start, start + window) for start in starts]
+
+
+def optim_window_wrapper(args):
+    config, cgroup, start, points_2d, points_3d_init, \
+        constraints, constraints_weak, scale_smooth, max_nfev = args
+    c = np.isfinite(points_3d_init[:, :, 0])
+    if np.sum(c) < 20:
+        return start, points_3d_init
+    points_3d = optim_points(config, cgroup, points_2d, points_3d_init,
+                             constraints, constraints_weak,
+                             scale_smooth=scale_smooth, verbose=False,
+                             max_nfev=max_nfev)
+    return start, points_3d
+
+
+def optim_points_windowed(config, cgroup, points_2d, points_3d_init,
+                          constraints, constraints_weak, default_smooth=None,
+                          max_nfev=None):
+    """Same as optim_points, but optimizes overlapping windows of
+    triangulation.optim_window frames in parallel, and blends the overlaps
+    linearly. The smoothness scale is computed over the whole trial (or given
+    as default_smooth), so the windows all weigh smoothness the same as a
+    single optimization would."""
+    n_cams, n_frames, n_joints, _ = points_2d.shape
+    windows = get_optim_windows(n_frames, config['triangulation']['optim_window'],
+                                config['triangulation']['optim_overlap'])
+
+    if default_smooth is None:
+        default_smooth = get_default_smooth(points_3d_init)
+    iterable = []
+    for start, end in windows:
+        scale = config['triangulation']['scale_smooth'] * default_smooth \
+            / get_default_smooth(points_3d_init[start:end])
+        iterable.append((config, cgroup, start,
+                         np.ascontiguousarray(points_2d[:, start:end]),
+                         points_3d_init[start:end], constraints, constraints_weak,
+                         scale, max_nfev))
+
+    ## trials may already run in parallel on n_workers processes,
+    ## which share the cpus with the processes of each trial
+    n_proc_default = cpu_count() // (2 * get_n_workers(config))
+    n_proc_default = max(min(n_proc_default, len(windows)), 1)
+    n_proc = config['triangulation'].get('optim_n_proc', n_proc_default)
+    results = dict()
+    if n_proc > 1:
+        ctx = get_context('spawn')
+        with ctx.Pool(n_proc) as pool:
+            outputs = pool.imap_unordered(optim_window_wrapper, iterable)
+            for start, points_3d in tqdm(outputs, total=len(windows), ncols=70):
+                results[start] = points_3d
+    else:
+        outputs = map(optim_window_wrapper, iterable)
+        for start, points_3d in tqdm(outputs, total=len(windows), ncols=70):
+            results[start] = points_3d
+
+    ## each window ramps linearly in and out over its overlaps with the
+    ## previous and next windows. The weights sum to 1 where at most two
+    ## windows overlap, but the last window is shifted back to end at the last
+    ## frame and may overlap more windows (e.g. 3 windows around frame 70 for
+    ## 160 frames, a window of 100 and an overlap of 50), so the blend is
+    ## normalized by the sum of the weights
+    points_sum = np.zeros((n_frames, n_joints, 3), dtype='float64')
+    weights_sum = np.zeros(n_frames, dtype='float64')
+    for ix, (start, end) in enumerate(windows):
+        weights = np.ones(end - start, dtype='float64')
+        if ix > 0:
+            n = windows[ix-1][1] - start
+            weights[:n] = np.arange(1, n+1) / (n+1)
+        if ix < len(windows) - 1:
+            n = end - windows[ix+1][0]
+            weights[len(weights)-n:] = np.minimum(
+                weights[len(weights)-n:], np.arange(n, 0, -1) / (n+1))
+        points_sum[start:end] += weights[:, None, None] * results[start]
+        weights_sum[start:end] += weights
+
+    return points_sum / weights_sum[:, None, None]
+
+
+def get_optim_final_max_nfev(config):
+    max_nfev = config['triangulation']['optim_final_max_nfev']
+    if not isinstance(max_nfev, int) or max_nfev < 0:
+        raise ValueError('triangulation.optim_final_max_nfev should be a non-negative '
+                         'integer, got {}'.format(max_nfev))
+    return max_nfev if max_nfev > 0 else None
+
+
+def get_optim_decimation(config):
+    factors = list(config['triangulation']['optim_decimation'])
+    for factor in factors:
+        if not isinstance(factor, int) or factor < 2:
+            raise ValueError('triangulation.optim_decimation should be a list of integers '
+                             'greater than 1, got {}'.format(factors))
+    if factors != sorted(set(factors), reverse=True):
+        raise ValueError('triangulation.optim_decimation should be decreasing, '
+                         'got {}'.format(factors))
+    return factors
+
+
+def upsample_points(points_3d, factor_from, factor_to, n_frames):
+    """Linearly interpolates 3d points on every factor_from-th frame of a trial
+    of n_frames frames onto every factor_to-th frame"""
+    t_from = np.arange(0, n_frames, factor_from)
+    t_to = np.arange(0, n_frames, factor_to)
+    flat = points_3d.reshape(len(t_from), -1)
+    out = np.empty((len(t_to), flat.shape[1]), dtype='float64')
+    for i in range(flat.shape[1]):
+        out[:, i] = np.interp(t_to, t_from, flat[:, i])
+    return out.reshape((len(t_to),) + points_3d.shape[1:])
+
+
+def optim_points_multilevel(config, cgroup, points_2d, points_3d_init,
+                            constraints, constraints_weak):
+    """Coarse to fine version of optim_points. Optimizes every d-th frame for
+    each factor d in triangulation.optim_decimation, then all frames, each
+    level starting from the upsampled solution of the previous one.
+    The smoothness of each level is weighted as optim_points would weigh it
+    from the initial triangulation at that rate, so the last level solves
+    the same problem as a single optimization, from a better start, stopping
+    after triangulation.optim_final_max_nfev evaluations.
+    The coarse levels get contiguous copies of the decimated 2d points, as
+    numba compiles the residuals of aniposelib again for strided arrays."""
+    n_frames = points_2d.shape[1]
+    scale_smooth = config['triangulation']['scale_smooth']
+    final_max_nfev = get_optim_final_max_nfev(config)
+
+    points_3d = None
+    prev_factor = None
+    total = 0
+    for factor in get_optim_decimation(config) + [1]:
+        init_raw = points_3d_init[::factor]
+        if points_3d is None:
+            if factor > 1 and np.sum(np.isfinite(init_raw[:, :, 0])) < 20:
+                continue
+            init = init_raw
+        else:
+            init = upsample_points(points_3d, prev_factor, factor, n_frames)
+        default_smooth = get_default_smooth(init_raw)
+        ## the iterations are only capped when starting from a coarser level
+        max_nfev = final_max_nfev if factor == 1 and points_3d is not None else None
+
+        start = time.time()
+        with span('optim_points_level', 'compute', frames=len(init), factor=factor):
+            if factor == 1 and config['triangulation']['optim_window'] > 0:
+                points_3d = optim_points_windowed(
+                    config, cgroup, points_2d, init,
+                    constraints, constraints_weak, default_smooth, max_nfev)
+            else:
+                scale = scale_smooth * default_smooth / get_default_smooth(init)
+                points_3d = optim_points(
+                    config, cgroup, np.ascontiguousarray(points_2d[:, ::factor]), init,
+                    constraints, constraints_weak, scale_smooth=scale, verbose=False,
+                    max_nfev=max_nfev)
+        elapsed = time.time() - start
+        total += elapsed
+        print('optimized 1/{} of the frames ({} frames) in {:.2f} seconds'.format(
+            factor, len(init), elapsed))
+        prev_factor = factor
+
+    print('coarse to fine optimization took {:.2f} seconds'.format(total))
+    return points_3d
+
+
+def triangulate_data(config, cgroup, pose_2d, checkpoint=None, frame=None):
+    """Triangulates the output of load_pose2d_fnames with a CameraGroup
+    with the same cameras. Returns a table in the pose-3d format.
+    With optim enabled, checkpoint may be a tuple (outname, key) to save the
+    initial and optimized points next to outname, and resume from them.
+    frame may be a tuple (M, center) to use instead of estimating the
+    coordinate frame from this trial."""
+    all_points_raw = pose_2d['points']
+    all_scores = pose_2d['scores']
+    bodyparts = pose_2d['bodyparts']
 
     n_cams, n_frames, n_joints, _ = all_points_raw.shape
 
     bad = all_scores < config['triangulation']['score_threshold']
     all_points_raw[bad] = np.nan
 
+    points_und = pose_2d.get('points_undistorted')
+    if points_und is not None:
+        points_und = mask_undistorted(points_und, all_points_raw)
+
     if config['triangulation']['optim']:
         constraints = load_constraints(config, bodyparts)
         constraints_weak = load_constraints(config, bodyparts, 'constraints_weak')
@@ -197,35 +704,63 @@ def triangulate(config,
         points_2d = all_points_raw
         scores_2d = all_scores
 
+        ckpt = dict()
+        if checkpoint is not None:
+            ckpt_outname, ckpt_key = checkpoint
+            ckpt = load_checkpoint(ckpt_outname, 'optim', ckpt_key) or dict()
+            if len(ckpt) > 0:
+                print('resuming from checkpoint')
+
         points_shaped = points_2d.reshape(n_cams, n_frames*n_joints, 2)
-        if config['triangulation']['ransac']:
-            points_3d_init, _, _, _ = cgroup.triangulate_ransac(points_shaped, progress=True)
+        und_shaped = None
+        if points_und is not None:
+            und_shaped = points_und.reshape(n_cams, n_frames*n_joints, 2)
+        if 'points_3d_init' in ckpt:
+            points_3d_init = ckpt['points_3d_init']
+        elif config['triangulation']['ransac']:
+            with span('triangulate_ransac', 'compute', frames=n_frames):
+                points_3d_init, _, _, _ = triangulate_ransac(
+                    config, cgroup, points_shaped, points_und=und_shaped)
         else:
-            points_3d_init = cgroup.triangulate(points_shaped, progress=True)
+            with span('triangulate', 'compute', frames=n_frames):
+                points_3d_init = triangulate_dlt(
+                    config, cgroup, points_shaped,
+                    scores=scores_2d.reshape(n_cams, n_frames*n_joints),
+                    points_und=und_shaped)
         points_3d_init = points_3d_init.reshape((n_frames, n_joints, 3))
+        if checkpoint is not None and 'points_3d_init' not in ckpt:
+            save_checkpoint(ckpt_outname, 'optim', ckpt_key,
+                            points_3d_init=points_3d_init)
 
         c = np.isfinite(points_3d_init[:, :, 0])
         if np.sum(c) < 20:
             print("warning: not enough 3D points to run optimization")
             points_3d = points_3d_init
+        elif 'points_3d' in ckpt:
+            points_3d = ckpt['points_3d']
         else:
-            points_3d = cgroup.optim_points(
-                points_2d, points_3d_init,
-                constraints=constraints,
-                constraints_weak=constraints_weak,
-                # scores=scores_2d,
-                scale_smooth=config['triangulation']['scale_smooth'],
-                scale_length=config['triangulation']['scale_length'],
-                scale_length_weak=config['triangulation']['scale_length_weak'],
-                n_deriv_smooth=config['triangulation']['n_deriv_smooth'],
-                reproj_error_threshold=config['triangulation']['reproj_error_threshold'],
-                verbose=True)
+            with span('optim_points', 'compute', frames=n_frames):
+                if len(config['triangulation']['optim_decimation']) > 0:
+                    points_3d = optim_points_multilevel(
+                        config, cgroup, points_2d, points_3d_init,
+                        constraints, constraints_weak)
+                elif config['triangulation']['optim_window'] > 0:
+                    points_3d = optim_points_windowed(
+                        config, cgroup, points_2d, points_3d_init,
+                        constraints, constraints_weak)
+                else:
+                    points_3d = optim_points(
+                        config, cgroup, points_2d, points_3d_init,
+                        constraints, constraints_weak)
+            if checkpoint is not None:
+                save_checkpoint(ckpt_outname, 'optim', ckpt_key,
+                                points_3d_init=points_3d_init, points_3d=points_3d)
 
         points_2d_flat = points_2d.reshape(n_cams, -1, 2)
         points_3d_flat = points_3d.reshape(-1, 3)
 
-        errors = cgroup.reprojection_error(
-            points_3d_flat, points_2d_flat, mean=True)
+        with span('reprojection_error', 'compute', frames=n_frames):
+            errors = cgroup.reprojection_error(points_3d_flat, points_2d_flat, mean=True)
         good_points = ~np.isnan(all_points_raw[:, :, :, 0])
         num_cams = np.sum(good_points, axis=0).astype('float')
 
@@ -239,44 +774,114 @@ def triangulate(config,
         all_errors[num_cams < 1] = np.nan
 
     else:
-        points_2d = all_points_raw.reshape(n_cams, n_frames*n_joints, 2)
-        if config['triangulation']['ransac']:
-            points_3d, picked, p2ds, errors = cgroup.triangulate_ransac(
-                points_2d, min_cams=3, progress=True)
+        all_points_3d, all_errors, num_cams, scores_3d = \
+            triangulate_points(config, cgroup, all_points_raw, all_scores,
+                               points_und=points_und)
+
+    if frame is not None:
+        M, center = frame
+        all_points_3d_adj = all_points_3d.dot(M.T) - center
+    elif has_coordinate_frame(config):
+        all_points_3d_adj, M, center = correct_coordinate_frame(config, all_points_3d, bodyparts)
+    else:
+        all_points_3d_adj = all_points_3d
+        M = np.identity(3)
+        center = np.zeros(3)
 
-            all_points_picked = p2ds.reshape(n_cams, n_frames, n_joints, 2)
-            good_points = ~np.isnan(all_points_picked[:, :, :, 0])
+    return make_pose_3d_table(bodyparts, all_points_3d_adj, all_errors, num_cams,
+                              scores_3d, M, center, np.arange(n_frames))
+
+
+def mask_undistorted(points_und, points):
+    """Undistorted points as float64, missing wherever points
+    (of the same shape) are missing"""
+    points_und = np.array(points_und, dtype='float64')
+    points_und[np.isnan(points[..., 0])] = np.nan
+    return points_und
+
+
+def triangulate_dlt(config, cgroup, points_2d, progress=True, scores=None,
+                    points_und=None):
+    """Triangulates a CxNx2 array of points with the engine in config.
+    The weighted engine weights the cameras by scores (CxN) if given.
+    points_und may be the points already undistorted."""
+    engine = get_triangulation_engine(config)
+    undistort = points_und is None
+    if not undistort:
+        points_2d = points_und
+    if engine == 'weighted':
+        return triangulate_batched(cgroup, points_2d, undistort=undistort, scores=scores)
+    elif engine == 'batched':
+        return triangulate_batched(cgroup, points_2d, undistort=undistort)
+    return cgroup.triangulate(points_2d, undistort=undistort, progress=progress)
+
+
+def triangulate_ransac(config, cgroup, points_2d, min_cams=2, progress=True,
+                       points_und=None):
+    """Triangulates a CxNx2 array of points with RANSAC over the cameras,
+    with the engine in config (the weighted engine tries the subsets
+    of cameras as the batched one, without weights). points_und may be the
+    points already undistorted, which only the batched engines use."""
+    if get_triangulation_engine(config) in ['batched', 'weighted']:
+        return triangulate_ransac_batched(cgroup, points_2d, min_cams=min_cams,
+                                          points_und=points_und)
+    return cgroup.triangulate_ransac(points_2d, min_cams=min_cams, progress=progress)
+
+
+def triangulate_points(config, cgroup, all_points_raw, all_scores, progress=True,
+                       points_und=None):
+    """Triangulates each frame on its own (without optim), from 2d points of
+    shape (cameras, frames, bodyparts, 2) with low scores already set to nan,
+    and optionally the same points already undistorted in points_und.
+    Returns the 3d points of shape (frames, bodyparts, 3) and the errors,
+    number of cameras and scores of shape (frames, bodyparts)."""
+    n_cams, n_frames, n_joints, _ = all_points_raw.shape
 
-            num_cams = np.sum(np.sum(picked, axis=0), axis=1)\
-                         .reshape(n_frames, n_joints)\
-                         .astype('float')
-        else:
-            points_3d = cgroup.triangulate(points_2d, progress=True)
+    points_2d = all_points_raw.reshape(n_cams, n_frames*n_joints, 2)
+    if points_und is not None:
+        points_und = points_und.reshape(n_cams, n_frames*n_joints, 2)
+    if config['triangulation']['ransac']:
+        with span('triangulate_ransac', 'compute', frames=n_frames):
+            points_3d, picked, p2ds, errors = triangulate_ransac(
+                config, cgroup, points_2d, min_cams=3, progress=progress,
+                points_und=points_und)
+
+        all_points_picked = p2ds.reshape(n_cams, n_frames, n_joints, 2)
+        good_points = ~np.isnan(all_points_picked[:, :, :, 0])
+
+        num_cams = np.sum(np.sum(picked, axis=0), axis=1)\
+                     .reshape(n_frames, n_joints)\
+                     .astype('float')
+    else:
+        with span('triangulate', 'compute', frames=n_frames):
+            points_3d = triangulate_dlt(config, cgroup, points_2d, progress,
+                                        all_scores.reshape(n_cams, n_frames*n_joints),
+                                        points_und)
+        with span('reprojection_error', 'compute', frames=n_frames):
             errors = cgroup.reprojection_error(points_3d, points_2d, mean=True)
-            good_points = ~np.isnan(all_points_raw[:, :, :, 0])
-            num_cams = np.sum(good_points, axis=0).astype('float')
+        good_points = ~np.isnan(all_points_raw[:, :, :, 0])
+        num_cams = np.sum(good_points, axis=0).astype('float')
 
-        all_points_3d = points_3d.reshape(n_frames, n_joints, 3)
-        all_errors = errors.reshape(n_frames, n_joints)
+    all_points_3d = points_3d.reshape(n_frames, n_joints, 3)
+    all_errors = errors.reshape(n_frames, n_joints)
 
-        all_scores[~good_points] = 2
-        scores_3d = np.min(all_scores, axis=0)
+    all_scores[~good_points] = 2
+    scores_3d = np.min(all_scores, axis=0)
 
-        scores_3d[num_cams < 2] = np.nan
-        all_errors[num_cams < 2] = np.nan
-        num_cams[num_cams < 2] = np.nan
+    scores_3d[num_cams < 2] = np.nan
+    all_errors[num_cams < 2] = np.nan
+    num_cams[num_cams < 2] = np.nan
 
-    if 'reference_point' in config['triangulation'] and 'axes' in config['triangulation']:
-        all_points_3d_adj, M, center = correct_coordinate_frame(config, all_points_3d, bodyparts)
-    else:
-        all_points_3d_adj = all_points_3d
-        M = np.identity(3)
-        center = np.zeros(3)
+    return all_points_3d, all_errors, num_cams, scores_3d
 
+
+def make_pose_3d_table(bodyparts, all_points_3d, all_errors, num_cams, scores_3d,
+                       M, center, fnum):
+    """Table in the pose-3d format from the arrays of triangulate_points"""
     dout = pd.DataFrame()
     for bp_num, bp in enumerate(bodyparts):
         for ax_num, axis in enumerate(['x','y','z']):
-            dout[bp + '_' + axis] = all_points_3d_adj[:, bp_num, ax_num]
+            dout[bp + '_' + axis] = all_points_3d[:, bp_num, ax_num]
         dout[bp + '_error'] = all_errors[:, bp_num]
         dout[bp + '_ncams'] = num_cams[:, bp_num]
         dout[bp + '_score'] = scores_3d[:, bp_num]
@@ -288,9 +893,142 @@ def triangulate(config,
     for i in range(3):
         dout['center_{}'.format(i)] = center[i]
 
-    dout['fnum'] = np.arange(n_frames)
+    dout['fnum'] = fnum
+
+    return dout
+
+
+def iter_pose2d_chunks(fname_dict, offsets_dict, cam_names, chunk_frames):
+    """Yields the 2d pose of one trial as load_pose2d_fnames would return it,
+    chunk_frames frames at a time, reading only these frames from the files"""
+    start = 0
+    while True:
+        dlabs_dict = dict([(cname, pd.read_hdf(fname_dict[cname], start=start,
+                                               stop=start + chunk_frames))
+                           for cname in cam_names])
+        out = load_pose2d_dataframes(dlabs_dict, offsets_dict, cam_names)
+        n_frames = out['points'].shape[1]
+        if n_frames > 0 or start == 0:
+            yield out
+        if n_frames < chunk_frames:
+            break
+        start += chunk_frames
+
+
+def triangulate_stream(config, cgroup, fname_dict, offsets_dict, output_fname,
+                       frame=None):
+    """Same as triangulate_data followed by write_pose_3d without optim, but
+    reads and triangulates the 2d pose triangulation.chunk_frames frames at a
+    time, so that the memory used does not grow with the length of the trial.
+    The 3d points are kept in temporary files until the coordinate frame,
+    which depends on all frames, is known (unless it is given as frame)."""
+    cam_names = cgroup.get_names()
+    chunk_frames = config['triangulation']['chunk_frames']
+    fields = ['points', 'errors', 'ncams', 'scores']
+    tmp_fnames = dict([(field, temp_fname(output_fname) + '.' + field)
+                       for field in fields])
+
+    try:
+        n_frames = 0
+        files = dict([(field, open(tmp_fnames[field], 'wb')) for field in fields])
+        with span('triangulate_stream', 'compute') as info:
+            chunks = iter_pose2d_chunks(fname_dict, offsets_dict, cam_names, chunk_frames)
+            if config['triangulation']['undistort_cache']:
+                chunks = iter_undistorted_chunks(cgroup, chunks, fname_dict, offsets_dict,
+                                                 chunk_frames)
+            for pose_2d in chunks:
+                bodyparts = pose_2d['bodyparts']
+                bad = pose_2d['scores'] < config['triangulation']['score_threshold']
+                pose_2d['points'][bad] = np.nan
+                points_und = pose_2d.get('points_undistorted')
+                if points_und is not None:
+                    points_und = mask_undistorted(points_und, pose_2d['points'])
+                results = triangulate_points(config, cgroup, pose_2d['points'],
+                                             pose_2d['scores'], progress=False,
+                                             points_und=points_und)
+                for field, arr in zip(fields, results):
+                    files[field].write(np.ascontiguousarray(arr, dtype='float64').tobytes())
+                n_frames += results[0].shape[0]
+            info['frames'] = n_frames
+        for f in files.values():
+            f.close()
+
+        n_joints = len(bodyparts)
+        shapes = {'points': (n_frames, n_joints, 3)}
+        arrays = dict()
+        for field in fields:
+            shape = shapes.get(field, (n_frames, n_joints))
+            if n_frames == 0:
+                arrays[field] = np.zeros(shape, dtype='float64')
+            else:
+                arrays[field] = np.memmap(tmp_fnames[field], dtype='float64',
+                                          mode='r', shape=shape)
+
+        if frame is not None:
+            M, center = frame
+        elif has_coordinate_frame(config):
+            M, center = get_coordinate_frame(config, arrays['points'], bodyparts)
+        else:
+            M = np.identity(3)
+            center = np.zeros(3)
+
+        def chunks():
+            for start in range(0, max(n_frames, 1), chunk_frames):
+                end = min(start + chunk_frames, n_frames)
+                points = np.asarray(arrays['points'][start:end])
+                if frame is not None or has_coordinate_frame(config):
+                    points = points.dot(M.T) - center
+                yield make_pose_3d_table(
+                    bodyparts, points,
+                    np.array(arrays['errors'][start:end]),
+                    np.array(arrays['ncams'][start:end]),
+                    np.array(arrays['scores'][start:end]),
+                    M, center, np.arange(start, end))
+
+        write_pose_3d_chunks(chunks(), output_fname, n_frames)
+        del arrays
+    finally:
+        for field in fields:
+            if os.path.exists(tmp_fnames[field]):
+                os.remove(tmp_fnames[field])
+
+
+def triangulate(config,
+                calib_folder, video_folder, pose_folder,
+                fname_dict, output_fname):
+
+    cam_names = sorted(fname_dict.keys())
+
+    calib_fname = os.path.join(calib_folder, 'calibration.toml')
+    cgroup = load_camera_group(calib_fname, cam_names)
+
+    offsets_dict = load_offsets_dict(config, cam_names, video_folder)
+
+    frame = None
+    if use_calibration_frame(config):
+        # estimated by process_session, a single trial is not enough
+        frame = load_coordinate_frame(config, calib_folder)
+        if frame is None:
+            print('W: no up to date coordinate frame in {}, '
+                  'using the frame of this trial'.format(calib_folder))
+
+    if config['triangulation']['chunk_frames'] > 0 and not config['triangulation']['optim']:
+        triangulate_stream(config, cgroup, fname_dict, offsets_dict, output_fname, frame)
+        return
+
+    out = load_pose2d_fnames(fname_dict, offsets_dict, cam_names)
+    if config['triangulation']['undistort_cache']:
+        out['points_undistorted'] = get_undistorted(cgroup, out, fname_dict, offsets_dict)
+
+    checkpoint = None
+    if config['triangulation']['optim']:
+        key = checkpoint_key(config, list(fname_dict.values()) + [calib_fname],
+                             ['triangulation', 'cameras'])
+        checkpoint = (output_fname, key)
 
-    dout.to_csv(output_fname, index=False)
+    dout = triangulate_data(config, cgroup, out, checkpoint, frame)
+    write_pose_3d(dout, output_fname)
+    remove_checkpoint(output_fname, 'optim')
 
 
 def process_session(config, session_path):
@@ -313,7 +1051,7 @@ def process_session(config, session_path):
     video_folder = os.path.join(session_path, pipeline_videos_raw)
     output_folder = os.path.join(session_path, pipeline_3d)
 
-    pose_files = glob(os.path.join(pose_folder, '*.h5'))
+    pose_files = find_files(config, pose_folder, 'h5')
 
     cam_videos = defaultdict(list)
 
@@ -327,26 +1065,34 @@ def process_session(config, session_path):
     if len(vid_names) > 0:
         os.makedirs(output_folder, exist_ok=True)
 
+    fname_dicts = dict()
     for name in vid_names:
         fnames = cam_videos[name]
         cam_names = [get_cam_name(config, f) for f in fnames]
-        fname_dict = dict(zip(cam_names, fnames))
+        fname_dicts[name] = dict(zip(cam_names, fnames))
 
-        output_fname = os.path.join(output_folder, name + '.csv')
+    if len(vid_names) > 0 and use_calibration_frame(config):
+        pipeline_pose_key = 'pose_2d_filter' if config['filter']['enabled'] else 'pose_2d'
+        get_calibration_frame(config, calib_folder, pipeline_pose_key)
+
+    for name in vid_names:
+        fnames = cam_videos[name]
+        fname_dict = fname_dicts[name]
+
+        output_fname = pose_3d_fname(config, output_folder, name)
 
         print(output_fname)
-        
-        if os.path.exists(output_fname):
+
+        calib_fname = os.path.join(calib_folder, 'calibration.toml')
+        deps = Dependencies([output_fname],
+                            fnames + [calib_fname] + coordinate_frame_inputs(config, calib_folder),
+                            ['triangulation', 'cameras'])
+        if is_up_to_date(config, deps):
             continue
 
+        yield Task(output_fname, triangulate,
+                   (config, calib_folder, video_folder, pose_folder,
+                    fname_dict, output_fname), deps)
 
-        try:
-            triangulate(config,
-                        calib_folder, video_folder, pose_folder,
-                        fname_dict, output_fname)
-        except ValueError:
-            import traceback, sys
-            traceback.print_exc(file=sys.stdout)
-            
 
 triangulate_all = make_process_fun(process_session)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from .atomic import atomic_output, temp_fname
+from .profiling import span
+
+## Undistorted 2d points of a trial, shared by all triangulation methods.
+## Every triangulation starts by undistorting the 2d points of each camera
+## into normalized coordinates. With undistort_cache = true in the
+## [triangulation] section, this is done once per trial, in bulk for each
+## camera, and the float32 result is saved in a hidden file
+## .<name>.undistorted.npz next to each 2d pose file. Later runs (with other
+## triangulation options, or the estimation of the coordinate frame) load it
+## instead of undistorting again. A file is keyed on the intrinsics of the
+## camera, its crop offset and the state of the 2d pose file, so it stays
+## valid when only the extrinsics of the calibration change.
+## Missing points are nan, which is also the visibility mask of each point.
+## When triangulating in chunks, the files are read (or written) a chunk of
+## frames at a time, so that the memory used stays bounded.
+
+UNDISTORTED_VERSION = 1
+
+
+def undistorted_fname(pose_fname):
+    folder, name = os.path.split(pose_fname)
+    return os.path.join(folder, '.{}.undistorted.npz'.format(name))
+
+
+def undistorted_key(cam, offset, pose_fname):
+    st = os.stat(pose_fname)
+    d = cam.get_dict()
+    record = {
+        'version': UNDISTORTED_VERSION,
+        'matrix': d['matrix'],
+        'distortions': d['distortions'],
+        'fisheye': d.get('fisheye', False),
+        'offset': [float(x) for x in offset],
+        'source': [st.st_size, st.st_mtime_ns]
+    }
+    text = json.dumps(record, sort_keys=True)
+    return hashlib.sha1(text.encode('utf8')).hexdigest()
+
+
+def undistort_camera(cam, points):
+    """Undistorts an array of points of shape (..., 2) with camera cam,
+    leaving missing points as nan. Returns a float32 array."""
+    out = np.full(points.shape, np.nan, dtype='float32')
+    flat = points.reshape(-1, 2)
+    out_flat = out.reshape(-1, 2)
+    good = ~np.isnan(flat[:, 0])
+    if np.any(good):
+        sub = np.array(flat[good], dtype='float64')
+        out_flat[good] = cam.undistort_points(sub)
+    return out
+
+
+def is_undistorted_valid(cam, offset, pose_fname):
+    """Whether the file of undistorted points of pose_fname is up to date,
+    without loading the points"""
+    try:
+        with np.load(undistorted_fname(pose_fname), allow_pickle=False) as data:
+            return str(data['key']) == undistorted_key(cam, offset, pose_fname)
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def load_undistorted_camera(cam, offset, pose_fname):
+    fname = undistorted_fname(pose_fname)
+    if not os.path.exists(fname):
+        return None
+    try:
+        with np.load(fname, allow_pickle=False) as data:
+            if str(data['key']) != undistorted_key(cam, offset, pose_fname):
+                return None
+            return data['points']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_undistorted_camera(cam, offset, pose_fname, points):
+    fname = undistorted_fname(pose_fname)
+    with atomic_output(fname) as tmp_fname:
+        with open(tmp_fname, 'wb') as f:
+            np.savez(f, key=np.array(undistorted_key(cam, offset, pose_fname)),
+                     points=points)
+
+
+def get_undistorted(cgroup, pose_2d, fname_dict, offsets_dict):
+    """Undistorted points of the output of load_pose2d_fnames, of shape
+    (cameras, frames, bodyparts, 2), loaded from the files next to the 2d
+    pose files of fname_dict when they are up to date, or else computed
+    and saved there"""
+    cam_names = pose_2d['cam_names']
+    points = pose_2d['points']
+    out = np.empty(points.shape, dtype='float32')
+    with span('undistort_points', 'compute', frames=points.shape[1]):
+        for cix, (cname, cam) in enumerate(zip(cam_names, cgroup.cameras)):
+            pose_fname = fname_dict[cname]
+            offset = offsets_dict[cname] if offsets_dict is not None else (0, 0)
+            und = load_undistorted_camera(cam, offset, pose_fname)
+            if und is None or und.shape != points[cix].shape:
+                und = undistort_camera(cam, points[cix])
+                save_undistorted_camera(cam, offset, pose_fname, und)
+            out[cix] = und
+    return out
+
+
+def iter_undistorted_chunks(cgroup, chunks, fname_dict, offsets_dict, chunk_frames):
+    """Yields the chunks of 2d pose of iter_pose2d_chunks, with their points
+    undistorted as in get_undistorted added as 'points_undistorted'. These
+    are read chunk_frames frames at a time from the files that are up to
+    date. The other cameras are undistorted chunk by chunk into a temporary
+    file, which is saved as their file once all the chunks are read."""
+    from .pose_io import iter_npz_array
+    cam_names = cgroup.get_names()
+    offsets = dict()
+    readers = dict()
+    spools = dict()
+    for cname, cam in zip(cam_names, cgroup.cameras):
+        pose_fname = fname_dict[cname]
+        offsets[cname] = offsets_dict[cname] if offsets_dict is not None else (0, 0)
+        if is_undistorted_valid(cam, offsets[cname], pose_fname):
+            readers[cname] = iter_npz_array(undistorted_fname(pose_fname), 'points',
+                                            chunk_frames)
+        else:
+            spool_fname = temp_fname(undistorted_fname(pose_fname)) + '.raw'
+            spools[cname] = (spool_fname, open(spool_fname, 'wb'))
+
+    try:
+        shape = None
+        n_frames = 0
+        for out in chunks:
+            points = out['points']
+            und = np.empty(points.shape, dtype='float32')
+            for cix, (cname, cam) in enumerate(zip(cam_names, cgroup.cameras)):
+                if cname in readers:
+                    cached = next(readers[cname], None)
+                    if cached is not None and cached[:points.shape[1]].shape == und[cix].shape:
+                        und[cix] = cached[:points.shape[1]]
+                    else:
+                        und[cix] = undistort_camera(cam, points[cix])
+                else:
+                    und[cix] = undistort_camera(cam, points[cix])
+                    spools[cname][1].write(und[cix].tobytes())
+            n_frames += points.shape[1]
+            shape = points.shape[2:]
+            out['points_undistorted'] = und
+            yield out
+
+        for cname, (spool_fname, f) in spools.items():
+            f.close()
+            if n_frames == 0:
+                continue
+            cam = cgroup.cameras[cam_names.index(cname)]
+            und = np.memmap(spool_fname, dtype='float32', mode='r',
+                            shape=(n_frames,) + tuple(shape))
+            save_undistorted_camera(cam, offsets[cname], fname_dict[cname], und)
+            del und
+    finally:
+        for reader in readers.values():
+            reader.close()
+        for spool_fname, f in spools.values():
+            f.close()
+            if os.path.exists(spool_fname):
+                os.remove(spool_fname)
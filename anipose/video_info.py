@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+## Persistent cache of video metadata (fps, nframes, width, height, duration, codec).
+## Probing a video means opening it with opencv and running ffprobe on it, which
+## is slow on network filesystems, so the results are kept in a sqlite database
+## shared across projects, keyed by the video path and checked against its size
+## and mtime.
+## The database is in $ANIPOSE_CACHE_DIR if set, otherwise ~/.cache/anipose
+
+CACHE_NAME = 'videos.sqlite'
+
+_connections = dict()
+
+
+def get_cache_folder():
+    if 'ANIPOSE_CACHE_DIR' in os.environ:
+        return os.environ['ANIPOSE_CACHE_DIR']
+    cache_home = os.environ.get('XDG_CACHE_HOME',
+                                os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'anipose')
+
+
+def get_connection():
+    fname = os.path.join(get_cache_folder(), CACHE_NAME)
+    key = (fname, os.getpid())
+    if key in _connections:
+        return _connections[key]
+
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    conn = sqlite3.connect(fname, timeout=60)
+    conn.execute('CREATE TABLE IF NOT EXISTS videos ('
+                 'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                 'info TEXT)')
+    conn.commit()
+    _connections[key] = conn
+    return conn
+
+
+def probe_ffprobe(fname):
+    import skvideo.io
+    try:
+        metadata = skvideo.io.ffprobe(fname)
+    except Exception: # ffprobe missing or unable to read the file
+        return dict()
+    if 'video' not in metadata:
+        return dict()
+
+    video = metadata['video']
+    out = dict()
+    if '@nb_frames' in video:
+        out['nframes'] = int(video['@nb_frames'])
+    if '@duration' in video:
+        out['duration'] = float(video['@duration'])
+    if '@codec_name' in video:
+        out['codec'] = video['@codec_name']
+    return out
+
+
+def probe_video(fname):
+    """Reads the metadata of a video, without going through the cache.
+    Frame count, duration and codec are taken from ffprobe when available,
+    the rest from opencv."""
+    cap = cv2.VideoCapture(fname)
+    if not cap.isOpened():
+        return {'width': 0, 'height': 0, 'nframes': 0, 'fps': 0.0,
+                'codec': '', 'duration': 0.0}
+    fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+    info = {
+        'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        'nframes': int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+        'fps': cap.get(cv2.CAP_PROP_FPS),
+        'codec': ''.join([chr((fourcc >> 8*i) & 0xFF) for i in range(4)]).strip('\x00 ')
+    }
+    cap.release()
+
+    if info['fps'] > 0:
+        info['duration'] = info['nframes'] / info['fps']
+    else:
+        info['duration'] = 0.0
+
+    info.update(probe_ffprobe(fname))
+    return info
+
+
+def file_key(fname):
+    fname = os.path.abspath(fname)
+    try:
+        st = os.stat(fname)
+    except FileNotFoundError:
+        return fname, -1, -1
+    return fname, st.st_size, st.st_mtime_ns
+
+
+def lookup(keys):
+    """Returns a dict of path -> info for the keys found in the cache"""
+    out = dict()
+    try:
+        conn = get_connection()
+        for path, size, mtime_ns in keys:
+            row = conn.execute('SELECT size, mtime_ns, info FROM videos WHERE path = ?',
+                               (path,)).fetchone()
+            if row is not None and row[0] == size and row[1] == mtime_ns:
+                out[path] = json.loads(row[2])
+    except sqlite3.Error:
+        pass
+    return out
+
+
+def store(keys, infos):
+    try:
+        conn = get_connection()
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?)',
+                             [(path, size, mtime_ns, json.dumps(info))
+                              for (path, size, mtime_ns), info in zip(keys, infos)])
+    except sqlite3.Error:
+        pass # the cache is optional, the metadata is still correct
+
+
+def probe_videos(fnames, n_threads=8):
+    """Returns a list with the metadata of each video in fnames.
+    Videos missing from the cache (or changed since they were cached)
+    are probed in parallel and added to the cache."""
+    keys = [file_key(f) for f in fnames]
+    cached = lookup(keys)
+
+    missing = [k for k in keys if k[0] not in cached]
+    if len(missing) > 0:
+        n_threads = max(min(n_threads, len(missing)), 1)
+        with ThreadPoolExecutor(n_threads) as pool:
+            infos = list(pool.map(probe_video, [k[0] for k in missing]))
+        store([k for k in missing if k[1] >= 0],
+              [info for k, info in zip(missing, infos) if k[1] >= 0])
+        for key, info in zip(missing, infos):
+            cached[key[0]] = info
+
+    return [cached[k[0]] for k in keys]
+
+
+def get_video_info(fname):
+    return probe_videos([fname])[0]